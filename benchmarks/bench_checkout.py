@@ -0,0 +1,71 @@
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import git_object
+import git_repository
+import libwyag
+
+
+def make_tree(repo, rng, depth, fanout, files, size):
+    tree = git_object.GitTree()
+    
+    for i in range(files):
+        blob = git_object.GitBlob()
+        blob.blobdata = bytes(rng.choices(b'abcdefghijklmnop \n', k=size))
+        mode = b'100755' if i % 10 == 0 else b'100644'
+        tree.items.append(git_object.GitTreeLeaf(mode, f'file{i}.txt', git_object.object_write(blob, repo)))
+    
+    if depth > 0:
+        for i in range(fanout):
+            sha = make_tree(repo, rng, depth - 1, fanout, files, size)
+            tree.items.append(git_object.GitTreeLeaf(b'040000', f'dir{i}', sha))
+    
+    return git_object.object_write(tree, repo)
+
+def run(repo, sha, jobs, scratch):
+    dest = os.path.join(scratch, f'checkout-{jobs}')
+    if os.path.exists(dest):
+        shutil.rmtree(dest)
+    os.makedirs(dest)
+    
+    repo.object_cache = None
+    repo.delta_cache = None
+    start = time.perf_counter()
+    libwyag.tree_checkout(repo, git_object.object_read(repo, sha), dest, jobs=jobs)
+    return time.perf_counter() - start
+
+def main(argv=sys.argv[1:]):
+    argparser = argparse.ArgumentParser(description='Serial vs parallel tree_checkout on a synthetic tree')
+    argparser.add_argument('--depth', type=int, default=3)
+    argparser.add_argument('--fanout', type=int, default=6)
+    argparser.add_argument('--files', type=int, default=40, help='Files per directory')
+    argparser.add_argument('--size', type=int, default=4096, help='Bytes per file')
+    argparser.add_argument('--jobs', type=int, nargs='+', default=[1, 2, 4, 8])
+    argparser.add_argument('--repeat', type=int, default=3)
+    args = argparser.parse_args(argv)
+    
+    scratch = tempfile.mkdtemp(prefix='wyag-bench-')
+    try:
+        repo = git_repository.repo_create(os.path.join(scratch, 'repo'))
+        sha = make_tree(repo, random.Random(0), args.depth, args.fanout, args.files, args.size)
+        count = args.files * sum(args.fanout ** d for d in range(args.depth + 1))
+        print(f'tree {sha}: {count} files of {args.size} bytes')
+        
+        baseline = None
+        for jobs in args.jobs:
+            best = min(run(repo, sha, jobs, scratch) for _ in range(args.repeat))
+            if baseline is None:
+                baseline = best
+            print(f'-j {jobs:<3} {best:8.3f}s  {baseline / best:5.2f}x')
+    finally:
+        shutil.rmtree(scratch)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import git_index
+
+
+def make_index(count, version):
+    entries = list()
+    for i in range(count):
+        sha = format(i * 2654435761 % (1 << 160), '040x')
+        name = f'dir-{i // 1000:04d}/sub-{i // 50 % 20:02d}/file-{i:07d}.txt'
+        entries.append(git_index.index_entry_make(ctime=(i, 0), mtime=(i, 0), ino=i, fsize=i, sha=sha, name=name))
+    return git_index.index_serialize(git_index.GitIndex(version=version, entries=entries))
+
+def measure(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main(argv=sys.argv[1:]):
+    argparser = argparse.ArgumentParser(description='Index parse and serialize timings')
+    argparser.add_argument('--entries', type=int, nargs='+', default=[10000, 500000])
+    argparser.add_argument('--repeat', type=int, default=3)
+    args = argparser.parse_args(argv)
+
+    for count in args.entries:
+        for version in (2, 4):
+            raw = make_index(count, version)
+            index = git_index.index_parse(raw)
+            print(f'{count} entries, version {version} ({len(raw) / 1024 / 1024:.1f} MiB)')
+            print(f'  {"parse, checksum verified":<30} {measure(lambda: git_index.index_parse(raw), args.repeat) * 1e3:9.2f} ms')
+            print(f'  {"parse, no checksum":<30} {measure(lambda: git_index.index_parse(raw, verify=False), args.repeat) * 1e3:9.2f} ms')
+            print(f'  {"serialize":<30} {measure(lambda: git_index.index_serialize(index), args.repeat) * 1e3:9.2f} ms')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+import argparse
+import collections
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import git_object
+
+
+# The recursive parser and concatenating serializer kvlm_parse and
+# kvlm_serialize replaced, kept here as the baseline to compare against.
+def kvlm_parse_recursive(raw, start=0, dct=None):
+    if not dct:
+        dct = collections.OrderedDict()
+    
+    space = raw.find(b' ', start)
+    newline = raw.find(b'\n', start)
+
+    if space < 0 or newline < space:
+        dct[None] = raw[start + 1:]
+        return dct
+    
+    key = raw[start:space]
+    end = start
+    while True:
+        end = raw.find(b'\n', end + 1)
+        if raw[end + 1] != ord(' '):
+            break
+    
+    value = raw[space + 1:end].replace(b'\n ', b'\n')
+    
+    if key in dct:
+        if type(dct[key]) == list:
+            dct[key].append(value)
+        else:
+            dct[key] = [dct[key], value]
+    else:
+        dct[key] = value
+    
+    return kvlm_parse_recursive(raw, start=end + 1, dct=dct)
+
+def kvlm_serialize_concat(kvlm):
+    ret = b''
+    
+    for k in kvlm.keys():
+        if k == None:
+            continue
+        
+        val = kvlm[k]
+        if type(val) != list:
+            val = [val]
+        
+        for v in val:
+            ret += k + b' ' + (v.replace(b'\n', b'\n ')) + b'\n'
+
+    ret += b'\n' + kvlm[None]
+    
+    return ret
+
+def make_commit(parents, signature_lines, message_lines):
+    lines = [b'tree ' + b'1' * 40]
+    for i in range(parents):
+        lines.append(b'parent ' + format(i, '040x').encode())
+    lines.append(b'author Wyag <wyag@example.com> 1700000000 +0000')
+    lines.append(b'committer Wyag <wyag@example.com> 1700000000 +0000')
+    if signature_lines:
+        sig = [b'-----BEGIN PGP SIGNATURE-----', b'']
+        sig += [b'A' * 64] * signature_lines
+        sig += [b'-----END PGP SIGNATURE-----']
+        lines.append(b'gpgsig ' + b'\n '.join(sig))
+    body = b'\n'.join(b'message line %d' % i for i in range(message_lines))
+    return b'\n'.join(lines) + b'\n\n' + body + b'\n'
+
+def measure(fn, number):
+    try:
+        return min(timeit.repeat(fn, number=number, repeat=5)) / number
+    except RecursionError:
+        return None
+
+def show(label, seconds, baseline=None):
+    if seconds is None:
+        print(f'  {label:<34} RecursionError')
+    elif baseline:
+        print(f'  {label:<34} {seconds * 1e6:10.1f} us  {baseline / seconds:6.2f}x')
+    else:
+        print(f'  {label:<34} {seconds * 1e6:10.1f} us')
+
+def main(argv=sys.argv[1:]):
+    argparser = argparse.ArgumentParser(description='kvlm parse/serialize micro-benchmarks')
+    argparser.add_argument('--number', type=int, default=200)
+    args = argparser.parse_args(argv)
+    
+    cases = [
+        ('plain commit', make_commit(1, 0, 3)),
+        ('signed commit', make_commit(1, 400, 20)),
+        ('octopus, 64 parents', make_commit(64, 0, 3)),
+        ('octopus, 2000 parents', make_commit(2000, 0, 3)),
+    ]
+    
+    for name, raw in cases:
+        print(f'{name} ({len(raw)} bytes)')
+        old = measure(lambda: kvlm_parse_recursive(raw), args.number)
+        show('parse, recursive', old)
+        show('parse, iterative', measure(lambda: git_object.kvlm_parse(raw), args.number), old)
+        show('parse tree+parent only', measure(lambda: git_object.kvlm_parse(raw, keys=(b'tree', b'parent')), args.number), old)
+        
+        kvlm = git_object.kvlm_parse(raw)
+        old = measure(lambda: kvlm_serialize_concat(kvlm), args.number)
+        show('serialize, concatenating', old)
+        show('serialize, join', measure(lambda: git_object.kvlm_serialize(kvlm), args.number), old)
+
+if __name__ == '__main__':
+    main()
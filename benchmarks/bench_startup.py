@@ -0,0 +1,125 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_suite import compare, revision
+import git_serve
+import synthetic
+
+WYAG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'wyag')
+
+COMMANDS = {
+    'python'     : None,
+    'help'       : ['--help'],
+    'rev-parse'  : ['rev-parse', 'HEAD'],
+    'show-ref'   : ['show-ref'],
+    'cat-file'   : ['cat-file', 'commit', 'HEAD'],
+    'status'     : ['status', '-s', '-u', 'no'],
+}
+
+
+def measure(argv, cwd, runs, env=None):
+    times = list()
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(argv, cwd=cwd, env=env, stdout=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start)
+    return {'min': min(times), 'median': statistics.median(times), 'runs': times}
+
+def import_times(limit):
+    # the modules that dominate importing libwyag, by cumulative time
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import libwyag'],
+                          cwd=os.path.dirname(WYAG), stderr=subprocess.PIPE, text=True, check=True)
+    rows = list()
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        own, total, name = line[len('import time:'):].split('|')
+        rows.append((int(total), int(own), name.strip()))
+    rows.sort(reverse=True)
+    return rows[:limit]
+
+def main(argv=sys.argv[1:]):
+    argparser = argparse.ArgumentParser(description='Wall clock time of short wyag invocations')
+    argparser.add_argument('--repo', help='Run in this repository instead of a generated one')
+    argparser.add_argument('--runs', type=int, default=30)
+    argparser.add_argument('--command', nargs='+', choices=list(COMMANDS), default=list(COMMANDS))
+    argparser.add_argument('--serve', action='store_true',
+                           help='Also time the commands answered by a running wyag serve')
+    argparser.add_argument('--imports', type=int, default=0, metavar='N',
+                           help='Also print the N slowest imports of libwyag')
+    argparser.add_argument('--output', help='Write the results as JSON to this file')
+    argparser.add_argument('--compare', help='A previous JSON result to compare against')
+    args = argparser.parse_args(argv)
+
+    scratch = tempfile.mkdtemp(prefix='wyag-startup-')
+    server = None
+    try:
+        path = args.repo
+        if not path:
+            path = os.path.join(scratch, 'repo')
+            synthetic.generate(path, synthetic.SyntheticSpec(commits=20, depth=2, refs=20))
+
+        results = {
+            'meta': {
+                'revision': revision(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'runs': args.runs,
+                'bytecode': not sys.dont_write_bytecode,
+            },
+            'results': dict(),
+        }
+
+        runs = [(name, None) for name in args.command]
+        if args.serve:
+            sock = os.path.join(scratch, 'wyag.sock')
+            server = subprocess.Popen([sys.executable, WYAG, 'serve', '--socket', sock], cwd=path)
+            while not os.path.exists(sock) and server.poll() is None:
+                time.sleep(0.01)
+            env = dict(os.environ, WYAG_SOCKET=sock)
+            runs.extend((name, env) for name in args.command if name in git_serve.SERVE_COMMANDS)
+
+        for name, env in runs:
+            wyag = COMMANDS[name]
+            cmd = [sys.executable, '-c', 'pass'] if wyag is None else [sys.executable, WYAG] + wyag
+            if env:
+                name += ' served'
+            # one untimed run so the page cache, bytecode and server are warm
+            subprocess.run(cmd, cwd=path, env=env, stdout=subprocess.DEVNULL, check=True)
+            result = measure(cmd, path, args.runs, env)
+            results['results'][name] = result
+            print(f'  {name:<18} {result['min'] * 1e3:10.2f} ms min {result['median'] * 1e3:10.2f} ms median',
+                  file=sys.stderr)
+    finally:
+        if server:
+            server.send_signal(signal.SIGINT)
+            server.wait()
+        shutil.rmtree(scratch)
+
+    for total, own, name in import_times(args.imports):
+        print(f'  {total / 1e3:8.2f} ms {own / 1e3:8.2f} ms self  {name}', file=sys.stderr)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import git_index
+import git_object
+import git_refs
+import git_repository
+import libwyag
+import synthetic
+
+
+def scenario_cat_file(path, ctx):
+    repo = git_repository.GitRepository(path)
+    names = ''.join(sha + '\n' for sha in ctx['blobs']).encode()
+    libwyag.cat_file_batch(repo, io.BytesIO(names), io.BytesIO(), flush=False)
+
+def scenario_ls_tree(path, ctx):
+    repo = git_repository.GitRepository(path)
+    with contextlib.redirect_stdout(io.StringIO()):
+        libwyag.ls_tree(repo, 'HEAD', recursive=True)
+
+def scenario_log(path, ctx):
+    repo = git_repository.GitRepository(path)
+    with contextlib.redirect_stdout(io.StringIO()):
+        libwyag.log_graphviz(repo, git_object.object_find(repo, 'HEAD'), set())
+
+def scenario_rev_parse(path, ctx):
+    repo = git_repository.GitRepository(path)
+    for name in ctx['names']:
+        git_object.object_find(repo, name)
+
+def scenario_show_ref(path, ctx):
+    repo = git_repository.GitRepository(path)
+    with contextlib.redirect_stdout(io.StringIO()):
+        libwyag.show_ref(repo, 'refs/')
+
+def scenario_checkout(path, ctx):
+    repo = git_repository.GitRepository(path)
+    dest = tempfile.mkdtemp(prefix='checkout-', dir=ctx['scratch'])
+    try:
+        tree = git_object.object_read(repo, git_object.object_find(repo, 'HEAD', fmt=b'tree'))
+        libwyag.tree_checkout(repo, tree, dest)
+    finally:
+        shutil.rmtree(dest)
+
+def scenario_index_load(path, ctx):
+    repo = git_repository.GitRepository(path)
+    git_index.index_read(repo)
+
+SCENARIOS = {
+    'cat-file'   : scenario_cat_file,
+    'ls-tree'    : scenario_ls_tree,
+    'log'        : scenario_log,
+    'rev-parse'  : scenario_rev_parse,
+    'show-ref'   : scenario_show_ref,
+    'checkout'   : scenario_checkout,
+    'index-load' : scenario_index_load,
+}
+
+def context(path, commits, scratch):
+    repo = git_repository.GitRepository(path)
+    tree = git_object.object_read(repo, git_object.object_find(repo, 'HEAD', fmt=b'tree'))
+
+    blobs = list()
+    stack = [tree]
+    while stack:
+        for mode, _, binsha in stack.pop().entries():
+            if git_object.tree_mode_is_tree(mode):
+                stack.append(git_object.object_read(repo, binsha.hex()))
+            else:
+                blobs.append(binsha.hex())
+
+    refs = [name.split('/', 2)[2] for name, _ in git_refs.ref_store(repo).iter_prefix('refs/')]
+    names = ['HEAD', 'master'] + refs[::max(1, len(refs) // 50)] + [sha[:10] for sha in commits[::max(1, len(commits) // 50)]]
+    return {'blobs': blobs, 'names': names, 'scratch': scratch}
+
+def measure(fn, path, ctx, repeat):
+    runs = list()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(path, ctx)
+        runs.append(time.perf_counter() - start)
+    return {'min': min(runs), 'median': statistics.median(runs), 'runs': runs}
+
+def revision():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        repo = git_repository.GitRepository(root)
+        return git_object.ref_resolve(repo, 'HEAD')
+    except Exception:
+        return None
+
+def compare(results, baseline):
+    for name, result in results['results'].items():
+        old = baseline['results'].get(name)
+        if not old:
+            continue
+        ratio = old['median'] / result['median'] if result['median'] else float('inf')
+        print(f'  {name:<12} {old['median'] * 1e3:10.2f} ms -> {result['median'] * 1e3:10.2f} ms  {ratio:6.2f}x')
+
+def main(argv=sys.argv[1:]):
+    argparser = argparse.ArgumentParser(description='Timed wyag scenarios on a generated repository')
+    argparser.add_argument('--commits', type=int, default=200)
+    argparser.add_argument('--depth', type=int, default=3, help='Directory nesting below the root')
+    argparser.add_argument('--fanout', type=int, default=4, help='Subdirectories per directory')
+    argparser.add_argument('--files', type=int, default=8, help='Files per directory')
+    argparser.add_argument('--blob-median', type=int, default=2048, dest='blob_median', help='Median blob size in bytes')
+    argparser.add_argument('--blob-sigma', type=float, default=1.0, dest='blob_sigma', help='Spread of the log-normal blob sizes')
+    argparser.add_argument('--changes', type=int, default=6, help='Files modified per commit')
+    argparser.add_argument('--refs', type=int, default=100)
+    argparser.add_argument('--seed', type=int, default=1)
+    argparser.add_argument('--pack', action='store_true', help='Repack the generated objects before measuring')
+    argparser.add_argument('--repeat', type=int, default=5)
+    argparser.add_argument('--scenario', nargs='+', choices=sorted(SCENARIOS), default=list(SCENARIOS))
+    argparser.add_argument('--output', help='Write the results as JSON to this file')
+    argparser.add_argument('--compare', help='A previous JSON result to compare against')
+    argparser.add_argument('--keep', help='Generate the repository here and keep it')
+    args = argparser.parse_args(argv)
+
+    spec = synthetic.SyntheticSpec(commits=args.commits, depth=args.depth, fanout=args.fanout, files=args.files,
+                                   blob_median=args.blob_median, blob_sigma=args.blob_sigma, changes=args.changes,
+                                   refs=args.refs, seed=args.seed, pack=args.pack)
+
+    scratch = tempfile.mkdtemp(prefix='wyag-suite-')
+    try:
+        path = args.keep or os.path.join(scratch, 'repo')
+        start = time.perf_counter()
+        _, commits, paths = synthetic.generate(path, spec)
+        generated = time.perf_counter() - start
+        ctx = context(path, commits, scratch)
+
+        results = {
+            'meta': {
+                'revision': revision(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpus': os.cpu_count(),
+                'spec': spec.params(),
+                'files': len(paths),
+                'generate_seconds': generated,
+                'repeat': args.repeat,
+            },
+            'results': dict(),
+        }
+
+        for name in args.scenario:
+            result = measure(SCENARIOS[name], path, ctx, args.repeat)
+            results['results'][name] = result
+            print(f'  {name:<12} {result['min'] * 1e3:10.2f} ms min {result['median'] * 1e3:10.2f} ms median',
+                  file=sys.stderr)
+    finally:
+        shutil.rmtree(scratch)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+if __name__ == '__main__':
+    main()
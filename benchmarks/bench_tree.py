@@ -0,0 +1,96 @@
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import git_object
+
+
+# The eager parser and concatenating serializer GitTree used before the
+# compact representation, kept here as the baseline to compare against.
+class EagerTreeLeaf(object):
+    def __init__(self, mode, path, sha):
+        self.mode = mode
+        self.path = path
+        self.sha = sha
+
+def tree_parse_eager(raw):
+    pos = 0
+    ret = list()
+    while pos < len(raw):
+        x = raw.find(b' ', pos)
+        mode = raw[pos:x]
+        if len(mode) == 5:
+            mode = b'0' + mode
+        y = raw.find(b'\x00', x)
+        sha = format(int.from_bytes(raw[y+1:y+21], 'big'), '040x')
+        ret.append(EagerTreeLeaf(mode, raw[x+1:y].decode('utf8'), sha))
+        pos = y + 21
+    return ret
+
+def tree_serialize_concat(items):
+    ret = b''
+    for i in items:
+        ret += i.mode.lstrip(b'0') + b' ' + i.path.encode('utf8') + b'\x00'
+        ret += int(i.sha, 16).to_bytes(20, byteorder='big')
+    return ret
+
+def make_tree(count):
+    tree = git_object.GitTree()
+    for i in range(count):
+        mode = b'040000' if i % 20 == 0 else b'100644'
+        sha = format(i * 2654435761 % (1 << 160), '040x')
+        tree.items.append(git_object.GitTreeLeaf(mode, f'entry-{i:07d}.txt', sha))
+    return tree.serialize()
+
+def measure(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    
+    tracemalloc.start()
+    keep = fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del keep
+    return best, peak
+
+def show(label, result, baseline=None):
+    seconds, peak = result
+    line = f'  {label:<30} {seconds * 1e3:9.2f} ms {peak / 1024 / 1024:9.2f} MiB'
+    if baseline:
+        line += f'  {baseline[0] / seconds:7.1f}x time {baseline[1] / max(peak, 1):7.1f}x memory'
+    print(line)
+
+def main(argv=sys.argv[1:]):
+    argparser = argparse.ArgumentParser(description='Eager vs compact tree parsing')
+    argparser.add_argument('--entries', type=int, nargs='+', default=[1000, 50000])
+    argparser.add_argument('--repeat', type=int, default=5)
+    args = argparser.parse_args(argv)
+    
+    for count in args.entries:
+        raw = make_tree(count)
+        name = f'entry-{count // 2:07d}.txt'
+        print(f'{count} entries ({len(raw)} bytes)')
+        
+        eager = measure(lambda: tree_parse_eager(raw), args.repeat)
+        show('parse, eager leaves', eager)
+        show('parse, compact index', measure(lambda: git_object.GitTree(raw).index(), args.repeat), eager)
+        show('walk entries()', measure(lambda: sum(1 for _ in git_object.GitTree(raw).entries()), args.repeat), eager)
+        show('parse + find one name', measure(lambda: git_object.GitTree(raw).find(name), args.repeat), eager)
+        
+        items = tree_parse_eager(raw)
+        old = measure(lambda: tree_serialize_concat(items), args.repeat)
+        show('serialize, concatenating', old)
+        tree = git_object.GitTree(raw)
+        tree.items
+        show('serialize, join', measure(lambda: git_object.tree_serialize(tree), args.repeat), old)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import git_index
+import git_object
+import git_refs
+import git_repack
+import git_repository
+
+EPOCH = 1700000000
+WORDS = [b'alpha', b'beta', b'gamma', b'delta', b'return', b'value', b'index', b'tree', b'object',
+         b'commit', b'self', b'import', b'def', b'class', b'for', b'in', b'if', b'else', b'=', b'+']
+
+
+class SyntheticSpec(object):
+
+    def __init__(self, commits=200, depth=3, fanout=4, files=8, blob_median=2048, blob_sigma=1.0,
+                 changes=6, refs=100, seed=1, pack=False):
+        self.commits = commits
+        self.depth = depth
+        self.fanout = fanout
+        self.files = files
+        self.blob_median = blob_median
+        self.blob_sigma = blob_sigma
+        self.changes = changes
+        self.refs = refs
+        self.seed = seed
+        self.pack = pack
+
+    def params(self):
+        return dict(self.__dict__)
+
+
+def blob_content(rng, median, sigma):
+    # log-normal sizes; text made of lines so edits can be deltified
+    size = max(1, int(rng.lognormvariate(0, sigma) * median))
+    lines = list()
+    total = 0
+    while total < size:
+        line = b' '.join(rng.choices(WORDS, k=rng.randint(2, 12))) + b'\n'
+        lines.append(line)
+        total += len(line)
+    return b''.join(lines)[:size]
+
+def blob_edit(rng, data):
+    lines = data.splitlines(keepends=True) or [b'\n']
+    for _ in range(rng.randint(1, 4)):
+        i = rng.randrange(len(lines))
+        lines[i] = b' '.join(rng.choices(WORDS, k=rng.randint(2, 12))) + b'\n'
+    return b''.join(lines)
+
+def layout(spec):
+    paths = list()
+    stack = [(b'', 0)]
+    while stack:
+        prefix, level = stack.pop()
+        for i in range(spec.files):
+            paths.append(prefix + b'file%03d.txt' % i)
+        if level < spec.depth:
+            for i in range(spec.fanout):
+                stack.append((prefix + b'dir%02d/' % i, level + 1))
+    return sorted(paths)
+
+def tree_write(batch, files):
+    # files maps full paths to blob shas; returns the root tree sha
+    root = dict()
+    for path, sha in files.items():
+        node = root
+        parts = path.split(b'/')
+        for part in parts[:-1]:
+            node = node.setdefault(part, dict())
+        node[parts[-1]] = sha
+
+    def write(node):
+        parts = list()
+        for name in sorted(node, key=lambda n: n + b'/' if type(node[n]) == dict else n):
+            value = node[name]
+            if type(value) == dict:
+                parts.append(b'40000 ' + name + b'\x00' + bytes.fromhex(write(value)))
+            else:
+                parts.append(b'100644 ' + name + b'\x00' + bytes.fromhex(value))
+        return batch.write(b'tree', b''.join(parts))
+
+    return write(root)
+
+def commit_write(batch, tree, parent, when, message):
+    parts = [b'tree ' + tree.encode()]
+    if parent:
+        parts.append(b'parent ' + parent.encode())
+    ident = b'Bench <bench@example.com> %d +0000' % when
+    parts.append(b'author ' + ident)
+    parts.append(b'committer ' + ident)
+    return batch.write(b'commit', b'\n'.join(parts) + b'\n\n' + message + b'\n')
+
+def generate(path, spec):
+    rng = random.Random(spec.seed)
+    repo = git_repository.repo_create(path)
+    batch = git_object.GitLooseBatch(repo)
+
+    paths = layout(spec)
+    contents = dict()
+    files = dict()
+    for p in paths:
+        contents[p] = blob_content(rng, spec.blob_median, spec.blob_sigma)
+        files[p] = batch.write(b'blob', contents[p])
+
+    commits = list()
+    parent = None
+    for n in range(spec.commits):
+        if n:
+            for p in rng.sample(paths, min(spec.changes, len(paths))):
+                contents[p] = blob_edit(rng, contents[p])
+                files[p] = batch.write(b'blob', contents[p])
+        tree = tree_write(batch, files)
+        parent = commit_write(batch, tree, parent, EPOCH + 60 * n, b'commit %d' % n)
+        commits.append(parent)
+    batch.close()
+
+    git_refs.ref_write(repo, 'refs/heads/master', parent)
+    for i in range(spec.refs):
+        kind = 'tags' if i % 2 else 'heads'
+        git_refs.ref_write(repo, f'refs/{kind}/ref{i:05d}', rng.choice(commits))
+
+    entries = [git_index.index_entry_make(sha=files[p], name=p.decode('ascii'), fsize=len(contents[p]))
+               for p in paths]
+    git_index.index_write(repo, git_index.GitIndex(entries=entries))
+
+    if spec.pack:
+        git_repack.repack(repo, all_objects=True, delete=True)
+
+    return repo, commits, paths
@@ -0,0 +1,119 @@
+import asyncio
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+import git_object
+import git_refs
+
+ASYNC_WORKERS = 4
+ASYNC_PREFETCH = 8
+
+
+class GitAsyncStore(object):
+
+    def __init__(self, repo, workers=ASYNC_WORKERS):
+        self.repo = repo
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='wyag-async')
+        self.pending = dict()
+        # the ref store rescans in place, so only one thread may use it
+        self.refs_lock = threading.Lock()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, kind, value, tb):
+        self.close()
+        return False
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    async def run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    def refs_call(self, fn, *args):
+        with self.refs_lock:
+            return fn(*args)
+
+    async def read_object(self, sha):
+        cache = git_object.object_cache(self.repo)
+        if sha in cache:
+            obj = cache.get(sha)
+            if obj is not None:
+                return obj
+
+        # concurrent requests for one object share a single read; shielded so
+        # a cancelled caller does not cancel it for the others
+        future = self.pending.get(sha)
+        if future is None:
+            future = asyncio.ensure_future(self.run(object_load, self.repo, sha))
+            self.pending[sha] = future
+            future.add_done_callback(lambda _: self.pending.pop(sha, None))
+        return await asyncio.shield(future)
+
+    async def resolve(self, name, fmt=None):
+        return await self.run(self.refs_call, git_object.object_find, self.repo, name, fmt)
+
+    async def list_refs(self, prefix='refs/'):
+        store = git_refs.ref_store(self.repo)
+        return await self.run(self.refs_call, lambda: list(store.iter_prefix(prefix)))
+
+    async def walk_tree(self, sha, prefetch=ASYNC_PREFETCH):
+        # yields (mode, path, sha) depth first like ls-tree -r, reading the
+        # next prefetch subtrees in walk order ahead of it; no more reads than
+        # that are ever started, so one big tree cannot crowd everyone else
+        # out of the executor
+        ahead = collections.deque()
+        started = set()
+
+        def fill():
+            while ahead and len(started) < prefetch:
+                slot = ahead.popleft()
+                slot[1] = asyncio.ensure_future(self.read_object(slot[0]))
+                started.add(slot[1])
+
+        async def load(slot):
+            task = slot[1]
+            if task is None:
+                # not read ahead yet, so it is next in line
+                ahead.popleft()
+                task = self.read_object(slot[0])
+            else:
+                started.discard(task)
+            fill()
+            return await task
+
+        async def walk(prefix, slot):
+            tree = await load(slot)
+            if tree is None:
+                raise Exception(f'Missing tree under {prefix.decode('utf8', 'replace') or '/'}')
+            entries = list(tree.entries())
+            subtrees = dict((i, [binsha.hex(), None]) for i, (mode, _, binsha) in enumerate(entries)
+                            if git_object.tree_mode_is_tree(mode))
+            # they are walked before what is left of the trees above
+            ahead.extendleft(reversed(list(subtrees.values())))
+            fill()
+
+            for i, (mode, name, binsha) in enumerate(entries):
+                yield mode, prefix + name, binsha.hex()
+                if i in subtrees:
+                    async for entry in walk(prefix + name + b'/', subtrees[i]):
+                        yield entry
+
+        root = [sha, None]
+        ahead.append(root)
+        try:
+            async for entry in walk(b'', root):
+                yield entry
+        finally:
+            for task in started:
+                task.cancel()
+
+
+def object_load(repo, sha):
+    obj = git_object.object_read(repo, sha)
+    # tree entries are indexed here so the event loop only iterates them
+    if obj is not None and obj.fmt == b'tree':
+        obj.index()
+    return obj
@@ -0,0 +1,98 @@
+import struct
+
+# git's changed-path filters: each commit's paths changed against its first
+# parent, and every directory above them, set 7 bits each out of 10 per
+# path; version 1 is the one every git reads, though its murmur3
+# sign-extends bytes past 0x7f, which version 2 fixed
+BLOOM_VERSION = 1
+BLOOM_HASHES = 7
+BLOOM_BITS_PER_ENTRY = 10
+BLOOM_MAX_CHANGES = 512
+BLOOM_SEED0 = 0x293ae76f
+BLOOM_SEED1 = 0x7e646e2c
+
+# a filter of one byte with every bit set stands for too many changes
+BLOOM_LARGE = b'\xff'
+BLOOM_HEADER = struct.Struct('>III')
+
+
+def murmur3(seed, data, version=BLOOM_VERSION):
+    c1 = 0xcc9e2d51
+    c2 = 0x1b873593
+    h = seed
+    n = len(data)
+    if version == 1 and any(b & 0x80 for b in data):
+        words = [b | 0xffffff00 if b & 0x80 else b for b in data]
+    else:
+        words = data
+
+    tail = n & ~3
+    for i in range(0, tail, 4):
+        k = (words[i] | (words[i + 1] << 8) | (words[i + 2] << 16) | (words[i + 3] << 24)) & 0xffffffff
+        k = (k * c1) & 0xffffffff
+        k = ((k << 15) | (k >> 17)) & 0xffffffff
+        k = (k * c2) & 0xffffffff
+        h ^= k
+        h = ((h << 13) | (h >> 19)) & 0xffffffff
+        h = (h * 5 + 0xe6546b64) & 0xffffffff
+
+    if n & 3:
+        k = 0
+        for i in range(n - 1, tail - 1, -1):
+            k ^= words[i] << (8 * (i - tail))
+        k &= 0xffffffff
+        k = (k * c1) & 0xffffffff
+        k = ((k << 15) | (k >> 17)) & 0xffffffff
+        k = (k * c2) & 0xffffffff
+        h ^= k
+
+    h ^= n
+    h ^= h >> 16
+    h = (h * 0x85ebca6b) & 0xffffffff
+    h ^= h >> 13
+    h = (h * 0xc2b2ae35) & 0xffffffff
+    h ^= h >> 16
+    return h
+
+def bloom_key(path, version=BLOOM_VERSION, hashes=BLOOM_HASHES):
+    h0 = murmur3(BLOOM_SEED0, path, version)
+    h1 = murmur3(BLOOM_SEED1, path, version)
+    return [(h0 + i * h1) & 0xffffffff for i in range(hashes)]
+
+def bloom_paths(changed):
+    # the changed paths with all the directories above them
+    paths = set()
+    for path in changed:
+        while path and path not in paths:
+            paths.add(path)
+            path = path.rpartition(b'/')[0]
+    return paths
+
+def bloom_filter(changed, version=BLOOM_VERSION):
+    if len(changed) > BLOOM_MAX_CHANGES:
+        return BLOOM_LARGE
+    paths = bloom_paths(changed)
+    if len(paths) > BLOOM_MAX_CHANGES:
+        return BLOOM_LARGE
+
+    size = max(1, (len(paths) * BLOOM_BITS_PER_ENTRY + 7) // 8)
+    bits = bytearray(size)
+    for path in paths:
+        for h in bloom_key(path, version):
+            bit = h % (size * 8)
+            bits[bit >> 3] |= 1 << (bit & 7)
+    return bytes(bits)
+
+def bloom_contains(data, key):
+    # False when the path was surely not changed, True when it may have been
+    size = len(data) * 8
+    for h in key:
+        bit = h % size
+        if not data[bit >> 3] & (1 << (bit & 7)):
+            return False
+    return True
+
+def bloom_pathspec_keys(path, version=BLOOM_VERSION, hashes=BLOOM_HASHES):
+    # a change to path is also a change to each directory above it, so a
+    # filter must hold all of their keys
+    return [bloom_key(p, version, hashes) for p in bloom_paths([path])]
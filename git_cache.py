@@ -0,0 +1,115 @@
+import collections
+import threading
+
+
+class LRUCache(object):
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+
+            if size > self.max_bytes:
+                return
+
+            self.entries[key] = (value, size)
+            self.size += size
+
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= evicted
+                self.evictions += 1
+
+    def discard(self, key):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        return {
+            'entries'   : len(self.entries),
+            'bytes'     : self.size,
+            'max_bytes' : self.max_bytes,
+            'hits'      : self.hits,
+            'misses'    : self.misses,
+            'evictions' : self.evictions,
+        }
+
+
+class ObjectCache(object):
+
+    def __init__(self, max_bytes, blob_max_bytes, blob_max_object):
+        self.objects = LRUCache(max_bytes)
+        self.blobs = LRUCache(blob_max_bytes)
+        self.blob_max_object = blob_max_object
+        self.hits = 0
+        self.misses = 0
+        self.skipped = 0
+
+    def __contains__(self, sha):
+        return sha in self.objects or sha in self.blobs
+
+    def get(self, sha):
+        for lru in (self.objects, self.blobs):
+            if sha in lru:
+                self.hits += 1
+                return lru.get(sha)
+        self.misses += 1
+        return None
+
+    def put(self, sha, obj, size):
+        if obj.fmt != b'blob':
+            self.objects.put(sha, obj, size)
+        elif size <= self.blob_max_object:
+            self.blobs.put(sha, obj, size)
+        else:
+            self.skipped += 1
+
+    def discard(self, sha):
+        self.objects.discard(sha)
+        self.blobs.discard(sha)
+
+    def clear(self):
+        self.objects.clear()
+        self.blobs.clear()
+
+    def stats(self):
+        return {
+            'hits'    : self.hits,
+            'misses'  : self.misses,
+            'skipped' : self.skipped,
+            'objects' : self.objects.stats(),
+            'blobs'   : self.blobs.stats(),
+        }
@@ -0,0 +1,246 @@
+import os
+import stat
+
+from git_repository import repo_path, file_stamp
+import git_diff
+import git_index
+import git_object
+import git_sparse
+import git_status
+import git_trace
+
+MODE_GITLINK = 0o160000
+MODE_TREE = 0o040000
+
+
+def blob_checkout(repo, mode, sha, dest):
+    fmt, _, chunks = git_object.object_stream(repo, sha)
+    if fmt != b'blob':
+        raise Exception(f'Expected blob {sha}, got {fmt.decode('ascii')}')
+
+    if mode == b'120000':
+        os.symlink(b''.join(chunks), dest)
+        return
+
+    perms = 0o777 if mode == b'100755' else 0o666
+    fd = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, perms)
+    with open(fd, 'wb') as f:
+        for chunk in chunks:
+            f.write(chunk)
+
+def checkout_switch(repo, tree, jobs=1):
+    # moves the worktree and index from the HEAD tree to tree, touching only
+    # the paths that differ; subtrees with the same sha are never read, and
+    # neither are those outside the sparse cone
+    index = checkout_index_read(repo)
+    head = git_status.status_head_tree(repo)
+    sparse = git_sparse.sparse_load(repo)
+    with git_trace.region('checkout.diff'):
+        changes = list(git_diff.diff_trees(repo, bytes.fromhex(head) if head else None, bytes.fromhex(tree),
+                                           sparse=sparse))
+    return checkout_changes(repo, index, changes, jobs)
+
+def checkout_reapply(repo, jobs=1):
+    # brings the worktree and index in line with the sparse cone: files that
+    # left it are removed and their directories collapse into single index
+    # entries, directories that joined it are expanded and written out
+    index = checkout_index_read(repo)
+    result = git_status.GitStatus()
+    git_status.status_staged(repo, index, result)
+    if result.staged:
+        raise Exception('Cannot change the sparse checkout with staged changes')
+
+    head = git_status.status_head_tree(repo)
+    if head is None:
+        return 0, 0
+    with git_trace.region('checkout.diff'):
+        wanted = dict((path, (mode, sha)) for _, _, mode, _, sha, path in
+                      git_diff.diff_trees(repo, None, bytes.fromhex(head), sparse=git_sparse.sparse_load(repo)))
+
+    changes = list()
+    for e in index.entries:
+        path = e.raw_name
+        if path not in wanted:
+            changes.append(('D', e.fields[6], 0, e.binsha, None, path))
+        elif e.extended & git_index.FLAG_SKIP_WORKTREE and e.mode_type != MODE_TREE >> 12:
+            changes.append(('M', e.fields[6], e.fields[6], e.binsha, e.binsha, path))
+    tracked = set(e.raw_name for e in index.entries)
+    changes.extend(('A', 0, mode, None, sha, path) for path, (mode, sha) in wanted.items() if path not in tracked)
+    changes.sort(key=lambda c: c[5])
+    return checkout_changes(repo, index, changes, jobs)
+
+def checkout_index_read(repo):
+    index = git_index.index_read(repo)
+    if any(e.flag_stage for e in index.entries):
+        raise Exception('Cannot checkout with unmerged paths in the index')
+    return index
+
+def checkout_changes(repo, index, changes, jobs):
+    root = os.path.join(os.fsencode(repo.worktree), b'')
+    with git_trace.region('checkout.plan'):
+        plan = checkout_plan(repo, index, changes, root)
+
+    with git_trace.region('checkout.write'):
+        entries, removed = checkout_apply(repo, plan, root, jobs)
+
+    if git_trace.enabled:
+        git_trace.count('checkout.written', len(entries))
+        git_trace.count('checkout.removed', len(removed))
+
+    if not entries and not removed:
+        return 0, 0
+
+    keep = [e for e in index.entries if e.raw_name not in removed and e.raw_name not in entries]
+    keep.extend(entries.values())
+    keep.sort(key=lambda e: e.raw_name)
+    index.entries = keep
+    sparse = any(e.fields[6] == MODE_TREE for e in keep)
+    git_index.index_extension_set(index, git_index.INDEX_EXT_SPARSE, b'' if sparse else None)
+    git_index.index_cache_tree_invalidate(index, removed | set(entries))
+    git_index.index_write(repo, index)
+    return len(entries), len(removed - set(entries))
+
+def checkout_plan(repo, index, changes, root):
+    stamp = file_stamp(repo_path(repo, 'index'))
+    racy_ns = stamp[0] if stamp else 0
+    filemode = repo.conf.getboolean('core', 'filemode', fallback=True)
+    tracked = dict((e.raw_name, e) for e in index.entries)
+    dirs = None
+
+    # a path may only change when the index holds the HEAD or the target
+    # side of it and the worktree file matches the index, so nothing that
+    # was not committed is lost
+    conflicts = list()
+    plan = list()
+    for change in changes:
+        status, old_mode, new_mode, old_sha, new_sha, path = change
+        e = tracked.get(path)
+        full = root + path
+        if e is not None:
+            if ((e.fields[6], e.binsha) not in ((old_mode, old_sha), (new_mode, new_sha))
+                    or not worktree_clean(e, full, racy_ns, filemode)):
+                conflicts.append(path)
+                continue
+        elif old_sha is not None and new_sha is not None:
+            conflicts.append(path)
+            continue
+        elif new_sha is not None and new_mode != MODE_TREE and os.path.lexists(full):
+            # an untracked file is in the way, unless it is a directory of
+            # tracked files this checkout removes
+            if dirs is None:
+                dirs = index_dirs(tracked)
+            if not os.path.isdir(full) or os.path.islink(full) or path + b'/' not in dirs:
+                conflicts.append(path)
+                continue
+        plan.append((change, e))
+
+    if conflicts:
+        names = ''.join(f'\n\t{os.fsdecode(p)}' for p in conflicts)
+        raise Exception(f'Your local changes would be overwritten by checkout:{names}')
+    return plan
+
+def index_dirs(names):
+    dirs = set()
+    for name in names:
+        pos = name.find(b'/')
+        while pos >= 0:
+            dirs.add(name[:pos + 1])
+            pos = name.find(b'/', pos + 1)
+    return dirs
+
+def worktree_clean(e, path, racy_ns, filemode):
+    if e.mode_type == MODE_GITLINK >> 12 or e.extended & git_index.FLAG_SKIP_WORKTREE:
+        return True
+    # a file that is gone has nothing in it to lose
+    try:
+        st = os.lstat(path)
+    except (FileNotFoundError, NotADirectoryError):
+        return True
+    if stat.S_ISDIR(st.st_mode):
+        return False
+
+    mode = git_status.stat_mode(st)
+    if mode >> 12 != e.mode_type or (filemode and mode != e.fields[6]):
+        return False
+    if st.st_mtime_ns < racy_ns and git_status.stat_fields(st) == e.fields[0:6] + e.fields[7:10]:
+        return True
+    return git_status.worktree_hash(path, st) == e.sha
+
+def checkout_apply(repo, plan, root, jobs):
+    # removals go first, so a file can take the place of a directory and
+    # the other way around
+    removed = set()
+    for (status, old_mode, new_mode, old_sha, new_sha, path), e in plan:
+        if new_sha is None or status == 'T':
+            removed.add(path)
+            if e is not None and not e.extended & git_index.FLAG_SKIP_WORKTREE:
+                worktree_remove(root, path, old_mode)
+
+    entries = dict()
+    files = list()
+    for (status, old_mode, new_mode, old_sha, new_sha, path), e in plan:
+        if new_sha is None:
+            continue
+        if new_mode == MODE_TREE:
+            # a directory outside the sparse cone is only an index entry
+            entries[path] = git_index.GitIndexEntry((0,) * 6 + (new_mode, 0, 0, 0, new_sha, 0), path,
+                                                    git_index.FLAG_SKIP_WORKTREE)
+            continue
+        full = root + path
+        if os.path.lexists(full):
+            if os.path.isdir(full) and not os.path.islink(full):
+                if new_mode != MODE_GITLINK:
+                    os.rmdir(full)
+            else:
+                os.unlink(full)
+        else:
+            os.makedirs(os.path.dirname(full), exist_ok=True)
+
+        if new_mode == MODE_GITLINK:
+            os.makedirs(full, exist_ok=True)
+            entries[path] = git_index.GitIndexEntry((0,) * 6 + (new_mode, 0, 0, 0, new_sha, 0), path)
+        else:
+            files.append((f'{new_mode:o}'.encode(), new_sha.hex(), full))
+
+    if jobs == 0:
+        jobs = os.cpu_count() or 1
+
+    if jobs == 1 or len(files) < 2:
+        for f in files:
+            blob_checkout(repo, *f)
+    else:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            for _ in pool.map(lambda f: blob_checkout(repo, *f), files):
+                pass
+
+    # the stat data of the written files goes into the index, so the next
+    # status only hashes files written in the same tick as the index
+    for mode, sha, full in files:
+        fields = git_status.stat_fields(os.lstat(full))
+        path = full[len(root):]
+        entries[path] = git_index.GitIndexEntry(fields[0:6] + (int(mode, 8),) + fields[6:9] + (bytes.fromhex(sha), 0), path)
+    return entries, removed
+
+def worktree_remove(root, path, mode):
+    full = root + path
+    try:
+        if mode == MODE_GITLINK:
+            os.rmdir(full)
+        else:
+            os.unlink(full)
+    except (FileNotFoundError, NotADirectoryError):
+        pass
+    except OSError:
+        # a submodule that is still checked out stays where it is
+        if mode != MODE_GITLINK:
+            raise
+
+    # directories left empty go with it
+    parent = os.path.dirname(path)
+    while parent:
+        try:
+            os.rmdir(root + parent)
+        except OSError:
+            break
+        parent = os.path.dirname(parent)
@@ -0,0 +1,316 @@
+import mmap
+import os
+import struct
+
+from git_repository import repo_path, repo_dir, file_stamp
+import git_object
+import git_refs
+
+GRAPH_SIGNATURE = b'CGPH'
+GRAPH_PARENT_NONE = 0x70000000
+GRAPH_EXTRA_EDGES = 0x80000000
+GRAPH_LAST_EDGE = 0x80000000
+GRAPH_GENERATION_MAX = 0x3FFFFFFF
+
+CHUNK_OID_FANOUT = b'OIDF'
+CHUNK_OID_LOOKUP = b'OIDL'
+CHUNK_COMMIT_DATA = b'CDAT'
+CHUNK_EXTRA_EDGES = b'EDGE'
+CHUNK_BLOOM_INDEX = b'BIDX'
+CHUNK_BLOOM_DATA = b'BDAT'
+
+CDAT_WIDTH = 36
+
+COMMIT_HEADERS = (b'tree', b'parent', b'committer', b'author')
+
+
+class GitCommitGraph(object):
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        data = self.data
+        if data[0:4] != GRAPH_SIGNATURE:
+            raise Exception(f'Bad commit-graph signature {path}')
+        if data[4] != 1 or data[5] != 1:
+            raise Exception(f'Unsupported commit-graph version {data[4]}/{data[5]} {path}')
+
+        self.chunks = dict()
+        pos = 8
+        for _ in range(data[6]):
+            chunk_id = data[pos:pos + 4]
+            offset = struct.unpack('>Q', data[pos + 4:pos + 12])[0]
+            self.chunks[chunk_id] = offset
+            pos += 12
+
+        for chunk_id in (CHUNK_OID_FANOUT, CHUNK_OID_LOOKUP, CHUNK_COMMIT_DATA):
+            if chunk_id not in self.chunks:
+                raise Exception(f'Commit-graph {path} lacks chunk {chunk_id.decode('ascii')}')
+
+        start = self.chunks[CHUNK_OID_FANOUT]
+        self.fanout = struct.unpack('>256I', data[start:start + 1024])
+        self.count = self.fanout[255]
+        self.oid_table = self.chunks[CHUNK_OID_LOOKUP]
+        self.commit_table = self.chunks[CHUNK_COMMIT_DATA]
+        self.edge_table = self.chunks.get(CHUNK_EXTRA_EDGES)
+
+        # changed-path filters, when the graph was written with them
+        self.bloom_version = None
+        self.bloom_index = self.chunks.get(CHUNK_BLOOM_INDEX)
+        self.bloom_data = self.chunks.get(CHUNK_BLOOM_DATA)
+        if self.bloom_index is not None and self.bloom_data is not None:
+            import git_bloom
+            version, hashes, bits = git_bloom.BLOOM_HEADER.unpack_from(data, self.bloom_data)
+            if version in (1, 2):
+                self.bloom_version = version
+                self.bloom_hashes = hashes
+                self.bloom_data += git_bloom.BLOOM_HEADER.size
+
+    def close(self):
+        self.data.close()
+
+    def sha_at(self, i):
+        pos = self.oid_table + 20 * i
+        return self.data[pos:pos + 20].hex()
+
+    def find(self, sha):
+        binsha = bytes.fromhex(sha)
+        lo = self.fanout[binsha[0] - 1] if binsha[0] else 0
+        hi = self.fanout[binsha[0]]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            pos = self.oid_table + 20 * mid
+            cur = self.data[pos:pos + 20]
+            if cur < binsha:
+                lo = mid + 1
+            elif cur > binsha:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def commit_at(self, i):
+        pos = self.commit_table + CDAT_WIDTH * i
+        tree = self.data[pos:pos + 20].hex()
+        p1, p2, gen_hi, date_lo = struct.unpack('>IIII', self.data[pos + 20:pos + CDAT_WIDTH])
+
+        parents = list()
+        if p1 != GRAPH_PARENT_NONE:
+            parents.append(p1)
+        if p2 & GRAPH_EXTRA_EDGES:
+            edge = self.edge_table + 4 * (p2 & 0x7fffffff)
+            while True:
+                e = struct.unpack('>I', self.data[edge:edge + 4])[0]
+                parents.append(e & 0x7fffffff)
+                if e & GRAPH_LAST_EDGE:
+                    break
+                edge += 4
+        elif p2 != GRAPH_PARENT_NONE:
+            parents.append(p2)
+
+        generation = gen_hi >> 2
+        date = ((gen_hi & 3) << 32) | date_lo
+        return tree, parents, generation, date
+
+    def lookup(self, sha):
+        i = self.find(sha)
+        if i is None:
+            return None
+        tree, parents, generation, date = self.commit_at(i)
+        return tree, [self.sha_at(p) for p in parents], generation, date
+
+    def bloom_at(self, i):
+        start = struct.unpack_from('>I', self.data, self.bloom_index + 4 * (i - 1))[0] if i else 0
+        end = struct.unpack_from('>I', self.data, self.bloom_index + 4 * i)[0]
+        return self.data[self.bloom_data + start:self.bloom_data + end]
+
+    def bloom(self, sha):
+        if self.bloom_version is None:
+            return None
+        i = self.find(sha)
+        if i is None:
+            return None
+        return self.bloom_at(i)
+
+
+def commit_graph(repo):
+    path = repo_path(repo, 'objects', 'info', 'commit-graph')
+    stamp = file_stamp(path)
+
+    if repo.commit_graph is not None and repo.commit_graph_stamp == stamp:
+        return repo.commit_graph
+
+    if repo.commit_graph is not None:
+        repo.commit_graph.close()
+
+    repo.commit_graph = GitCommitGraph(path) if stamp else None
+    repo.commit_graph_stamp = stamp
+    return repo.commit_graph
+
+def commit_date(kvlm):
+    committer = kvlm.get(b'committer') or kvlm.get(b'author')
+    if not committer:
+        return 0
+    if type(committer) == list:
+        committer = committer[0]
+    return int(committer.rsplit(b' ', 2)[1])
+
+def commit_parents(kvlm):
+    parents = kvlm.get(b'parent', [])
+    if type(parents) != list:
+        parents = [parents]
+    return [p.decode('ascii') for p in parents]
+
+def commit_info(repo, sha):
+    graph = commit_graph(repo)
+    if graph:
+        info = graph.lookup(sha)
+        if info:
+            return info
+
+    commit = git_object.object_read(repo, sha)
+    if commit is None or commit.fmt != b'commit':
+        raise Exception(f'Not a commit {sha}')
+    kvlm = commit.headers(*COMMIT_HEADERS)
+    return kvlm[b'tree'].decode('ascii'), commit_parents(kvlm), None, commit_date(kvlm)
+
+def commit_graph_starts(repo):
+    starts = list()
+    names = [name for name, _ in git_refs.ref_store(repo).iter_prefix('refs/')]
+    for name in ['HEAD'] + names:
+        sha = git_object.ref_resolve(repo, name)
+        while sha:
+            header = git_object.object_header(repo, sha)
+            if not header:
+                break
+            if header[0] == b'commit':
+                starts.append(sha)
+                break
+            if header[0] != b'tag':
+                break
+            sha = git_object.object_read(repo, sha).headers(b'object')[b'object'].decode('ascii')
+    return starts
+
+def commit_graph_write(repo, starts=None, changed_paths=None):
+    if starts is None:
+        starts = commit_graph_starts(repo)
+
+    # filters are kept once written, and those of the old graph reused
+    old = commit_graph(repo)
+    if changed_paths is None:
+        changed_paths = old is not None and old.bloom_version is not None
+
+    commits = dict()
+    stack = list(starts)
+    while stack:
+        sha = stack.pop()
+        if sha in commits:
+            continue
+        commit = git_object.object_read(repo, sha)
+        if commit is None or commit.fmt != b'commit':
+            raise Exception(f'Not a commit {sha}')
+        kvlm = commit.headers(*COMMIT_HEADERS)
+        parents = commit_parents(kvlm)
+        commits[sha] = (kvlm[b'tree'].decode('ascii'), parents, commit_date(kvlm))
+        stack.extend(p for p in parents if p not in commits)
+
+    generation = dict()
+    for sha in commits:
+        stack = [sha]
+        while stack:
+            top = stack[-1]
+            if top in generation:
+                stack.pop()
+                continue
+            pending = [p for p in commits[top][1] if p not in generation]
+            if pending:
+                stack.extend(pending)
+                continue
+            generation[top] = min(GRAPH_GENERATION_MAX, 1 + max((generation[p] for p in commits[top][1]), default=0))
+            stack.pop()
+
+    order = sorted(commits)
+    position = dict((sha, i) for i, sha in enumerate(order))
+
+    fanout = [0] * 256
+    for sha in order:
+        fanout[int(sha[0:2], 16)] += 1
+    total = 0
+    for i in range(256):
+        total += fanout[i]
+        fanout[i] = total
+
+    cdat = list()
+    edges = list()
+    for sha in order:
+        tree, parents, date = commits[sha]
+        p1 = position[parents[0]] if parents else GRAPH_PARENT_NONE
+        if len(parents) <= 1:
+            p2 = GRAPH_PARENT_NONE
+        elif len(parents) == 2:
+            p2 = position[parents[1]]
+        else:
+            p2 = GRAPH_EXTRA_EDGES | len(edges)
+            for p in parents[1:-1]:
+                edges.append(position[p])
+            edges.append(GRAPH_LAST_EDGE | position[parents[-1]])
+        gen_hi = (generation[sha] << 2) | ((date >> 32) & 3)
+        cdat.append(bytes.fromhex(tree) + struct.pack('>IIII', p1, p2, gen_hi, date & 0xffffffff))
+
+    chunks = [
+        (CHUNK_OID_FANOUT, struct.pack('>256I', *fanout)),
+        (CHUNK_OID_LOOKUP, b''.join(bytes.fromhex(sha) for sha in order)),
+        (CHUNK_COMMIT_DATA, b''.join(cdat)),
+    ]
+    if edges:
+        chunks.append((CHUNK_EXTRA_EDGES, struct.pack(f'>{len(edges)}I', *edges)))
+    if changed_paths:
+        chunks.extend(commit_graph_blooms(repo, commits, order, old))
+
+    parts = [GRAPH_SIGNATURE + bytes([1, 1, len(chunks), 0])]
+    offset = 8 + 12 * (len(chunks) + 1)
+    for chunk_id, body in chunks:
+        parts.append(chunk_id + struct.pack('>Q', offset))
+        offset += len(body)
+    parts.append(b'\x00\x00\x00\x00' + struct.pack('>Q', offset))
+    parts.extend(body for _, body in chunks)
+
+    import hashlib
+    content = b''.join(parts)
+    path = os.path.join(repo_dir(repo, 'objects', 'info', mkdir=True), 'commit-graph')
+    lock = path + '.lock'
+    with open(lock, 'xb') as f:
+        f.write(content)
+        f.write(hashlib.sha1(content).digest())
+    os.replace(lock, path)
+
+    return len(order)
+
+def commit_graph_blooms(repo, commits, order, old):
+    import git_bloom
+    import git_diff
+
+    reuse = old is not None and old.bloom_version == git_bloom.BLOOM_VERSION
+    ends = list()
+    filters = list()
+    total = 0
+    for sha in order:
+        data = None
+        if reuse:
+            i = old.find(sha)
+            if i is not None:
+                data = old.bloom_at(i)
+        if data is None:
+            tree, parents, _ = commits[sha]
+            base = bytes.fromhex(commits[parents[0]][0]) if parents else None
+            changed = [change[5] for change in git_diff.diff_trees(repo, base, bytes.fromhex(tree))]
+            data = git_bloom.bloom_filter(changed)
+        filters.append(data)
+        total += len(data)
+        ends.append(total)
+
+    header = git_bloom.BLOOM_HEADER.pack(git_bloom.BLOOM_VERSION, git_bloom.BLOOM_HASHES, git_bloom.BLOOM_BITS_PER_ENTRY)
+    return [(CHUNK_BLOOM_INDEX, struct.pack(f'>{len(ends)}I', *ends)),
+            (CHUNK_BLOOM_DATA, header + b''.join(filters))]
@@ -0,0 +1,417 @@
+import math
+
+import git_object
+import git_sparse
+
+DIFF_CONTEXT = 3
+DIFF_BINARY_PROBE = 8000
+DIFF_FUNCNAME_MAX = 80
+DIFF_MAX_COST_MIN = 256
+
+MODE_TREE = 0o040000
+
+
+def entry_key(mode, name):
+    # the order git sorts tree entries in: a tree sorts as if its name ended in /
+    return name + b'/' if mode == MODE_TREE else name
+
+def tree_entries(repo, binsha):
+    if binsha is None:
+        return []
+    tree = git_object.object_read(repo, binsha.hex())
+    if tree is None or tree.fmt != b'tree':
+        raise Exception(f'Not a tree {binsha.hex()}')
+    return [(int(mode, 8), name, sha) for mode, name, sha in tree.entries()]
+
+def diff_trees(repo, old, new, recursive=True, trees=False, prefix=b'', sparse=None):
+    # yields (status, old_mode, new_mode, old_sha, new_sha, path), where a
+    # missing side has mode 0 and sha None; subtrees with the same sha on
+    # both sides are never read, and neither are subtrees outside the sparse
+    # cone, which come out whole with a path ending in /
+    if old == new:
+        return
+
+    a = tree_entries(repo, old)
+    b = tree_entries(repo, new)
+    i = j = 0
+    while i < len(a) or j < len(b):
+        if j == len(b):
+            cmp = -1
+        elif i == len(a):
+            cmp = 1
+        else:
+            ka = entry_key(a[i][0], a[i][1])
+            kb = entry_key(b[j][0], b[j][1])
+            cmp = -1 if ka < kb else 1 if ka > kb else 0
+
+        if cmp < 0:
+            yield from diff_side(repo, 'D', a[i], recursive, trees, prefix, sparse)
+            i += 1
+        elif cmp > 0:
+            yield from diff_side(repo, 'A', b[j], recursive, trees, prefix, sparse)
+            j += 1
+        else:
+            old_mode, name, old_sha = a[i]
+            new_mode, _, new_sha = b[j]
+            i += 1
+            j += 1
+            if old_sha == new_sha and old_mode == new_mode:
+                continue
+
+            path = prefix + name
+            if old_mode == MODE_TREE and recursive:
+                inner = git_sparse.sparse_child(sparse, name)
+                if inner is False:
+                    yield 'M', old_mode, new_mode, old_sha, new_sha, path + b'/'
+                    continue
+                if trees:
+                    yield 'M', old_mode, new_mode, old_sha, new_sha, path
+                yield from diff_trees(repo, old_sha, new_sha, recursive, trees, path + b'/', inner)
+            elif old_mode >> 12 != new_mode >> 12:
+                yield 'T', old_mode, new_mode, old_sha, new_sha, path
+            else:
+                yield 'M', old_mode, new_mode, old_sha, new_sha, path
+
+def diff_side(repo, status, entry, recursive, trees, prefix, sparse=None):
+    mode, name, sha = entry
+    path = prefix + name
+    inner = git_sparse.sparse_child(sparse, name)
+    if mode == MODE_TREE and recursive and inner is False:
+        path += b'/'
+        recursive = False
+    if mode != MODE_TREE or not recursive or trees:
+        if status == 'A':
+            yield status, 0, mode, None, sha, path
+        else:
+            yield status, mode, 0, sha, None, path
+    if mode == MODE_TREE and recursive:
+        if status == 'A':
+            yield from diff_trees(repo, None, sha, recursive, trees, path + b'/', inner)
+        else:
+            yield from diff_trees(repo, sha, None, recursive, trees, path + b'/', inner)
+
+def myers_snake(a, alo, ahi, b, blo, bhi, max_cost):
+    # the middle snake of Myers' linear space refinement: runs the forward
+    # and reverse searches until they overlap, returning the edit distance
+    # and the snake in absolute coordinates. Diagonals that run off the
+    # edit graph are dropped from later rounds
+    n = ahi - alo
+    m = bhi - blo
+    delta = n - m
+    odd = delta & 1
+    limit = (n + m + 1) // 2
+    offset = limit + 1
+    vf = [-1] * (2 * offset + 1)
+    vb = [-1] * (2 * offset + 1)
+    vf[offset + 1] = 0
+    vb[offset + 1] = 0
+    f_start = f_end = b_start = b_end = 0
+
+    for d in range(limit + 1):
+        if d > max_cost:
+            # like git, give up on a minimal script for very different
+            # inputs and split at the furthest forward point instead
+            best = None
+            for k in range(-d + 1 + f_start, d - f_end, 2):
+                x = vf[offset + k]
+                if 0 <= x <= n and x - k <= m and (best is None or 2 * x - k > 2 * best[0] - best[1]):
+                    best = (x, k)
+            if best and 0 < 2 * best[0] - best[1] < n + m:
+                x, k = best
+                return 2 * d, alo + x, blo + x - k, alo + x, blo + x - k
+
+        for k in range(-d + f_start, d + 1 - f_end, 2):
+            i = offset + k
+            if k == -d or (k != d and vf[i - 1] < vf[i + 1]):
+                x = vf[i + 1]
+            else:
+                x = vf[i - 1] + 1
+            y = x - k
+            x0, y0 = x, y
+            while x < n and y < m and a[alo + x] == b[blo + y]:
+                x += 1
+                y += 1
+            vf[i] = x
+            if x > n:
+                f_end += 2
+            elif y > m:
+                f_start += 2
+            elif odd:
+                r = vb[offset + delta - k] if 0 <= offset + delta - k < len(vb) else -1
+                if r != -1 and x + r >= n:
+                    return 2 * d - 1, alo + x0, blo + y0, alo + x, blo + y
+
+        for k in range(-d + b_start, d + 1 - b_end, 2):
+            i = offset + k
+            if k == -d or (k != d and vb[i - 1] < vb[i + 1]):
+                x = vb[i + 1]
+            else:
+                x = vb[i - 1] + 1
+            y = x - k
+            x0, y0 = x, y
+            while x < n and y < m and a[ahi - x - 1] == b[bhi - y - 1]:
+                x += 1
+                y += 1
+            vb[i] = x
+            if x > n:
+                b_end += 2
+            elif y > m:
+                b_start += 2
+            elif not odd:
+                f = vf[offset + delta - k] if 0 <= offset + delta - k < len(vf) else -1
+                if f != -1 and x + f >= n:
+                    return 2 * d, ahi - x, bhi - y, ahi - x0, bhi - y0
+
+    raise Exception('Diff failed to converge')
+
+def myers_matches(a, b):
+    # the (i, j) pairs of equal lines along a shortest edit script
+    max_cost = max(DIFF_MAX_COST_MIN, math.isqrt(len(a) + len(b) + 3))
+    matches = list()
+    stack = [(0, len(a), 0, len(b))]
+    while stack:
+        alo, ahi, blo, bhi = stack.pop()
+        while alo < ahi and blo < bhi and a[alo] == b[blo]:
+            matches.append((alo, blo))
+            alo += 1
+            blo += 1
+        tail = list()
+        while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+            ahi -= 1
+            bhi -= 1
+            tail.append((ahi, bhi))
+        matches.extend(tail)
+        if alo == ahi or blo == bhi:
+            continue
+
+        d, x, y, u, v = myers_snake(a, alo, ahi, b, blo, bhi, max_cost)
+        matches.extend(zip(range(x, u), range(y, v)))
+        stack.append((alo, x, blo, y))
+        stack.append((u, ahi, v, bhi))
+
+    matches.sort()
+    return matches
+
+def diff_lines(a, b):
+    # lines are interned to ints so the search compares small integers, and
+    # lines found on one side only are left out of it: they can never match,
+    # and a rewritten file then costs no more than an append
+    ids = dict()
+    a_ids = [ids.setdefault(line, len(ids)) for line in a]
+    b_ids = [ids.setdefault(line, len(ids)) for line in b]
+    a_set = set(a_ids)
+    b_set = set(b_ids)
+    a_keep = [i for i, x in enumerate(a_ids) if x in b_set]
+    b_keep = [j for j, x in enumerate(b_ids) if x in a_set]
+
+    matches = myers_matches([a_ids[i] for i in a_keep], [b_ids[j] for j in b_keep])
+    return [(a_keep[i], b_keep[j]) for i, j in matches]
+
+def diff_compact(lines, flags, other):
+    # slides each run of changed lines the way git does, so equally short
+    # diffs come out the same: up as far as it goes, merging with earlier
+    # runs, then down, then back up to line up with a change on the other
+    # side if it passed one. flags and other have a zero at both ends
+    g = [1, 1]
+    o = [1, 1]
+    group_extend(flags, g)
+    group_extend(other, o)
+    n = len(lines)
+
+    while True:
+        if g[1] != g[0]:
+            while True:
+                size = g[1] - g[0]
+                matching = -1
+                while g[0] > 1 and lines[g[0] - 2] == lines[g[1] - 2]:
+                    g[0] -= 1
+                    g[1] -= 1
+                    flags[g[0]] = 1
+                    flags[g[1]] = 0
+                    while flags[g[0] - 1]:
+                        g[0] -= 1
+                    group_previous(other, o)
+                earliest = g[1]
+                if o[1] > o[0]:
+                    matching = g[1]
+                while g[1] <= n and lines[g[0] - 1] == lines[g[1] - 1]:
+                    flags[g[0]] = 0
+                    flags[g[1]] = 1
+                    g[0] += 1
+                    g[1] += 1
+                    while flags[g[1]]:
+                        g[1] += 1
+                    group_next(other, o)
+                    if o[1] > o[0]:
+                        matching = g[1]
+                if size == g[1] - g[0]:
+                    break
+
+            if g[1] != earliest and matching != -1:
+                while o[1] == o[0]:
+                    g[0] -= 1
+                    g[1] -= 1
+                    flags[g[0]] = 1
+                    flags[g[1]] = 0
+                    while flags[g[0] - 1]:
+                        g[0] -= 1
+                    group_previous(other, o)
+
+        if g[1] == n + 1:
+            break
+        group_next(flags, g)
+        group_next(other, o)
+
+def group_extend(flags, g):
+    while flags[g[1]]:
+        g[1] += 1
+
+def group_next(flags, g):
+    g[0] = g[1] + 1
+    g[1] = g[0]
+    group_extend(flags, g)
+
+def group_previous(flags, g):
+    g[1] = g[0] - 1
+    g[0] = g[1]
+    while flags[g[0] - 1]:
+        g[0] -= 1
+
+def diff_changes(a, b):
+    # (a_start, a_end, b_start, b_end) for each run of changed lines
+    fa = [0] + [1] * len(a) + [0]
+    fb = [0] + [1] * len(b) + [0]
+    for i, j in diff_lines(a, b):
+        fa[i + 1] = 0
+        fb[j + 1] = 0
+    diff_compact(a, fa, fb)
+    diff_compact(b, fb, fa)
+
+    changes = list()
+    i = j = 1
+    while i <= len(a) or j <= len(b):
+        if fa[i] or fb[j]:
+            ci, cj = i, j
+            while fa[i]:
+                i += 1
+            while fb[j]:
+                j += 1
+            changes.append((ci - 1, i - 1, cj - 1, j - 1))
+        else:
+            i += 1
+            j += 1
+    return changes
+
+def diff_hunks(a, b, context=DIFF_CONTEXT):
+    # yields (a_start, a_end, b_start, b_end, changes): runs of changed lines
+    # with their context, where runs closer than twice the context merge
+    changes = diff_changes(a, b)
+
+    group = list()
+    for change in changes:
+        if group and change[0] - group[-1][1] > 2 * context:
+            yield hunk_make(group, len(a), len(b), context)
+            group = list()
+        group.append(change)
+    if group:
+        yield hunk_make(group, len(a), len(b), context)
+
+def hunk_make(changes, n, m, context):
+    ai, _, bi, _ = changes[0]
+    _, aj, _, bj = changes[-1]
+    before = min(context, ai)
+    after = min(context, n - aj)
+    return ai - before, aj + after, bi - before, bj + after, changes
+
+def hunk_range(start, count):
+    if count == 1:
+        return f'{start + 1}'
+    return f'{start + 1 if count else start},{count}'
+
+def hunk_funcname(a, start):
+    # git's default: the nearest line above the hunk starting with a letter,
+    # an underscore or a dollar sign
+    for i in range(start - 1, -1, -1):
+        line = a[i]
+        if line[:1].isalpha() or line[:1] in (b'_', b'$'):
+            return b' ' + line.rstrip()[:DIFF_FUNCNAME_MAX]
+    return b''
+
+def blob_lines(data):
+    # only \n ends a line; bytes.splitlines would also split on \r
+    lines = [line + b'\n' for line in data.split(b'\n')]
+    last = lines.pop()
+    if last != b'\n':
+        lines.append(last[:-1])
+    return lines
+
+def blob_is_binary(data):
+    return b'\x00' in data[:DIFF_BINARY_PROBE]
+
+def diff_blob(a_data, b_data, a_name, b_name, context=DIFF_CONTEXT):
+    if a_data == b_data:
+        return []
+    if blob_is_binary(a_data) or blob_is_binary(b_data):
+        return [b'Binary files ' + a_name + b' and ' + b_name + b' differ\n']
+
+    a = blob_lines(a_data)
+    b = blob_lines(b_data)
+    out = [b'--- ' + a_name + b'\n', b'+++ ' + b_name + b'\n']
+
+    for ai, aj, bi, bj, changes in diff_hunks(a, b, context):
+        header = f'@@ -{hunk_range(ai, aj - ai)} +{hunk_range(bi, bj - bi)} @@'.encode()
+        out.append(header + hunk_funcname(a, ai) + b'\n')
+
+        i = ai
+        for ci, cj, di, dj in changes:
+            for line in a[i:ci]:
+                diff_line_append(out, b' ', line)
+            for line in a[ci:cj]:
+                diff_line_append(out, b'-', line)
+            for line in b[di:dj]:
+                diff_line_append(out, b'+', line)
+            i = cj
+        for line in a[i:aj]:
+            diff_line_append(out, b' ', line)
+    return out
+
+def diff_line_append(out, sign, line):
+    if line.endswith(b'\n'):
+        out.append(sign + line)
+    else:
+        out.append(sign + line + b'\n\\ No newline at end of file\n')
+
+def diff_patch(repo, change, context=DIFF_CONTEXT):
+    status, old_mode, new_mode, old_sha, new_sha, path = change
+    if status == 'T':
+        # like git, a type change is shown as a deletion and an addition
+        return (diff_patch(repo, ('D', old_mode, 0, old_sha, None, path), context) + 
+                diff_patch(repo, ('A', 0, new_mode, None, new_sha, path), context))
+    
+    out = [b'diff --git a/' + path + b' b/' + path + b'\n']
+    old_hex = old_sha.hex() if old_sha else '0' * 40
+    new_hex = new_sha.hex() if new_sha else '0' * 40
+
+    match status:
+        case 'A':
+            out.append(f'new file mode {new_mode:06o}\n'.encode())
+            out.append(f'index {old_hex[:7]}..{new_hex[:7]}\n'.encode())
+        case 'D':
+            out.append(f'deleted file mode {old_mode:06o}\n'.encode())
+            out.append(f'index {old_hex[:7]}..{new_hex[:7]}\n'.encode())
+        case _ if old_mode != new_mode:
+            out.append(f'old mode {old_mode:06o}\nnew mode {new_mode:06o}\n'.encode())
+            if old_sha != new_sha:
+                out.append(f'index {old_hex[:7]}..{new_hex[:7]}\n'.encode())
+        case _:
+            out.append(f'index {old_hex[:7]}..{new_hex[:7]} {new_mode:06o}\n'.encode())
+
+    if old_sha == new_sha or MODE_TREE in (old_mode, new_mode) or 0o160000 in (old_mode, new_mode):
+        return out
+
+    a_data = git_object.object_read(repo, old_sha.hex()).blobdata if old_sha else b''
+    b_data = git_object.object_read(repo, new_sha.hex()).blobdata if new_sha else b''
+    a_name = b'a/' + path if old_sha else b'/dev/null'
+    b_name = b'b/' + path if new_sha else b'/dev/null'
+    out.extend(diff_blob(a_data, b_data, a_name, b_name, context))
+    return out
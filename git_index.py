@@ -0,0 +1,537 @@
+import gc
+import os
+import struct
+
+from git_repository import repo_file, repo_path
+import git_trace
+
+INDEX_SIGNATURE = b'DIRC'
+INDEX_HEADER = struct.Struct('>4sII')
+INDEX_ENTRY = struct.Struct('>10I20sH')
+INDEX_EXTENDED = struct.Struct('>H')
+INDEX_EXTENSION = struct.Struct('>4sI')
+INDEX_EXT_TREE = b'TREE'
+INDEX_EXT_SPARSE = b'sdir'
+# the extensions kept up to date as entries change; the others, like the
+# untracked and fsmonitor caches, describe the entries as they were read
+# and git would trust them stale, so they are dropped on write
+INDEX_EXT_KEEP = (INDEX_EXT_TREE, INDEX_EXT_SPARSE)
+INDEX_NO_HASH = b'\x00' * 20
+INDEX_SMALL_VARINTS = [bytes([i]) for i in range(0x80)]
+
+FLAG_ASSUME_VALID = 0x8000
+FLAG_EXTENDED = 0x4000
+FLAG_STAGE_SHIFT = 12
+FLAG_STAGE_MASK = 0x3000
+FLAG_NAME_MASK = 0x0FFF
+FLAG_KEEP_MASK = FLAG_ASSUME_VALID | FLAG_STAGE_MASK
+FLAG_SKIP_WORKTREE = 0x4000
+FLAG_INTENT_TO_ADD = 0x2000
+
+
+class GitIndexEntry(object):
+    # fields is the tuple unpacked from the on-disk entry: ctime (s, ns),
+    # mtime (s, ns), dev, ino, mode, uid, gid, size, binary sha and flags
+    __slots__ = ('fields', 'raw_name', 'extended')
+    
+    def __init__(self, fields, raw_name, extended=0):
+        self.fields = fields
+        self.raw_name = raw_name
+        self.extended = extended
+    
+    def field_set(self, i, value):
+        fields = list(self.fields)
+        fields[i] = value
+        self.fields = tuple(fields)
+    
+    def flag_set(self, bit, value):
+        flags = self.fields[11]
+        self.field_set(11, flags | bit if value else flags & ~bit)
+    
+    @property
+    def ctime(self):
+        return self.fields[0], self.fields[1]
+    
+    @ctime.setter
+    def ctime(self, value):
+        self.fields = tuple(value) + self.fields[2:]
+    
+    @property
+    def mtime(self):
+        return self.fields[2], self.fields[3]
+    
+    @mtime.setter
+    def mtime(self, value):
+        self.fields = self.fields[:2] + tuple(value) + self.fields[4:]
+    
+    @property
+    def dev(self):
+        return self.fields[4]
+    
+    @dev.setter
+    def dev(self, value):
+        self.field_set(4, value)
+    
+    @property
+    def ino(self):
+        return self.fields[5]
+    
+    @ino.setter
+    def ino(self, value):
+        self.field_set(5, value)
+    
+    @property
+    def mode_type(self):
+        return self.fields[6] >> 12
+    
+    @mode_type.setter
+    def mode_type(self, value):
+        self.field_set(6, (value << 12) | (self.fields[6] & 0o7777))
+    
+    @property
+    def mode_perms(self):
+        return self.fields[6] & 0o777
+    
+    @mode_perms.setter
+    def mode_perms(self, value):
+        self.field_set(6, (self.fields[6] & ~0o777) | value)
+    
+    @property
+    def uid(self):
+        return self.fields[7]
+    
+    @uid.setter
+    def uid(self, value):
+        self.field_set(7, value)
+    
+    @property
+    def gid(self):
+        return self.fields[8]
+    
+    @gid.setter
+    def gid(self, value):
+        self.field_set(8, value)
+    
+    @property
+    def fsize(self):
+        return self.fields[9]
+    
+    @fsize.setter
+    def fsize(self, value):
+        self.field_set(9, value)
+    
+    @property
+    def binsha(self):
+        return self.fields[10]
+    
+    @property
+    def sha(self):
+        return self.fields[10].hex()
+    
+    @sha.setter
+    def sha(self, value):
+        self.field_set(10, bytes.fromhex(value))
+    
+    @property
+    def flag_assume_valid(self):
+        return bool(self.fields[11] & FLAG_ASSUME_VALID)
+    
+    @flag_assume_valid.setter
+    def flag_assume_valid(self, value):
+        self.flag_set(FLAG_ASSUME_VALID, value)
+    
+    @property
+    def flag_stage(self):
+        return (self.fields[11] >> FLAG_STAGE_SHIFT) & 3
+    
+    @flag_stage.setter
+    def flag_stage(self, value):
+        self.field_set(11, (self.fields[11] & ~FLAG_STAGE_MASK) | (value << FLAG_STAGE_SHIFT))
+    
+    @property
+    def name(self):
+        return self.raw_name.decode('utf8')
+    
+    @name.setter
+    def name(self, value):
+        self.raw_name = value.encode('utf8')
+    
+    @property
+    def flag_skip_worktree(self):
+        return bool(self.extended & FLAG_SKIP_WORKTREE)
+    
+    @flag_skip_worktree.setter
+    def flag_skip_worktree(self, value):
+        self.extended = self.extended | FLAG_SKIP_WORKTREE if value else self.extended & ~FLAG_SKIP_WORKTREE
+    
+    @property
+    def flag_intent_to_add(self):
+        return bool(self.extended & FLAG_INTENT_TO_ADD)
+    
+    @flag_intent_to_add.setter
+    def flag_intent_to_add(self, value):
+        self.extended = self.extended | FLAG_INTENT_TO_ADD if value else self.extended & ~FLAG_INTENT_TO_ADD
+
+def index_entry_make(ctime=(0, 0), mtime=(0, 0), dev=0, ino=0, mode_type=0b1000, 
+                     mode_perms=0o644, uid=0, gid=0, fsize=0, sha=None, 
+                     flag_assume_valid=False, flag_stage=0, name='', 
+                     flag_skip_worktree=False, flag_intent_to_add=False):
+    flags = flag_stage << FLAG_STAGE_SHIFT
+    if flag_assume_valid:
+        flags |= FLAG_ASSUME_VALID
+    
+    extended = 0
+    if flag_skip_worktree:
+        extended |= FLAG_SKIP_WORKTREE
+    if flag_intent_to_add:
+        extended |= FLAG_INTENT_TO_ADD
+    
+    fields = (ctime[0], ctime[1], mtime[0], mtime[1], dev, ino, (mode_type << 12) | mode_perms, 
+              uid, gid, fsize, bytes.fromhex(sha), flags)
+    return GitIndexEntry(fields, name.encode('utf8'), extended)
+
+class GitIndex(object):
+    version = None
+    entries = []
+    extensions = []
+    
+    def __init__(self, version=2, entries=None, extensions=None):
+        if not entries:
+            entries = list()
+        if not extensions:
+            extensions = list()
+        
+        self.version = version
+        self.entries = entries
+        self.extensions = extensions
+
+def index_varint_read(raw, pos):
+    c = raw[pos]
+    pos += 1
+    value = c & 0x7f
+    while c & 0x80:
+        c = raw[pos]
+        pos += 1
+        value = ((value + 1) << 7) | (c & 0x7f)
+    return value, pos
+
+def index_varint_write(value):
+    if value < 0x80:
+        return INDEX_SMALL_VARINTS[value]
+    out = bytearray([value & 0x7f])
+    value >>= 7
+    while value:
+        value -= 1
+        out.append(0x80 | (value & 0x7f))
+        value >>= 7
+    out.reverse()
+    return bytes(out)
+
+def index_parse(raw, verify=True):
+    if len(raw) < INDEX_HEADER.size + 20:
+        raise Exception('Malformed index: too short')
+    
+    # an all-zero trailer is what git writes with index.skipHash
+    import hashlib
+    trailer = raw[-20:]
+    if verify and trailer != INDEX_NO_HASH and hashlib.sha1(memoryview(raw)[:-20]).digest() != trailer:
+        raise Exception('Malformed index: bad checksum')
+    
+    signature, version, count = INDEX_HEADER.unpack_from(raw, 0)
+    if signature != INDEX_SIGNATURE:
+        raise Exception('Malformed index: bad signature')
+    if version not in (2, 3, 4):
+        raise Exception(f'Unsupported index version {version}')
+    
+    entries = list()
+    append = entries.append
+    unpack_entry = INDEX_ENTRY.unpack_from
+    unpack_extended = INDEX_EXTENDED.unpack_from
+    make = GitIndexEntry
+    find = raw.find
+    previous = b''
+    pos = INDEX_HEADER.size
+    
+    # entries hold no reference cycles, and letting the collector run
+    # over hundreds of thousands of fresh objects doubles the load time
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for i in range(count):
+            start = pos
+            fields = unpack_entry(raw, pos)
+            flags = fields[11]
+            pos += 62
+            
+            extended = 0
+            if flags & FLAG_EXTENDED:
+                if version < 3:
+                    raise Exception('Malformed index: extended flags in a version 2 index')
+                extended = unpack_extended(raw, pos)[0]
+                pos += 2
+            
+            if version == 4:
+                strip, pos = index_varint_read(raw, pos)
+                end = find(b'\x00', pos)
+                name = previous[:len(previous) - strip] + raw[pos:end]
+                previous = name
+                pos = end + 1
+            else:
+                name_length = flags & FLAG_NAME_MASK
+                if name_length < FLAG_NAME_MASK:
+                    end = pos + name_length
+                else:
+                    end = find(b'\x00', pos + FLAG_NAME_MASK)
+                name = raw[pos:end]
+                pos = start + ((end - start) // 8 + 1) * 8
+            
+            append(make(fields, name, extended))
+    finally:
+        if gc_enabled:
+            gc.enable()
+    
+    extensions = list()
+    end = len(raw) - 20
+    while pos + INDEX_EXTENSION.size <= end:
+        signature, size = INDEX_EXTENSION.unpack_from(raw, pos)
+        pos += INDEX_EXTENSION.size
+        # sdir marks a sparse index, whose entries include directories
+        # outside the sparse cone; those are read like any other entry
+        if not (0x41 <= signature[0] <= 0x5a) and signature != INDEX_EXT_SPARSE:
+            raise Exception(f'Unsupported required index extension {signature.decode('ascii', 'replace')}')
+        extensions.append((signature, raw[pos:pos + size]))
+        pos += size
+    
+    return GitIndex(version=version, entries=entries, extensions=extensions)
+
+def index_read(repo, verify=True):
+    index_file = repo_file(repo, 'index')
+    
+    if not index_file or not os.path.exists(index_file):
+        return GitIndex()
+    
+    with git_trace.region('index.read'):
+        with open(index_file, 'rb') as f:
+            raw = f.read()
+        
+        index = index_parse(raw, verify=verify)
+    
+    if git_trace.enabled:
+        git_trace.count('index.entries', len(index.entries))
+        git_trace.count('bytes.in', len(raw))
+    return index
+
+def index_serialize(index):
+    entries = sorted(index.entries, key=lambda e: (e.raw_name, e.fields[11] & FLAG_STAGE_MASK))
+    
+    version = index.version
+    if version < 3 and any(e.extended for e in entries):
+        version = 3
+    
+    parts = [INDEX_HEADER.pack(INDEX_SIGNATURE, version, len(entries))]
+    append = parts.append
+    pack_entry = INDEX_ENTRY.pack
+    entry_size = INDEX_ENTRY.size
+    previous = b''
+    
+    for e in entries:
+        name = e.raw_name
+        fields = e.fields
+        extended = e.extended
+        flags = (fields[11] & FLAG_KEEP_MASK) | min(len(name), FLAG_NAME_MASK)
+        if extended:
+            flags |= FLAG_EXTENDED
+        
+        append(pack_entry(fields[0], fields[1], fields[2], fields[3], fields[4], fields[5], 
+                          fields[6], fields[7], fields[8], fields[9], fields[10], flags))
+        length = entry_size
+        if extended:
+            append(INDEX_EXTENDED.pack(extended))
+            length += 2
+        
+        if version == 4:
+            common = 0
+            limit = min(len(name), len(previous))
+            while common < limit:
+                mid = (common + limit + 1) // 2
+                if name[:mid] == previous[:mid]:
+                    common = mid
+                else:
+                    limit = mid - 1
+            append(index_varint_write(len(previous) - common))
+            append(name[common:])
+            append(b'\x00')
+            previous = name
+        else:
+            length += len(name)
+            append(name)
+            append(b'\x00' * (8 - length % 8))
+    
+    for signature, data in index.extensions:
+        if signature not in INDEX_EXT_KEEP:
+            continue
+        append(INDEX_EXTENSION.pack(signature, len(data)))
+        append(data)
+    
+    import hashlib
+    content = b''.join(parts)
+    return content + hashlib.sha1(content).digest()
+
+def index_write(repo, index):
+    path = repo_path(repo, 'index')
+    lock = path + '.lock'
+    
+    with open(lock, 'xb') as f:
+        index_smudge_racy(index, os.fstat(f.fileno()).st_mtime_ns)
+        f.write(index_serialize(index))
+    os.replace(lock, path)
+
+def index_smudge_racy(index, racy_ns):
+    # an entry modified in the same tick the index is written in would look
+    # clean to stat from then on; as git does, its size is zeroed so that
+    # readers compare the content instead
+    for e in index.entries:
+        fields = e.fields
+        if fields[9] and fields[2] * 10 ** 9 + fields[3] >= racy_ns:
+            e.field_set(9, 0)
+
+def index_extension(index, signature):
+    for name, data in index.extensions:
+        if name == signature:
+            return data
+    return None
+
+def index_extension_set(index, signature, data):
+    extensions = [ext for ext in index.extensions if ext[0] != signature]
+    if data is not None:
+        extensions.append((signature, data))
+    index.extensions = extensions
+
+def index_cache_tree(index):
+    data = index_extension(index, INDEX_EXT_TREE)
+    ret = dict()
+    if data is None:
+        return ret
+    
+    # pre-order list of directories, each with its entry count, the number
+    # of subtrees that follow it and the tree sha unless invalidated (-1)
+    pos = 0
+    stack = [(b'', 1)]
+    while pos < len(data):
+        parent, remaining = stack.pop()
+        if remaining > 1:
+            stack.append((parent, remaining - 1))
+        
+        end = data.index(b'\x00', pos)
+        name = data[pos:end]
+        newline = data.index(b'\n', end)
+        count, subtrees = data[end + 1:newline].split(b' ')
+        pos = newline + 1
+        
+        prefix = parent + name + b'/' if name else parent
+        count = int(count)
+        if count >= 0:
+            ret[prefix] = (count, data[pos:pos + 20])
+            pos += 20
+        else:
+            ret[prefix] = (count, None)
+        if int(subtrees):
+            stack.append((prefix, int(subtrees)))
+    
+    return ret
+
+def cache_tree_split(prefix):
+    parent, _, name = prefix[:-1].rpartition(b'/')
+    return parent + b'/' if parent else b'', name
+
+def cache_tree_serialize(nodes):
+    children = dict()
+    for prefix in sorted(nodes):
+        if prefix:
+            children.setdefault(cache_tree_split(prefix)[0], list()).append(prefix)
+    
+    parts = list()
+    stack = [b''] if b'' in nodes else []
+    while stack:
+        prefix = stack.pop()
+        count, binsha = nodes[prefix]
+        subs = children.get(prefix, [])
+        name = cache_tree_split(prefix)[1]
+        parts.append(name + b'\x00' + str(count).encode() + b' ' + str(len(subs)).encode() + b'\n')
+        if binsha is not None:
+            parts.append(binsha)
+        stack.extend(reversed(subs))
+    return b''.join(parts)
+
+def index_cache_tree_invalidate(index, paths):
+    nodes = index_cache_tree(index)
+    if not nodes:
+        return
+    
+    for path in paths:
+        pos = 0
+        while True:
+            prefix = path[:pos]
+            if prefix in nodes:
+                nodes[prefix] = (-1, None)
+            pos = path.find(b'/', pos) + 1
+            if not pos:
+                break
+        inner = path + b'/'
+        for prefix in [p for p in nodes if p.startswith(inner)]:
+            del nodes[prefix]
+    
+    index_extension_set(index, INDEX_EXT_TREE, cache_tree_serialize(nodes))
+
+def index_tree_write(index, write):
+    entries = index.entries
+    cache = index_cache_tree(index)
+    nodes = dict()
+    
+    # entries are sorted by path, so each directory is a contiguous run and
+    # its children come out in tree order; valid cache-tree nodes let whole
+    # runs be skipped without rebuilding their trees
+    def build(prefix, i):
+        # a sparse directory entry stands for its whole tree
+        if prefix and i < len(entries) and entries[i].raw_name == prefix:
+            binsha = entries[i].binsha
+            nodes[prefix] = (1, binsha)
+            return binsha, i + 1
+        
+        cached = cache.get(prefix)
+        if cached and cached[1] is not None:
+            for sub, node in cache.items():
+                if sub.startswith(prefix):
+                    nodes[sub] = node
+            return cached[1], i + cached[0]
+        
+        start = i
+        parts = list()
+        while i < len(entries):
+            e = entries[i]
+            name = e.raw_name
+            if not name.startswith(prefix):
+                break
+            rest = name[len(prefix):]
+            slash = rest.find(b'/')
+            if slash >= 0:
+                binsha, i = build(prefix + rest[:slash + 1], i)
+                if binsha is not None:
+                    parts.append(b'40000 ' + rest[:slash] + b'\x00' + binsha)
+                continue
+            if e.fields[11] & FLAG_STAGE_MASK:
+                raise Exception(f'Cannot write a tree with unmerged path {e.name}')
+            if not e.extended & FLAG_INTENT_TO_ADD:
+                parts.append(b'%o ' % e.fields[6] + rest + b'\x00' + e.binsha)
+            i += 1
+        
+        if prefix and not parts:
+            return None, i
+        
+        binsha = bytes.fromhex(write(b'tree', b''.join(parts)))
+        nodes[prefix] = (i - start, binsha)
+        return binsha, i
+    
+    binsha, _ = build(b'', 0)
+    index_extension_set(index, INDEX_EXT_TREE, cache_tree_serialize(nodes))
+    return binsha.hex()
@@ -1,10 +1,34 @@
+import array
+import bisect
 import collections
-import hashlib
-from math import ceil
+import functools
 import os
 import re
+import stat
+import time
 import zlib
-from git_repository import repo_file, repo_dir
+
+# hashlib, tempfile and concurrent.futures are imported where they are used:
+# loading them costs more than most read-only commands take to run
+
+from git_cache import ObjectCache
+from git_repository import repo_path, repo_file, repo_dir, repo_config_size
+import git_pack
+import git_refs
+import git_trace
+
+OBJECT_CACHE_LIMIT = 64 * 1024 * 1024
+BLOB_CACHE_LIMIT = 16 * 1024 * 1024
+BLOB_CACHE_MAX_OBJECT = 1024 * 1024
+OBJECT_OVERHEAD = 256
+STREAM_CHUNK = 64 * 1024
+LOOSE_INDEX_RACY_NS = 2 * 10 ** 9
+BIG_FILE_THRESHOLD = 512 * 1024 * 1024
+UNPACK_LIMIT = 100
+LOOSE_FSYNC = {'loose-object', 'objects', 'committed', 'added', 'all'}
+
+HASH_RE = re.compile(r'^[0-9A-Fa-f]{4,40}$')
+KVLM_END_RE = re.compile(rb'\n[^ ]')
 
 class GitObject(object):
     
@@ -23,51 +47,356 @@ class GitObject(object):
     def init(self):
         pass
 
+def object_cache(repo):
+    if repo.object_cache is None:
+        repo.object_cache = ObjectCache(
+            repo_config_size(repo, 'wyag', 'objectCacheLimit', OBJECT_CACHE_LIMIT),
+            repo_config_size(repo, 'wyag', 'blobCacheLimit', BLOB_CACHE_LIMIT),
+            repo_config_size(repo, 'wyag', 'blobCacheMaxObject', BLOB_CACHE_MAX_OBJECT))
+    return repo.object_cache
+
 # maybe move to git repo file
 def object_read(repo, sha):
     
-    path = repo_file(repo, 'objects', sha[0:2], sha[2:])
-    
-    if not os.path.isfile(path):
-        return None
-    
-    with open (path, 'rb') as f:
-        raw = zlib.decompress(f.read())
-        
+    cache = object_cache(repo)
+    obj = cache.get(sha)
+    if obj is not None:
+        if git_trace.enabled:
+            git_trace.count('object.cache.hit')
+        return obj
+    
+    path = repo_path(repo, 'objects', sha[0:2], sha[2:])
+    
+    if os.path.isfile(path):
+        with open (path, 'rb') as f:
+            raw = f.read()
+            if git_trace.enabled:
+                git_trace.count('object.read.loose')
+                git_trace.count('bytes.in', len(raw))
+            raw = zlib.decompress(raw)
+            
         x = raw.find(b' ')
         fmt = raw[0:x]
         
         y = raw.find(b'\x00', x)
         size = int(raw[x:y].decode('ascii'))
         if size != len(raw) - y - 1:
-            raise Exception("Malformed Object {sha}: bad length")
-        
-        match fmt:
-            case b'commit'  : c = GitCommit
-            case b'tree'    : c = GitTree
-            case b'tag'     : c = GitTag
-            case b'blob'    : c = GitBlob
-            case _          : raise Exception('Unknown Type \
-                                              {fmt.decode(\'ascii\')} for object {sha}')
-            
-        return c(raw[y+1:])
+            raise Exception(f'Malformed Object {sha}: bad length')
+        data = raw[y+1:]
+    else:
+        packed = git_pack.pack_read(repo, sha)
+        if not packed:
+            return None
+        fmt, data = packed
+        if git_trace.enabled:
+            git_trace.count('object.read.pack')
+    
+    if git_trace.enabled:
+        git_trace.count('object.cache.miss')
+        git_trace.count(f'object.type.{fmt.decode('ascii')}')
+        git_trace.count('bytes.inflated', len(data))
+    
+    match fmt:
+        case b'commit'  : c = GitCommit
+        case b'tree'    : c = GitTree
+        case b'tag'     : c = GitTag
+        case b'blob'    : c = GitBlob
+        case _          : raise Exception(f'Unknown Type {fmt.decode('ascii')} for object {sha}')
+    
+    obj = c(data)
+    cache.put(sha, obj, len(data) + OBJECT_OVERHEAD)
+    return obj
+
+def loose_open(repo, sha):
+    path = repo_path(repo, 'objects', sha[0:2], sha[2:])
+    
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return None
+    
+    d = zlib.decompressobj()
+    head = b''
+    while b'\x00' not in head:
+        chunk = f.read(512)
+        if not chunk:
+            f.close()
+            raise Exception(f'Malformed Object {sha}: truncated header')
+        head += d.decompress(chunk)
+    
+    y = head.index(b'\x00')
+    x = head.find(b' ', 0, y)
+    fmt = head[0:x]
+    size = int(head[x+1:y].decode('ascii'))
+    
+    return f, d, fmt, size, head[y+1:]
+
+def loose_iter(sha, f, d, size, rest):
+    total = 0
+    try:
+        chunk = rest
+        while True:
+            if chunk:
+                total += len(chunk)
+                yield chunk
+            if d.eof:
+                break
+            data = d.unconsumed_tail or f.read(STREAM_CHUNK)
+            if not data:
+                break
+            chunk = d.decompress(data, STREAM_CHUNK)
+    finally:
+        f.close()
+    
+    if total != size:
+        raise Exception(f'Malformed Object {sha}: bad length')
+
+def object_header(repo, sha):
+    loose = loose_open(repo, sha)
+    if loose:
+        f, _, fmt, size, _ = loose
+        f.close()
+        return fmt, size
+    
+    return git_pack.pack_read_header(repo, sha)
+
+def object_stream(repo, sha):
+    loose = loose_open(repo, sha)
+    if loose:
+        f, d, fmt, size, rest = loose
+        return fmt, size, loose_iter(sha, f, d, size, rest)
+    
+    return git_pack.pack_stream(repo, sha)
 
 def object_write(obj, repo=None):
     data = obj.serialize()
     
-    result = obj.fmt + b' ' + str(len(data)).encode() + b'\x00' + data
+    header = obj.fmt + b' ' + str(len(data)).encode() + b'\x00'
     
-    sha = hashlib.sha1(result).hexdigest()
+    import hashlib
+    h = hashlib.sha1(header)
+    h.update(data)
+    sha = h.hexdigest()
     
-    if repo:
-        path = repo_file(repo, "objects", sha[0:2], sha[2:], mkdir=True)
+    if repo and not os.path.exists(repo_path(repo, 'objects', sha[0:2], sha[2:])):
+        z = zlib.compressobj()
+        loose_write(repo, sha, z.compress(header) + z.compress(data) + z.flush())
+    
+    return sha
+
+def loose_write(repo, sha, zdata):
+    # through a temp file renamed into place, so a crash never leaves a
+    # truncated object under its name
+    import tempfile
+    fd, tmp = tempfile.mkstemp(dir=repo_dir(repo, 'objects', mkdir=True), prefix='tmp_obj_')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(zdata)
+        loose_commit(repo, [(tmp, sha)])
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+def loose_commit(repo, pending):
+    # renames temp files to their objects; with fsync configured, each file
+    # and the directories its name goes into are flushed first, and the
+    # directories holding the new names after
+    durable = loose_fsync_enabled(repo)
+    dirs = set()
+    for tmp, sha in pending:
+        dirs.add(repo_dir(repo, 'objects', sha[0:2], mkdir=True))
+        # temp files are private to their owner; objects are read-only
+        os.chmod(tmp, 0o444)
+        if durable:
+            fsync_path(tmp)
+    if durable:
+        fsync_path(repo_path(repo, 'objects'))
+    
+    for tmp, sha in pending:
+        os.replace(tmp, repo_path(repo, 'objects', sha[0:2], sha[2:]))
+    
+    if durable:
+        for d in dirs:
+            fsync_path(d)
+
+def loose_fsync_enabled(repo):
+    components = set(c.strip() for c in repo.conf.get('core', 'fsync', fallback='').split(','))
+    return bool(components & LOOSE_FSYNC) or repo.conf.getboolean('core', 'fsyncObjectFiles', fallback=False)
+
+def fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def object_write_stream(fmt, size, chunks, repo=None):
+    import hashlib
+    header = fmt + b' ' + str(size).encode() + b'\x00'
+    h = hashlib.sha1(header)
+    total = 0
+    
+    if not repo:
+        for chunk in chunks:
+            h.update(chunk)
+            total += len(chunk)
+        if total != size:
+            raise Exception(f'Object size mismatch: expected {size}, got {total}')
+        return h.hexdigest()
+    
+    import tempfile
+    fd, tmp = tempfile.mkstemp(dir=repo_dir(repo, 'objects', mkdir=True), prefix='tmp_obj_')
+    try:
+        z = zlib.compressobj()
+        with os.fdopen(fd, 'wb') as f:
+            f.write(z.compress(header))
+            for chunk in chunks:
+                h.update(chunk)
+                total += len(chunk)
+                f.write(z.compress(chunk))
+            f.write(z.flush())
+        
+        if total != size:
+            raise Exception(f'Object size mismatch: expected {size}, got {total}')
         
-        if not os.path.exists(path):
-            with open (path, "wb") as f:
-                f.write(zlib.compress(result))
+        sha = h.hexdigest()
+        if os.path.exists(repo_path(repo, 'objects', sha[0:2], sha[2:])):
+            os.unlink(tmp)
+        else:
+            loose_commit(repo, [(tmp, sha)])
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
     
     return sha
 
+def file_chunks(f, size=STREAM_CHUNK):
+    while True:
+        chunk = f.read(size)
+        if not chunk:
+            return
+        yield chunk
+
+class GitLooseBatch(object):
+    
+    def __init__(self, repo):
+        self.repo = repo
+        self.pending = list()
+        self.seen = set()
+    
+    def add(self, sha, zdata):
+        if sha in self.seen or os.path.exists(repo_path(self.repo, 'objects', sha[0:2], sha[2:])):
+            return
+        self.seen.add(sha)
+        
+        import tempfile
+        fd, tmp = tempfile.mkstemp(dir=repo_dir(self.repo, 'objects', mkdir=True), prefix='tmp_obj_')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(zdata)
+        self.pending.append((tmp, sha))
+        
+        if git_trace.enabled:
+            git_trace.count('object.write.loose')
+            git_trace.count('bytes.out', len(zdata))
+    
+    def write(self, fmt, data):
+        import hashlib
+        header = fmt + b' ' + str(len(data)).encode() + b'\x00'
+        h = hashlib.sha1(header)
+        h.update(data)
+        sha = h.hexdigest()
+        if sha not in self.seen:
+            z = zlib.compressobj()
+            self.add(sha, z.compress(header) + z.compress(data) + z.flush())
+        return sha
+    
+    def abort(self):
+        for tmp, _ in self.pending:
+            os.unlink(tmp)
+        self.pending = list()
+    
+    def close(self):
+        if not self.pending:
+            return
+        
+        # the fsyncs wait until the whole batch is written, and nothing is
+        # renamed into place before it is durable
+        loose_commit(self.repo, self.pending)
+        self.pending = list()
+
+def blob_prepare(path, store=None, follow=False):
+    st = os.stat(path) if follow else os.lstat(path)
+    if stat.S_ISLNK(st.st_mode):
+        data = os.fsencode(os.readlink(path))
+    elif st.st_size > BIG_FILE_THRESHOLD:
+        return None, st.st_size, None, st
+    else:
+        with open(path, 'rb') as f:
+            data = f.read()
+    
+    import hashlib
+    header = b'blob ' + str(len(data)).encode() + b'\x00'
+    h = hashlib.sha1(header)
+    h.update(data)
+    
+    if store is None:
+        return h.hexdigest(), len(data), None, st
+    
+    z = zlib.compressobj()
+    if store == 'loose':
+        zdata = z.compress(header) + z.compress(data) + z.flush()
+    else:
+        zdata = z.compress(data) + z.flush()
+    return h.hexdigest(), len(data), zdata, st
+
+def blobs_write(repo, paths, write=True, jobs=0, follow=False):
+    store = None
+    if write:
+        limit = repo.conf.getint('transfer', 'unpackLimit', fallback=UNPACK_LIMIT)
+        store = 'pack' if len(paths) >= limit else 'loose'
+    
+    if jobs == 0:
+        jobs = os.cpu_count() or 1
+    
+    prepare = functools.partial(blob_prepare, store=store, follow=follow)
+    pool = None
+    if jobs > 1 and len(paths) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        pool = ProcessPoolExecutor(max_workers=jobs)
+        results = pool.map(prepare, paths, chunksize=max(1, min(256, len(paths) // (jobs * 8))))
+    else:
+        results = map(prepare, paths)
+    
+    if store == 'pack':
+        writer = git_pack.GitPackWriter(repo)
+    elif store == 'loose':
+        writer = GitLooseBatch(repo)
+    
+    ret = list()
+    try:
+        for path, (sha, size, zdata, st) in zip(paths, results):
+            if sha is None:
+                with open(path, 'rb') as f:
+                    sha = object_write_stream(b'blob', size, file_chunks(f), repo=repo if write else None)
+            elif store == 'pack':
+                writer.add(bytes.fromhex(sha), git_pack.PACK_OBJ_BLOB, size, zdata)
+            elif store == 'loose':
+                writer.add(sha, zdata)
+            ret.append((sha, st))
+    except BaseException:
+        if store:
+            writer.abort()
+        raise
+    finally:
+        if pool:
+            pool.shutdown()
+    
+    if store:
+        writer.close()
+    return ret
+
 def object_find(repo, name, fmt=None, follow=True):
     sha = object_resolve(repo, name)
     
@@ -83,18 +412,22 @@ def object_find(repo, name, fmt=None, follow=True):
         return sha
     
     while True:
-        obj = object_read(repo, sha)
+        header = object_header(repo, sha)
+        if not header:
+            raise Exception(f'Missing object {sha}')
         
-        if obj.fmt == fmt:
+        if header[0] == fmt:
             return sha
         
-        if not follow:
+        if not follow or header[0] not in (b'tag', b'commit'):
             return None
         
+        obj = object_read(repo, sha)
+        
         if obj.fmt == b'tag':
-            sha = obj.kvlm[b'object'].decode('ascii')
+            sha = obj.headers(b'object')[b'object'].decode('ascii')
         elif obj.fmt == b'commit' and fmt == b'tree':
-            sha = obj.kvlm[b'tree'].decode('ascii')
+            sha = obj.headers(b'tree')[b'tree'].decode('ascii')
         else:
             return None
     
@@ -107,86 +440,178 @@ class GitBlob(GitObject):
     def deserialize(self, data):
         self.blobdata = data
         
-class GitCommit(GitObject):
-    fmt = b'commit'
+class GitKvlmObject(GitObject):
+    raw = None
+    parsed = None
     
-    def serialize(self, data):
-        return kvlm_serialize(self.kvlm)
+    def serialize(self):
+        if self.parsed is None:
+            return self.raw
+        return kvlm_serialize(self.parsed)
     
     def deserialize(self, data):
-        self.kvlm = kvlm_parse(data)
+        self.raw = data
+        self.parsed = None
         
     def init(self):
-        self.kvlm = dict()
+        self.parsed = collections.OrderedDict()
+    
+    @property
+    def kvlm(self):
+        if self.parsed is None:
+            self.parsed = kvlm_parse(self.raw)
+        return self.parsed
+    
+    @kvlm.setter
+    def kvlm(self, value):
+        self.parsed = value
+    
+    def headers(self, *keys):
+        if self.parsed is not None:
+            return dict((k, self.parsed[k]) for k in keys if k in self.parsed)
+        return kvlm_parse(self.raw, keys=keys)
 
-def kvlm_parse(raw, start=0, dct=None):
-    if not dct:
-        dct = collections.OrderedDict()
-    
-    space = raw.find(b' ', start)
-    newline = raw.find(b'\n', start)
+class GitCommit(GitKvlmObject):
+    fmt = b'commit'
 
-    if space < 0 or newline < space:
-        assert newline == start
-        dct[None] = raw[start + 1:]
-        return dct
-    
-    key = raw[start:space]
-    end = start
-    while True:
-        end = raw.find(b'\n', end + 1)
-        if raw[end + 1] != ord(' '):
-            break
-    
-    value = raw[space + 1:end].replace(b'\n ', b'\n')
+class GitTag(GitKvlmObject):
+    fmt = b'tag'
+
+def kvlm_parse(raw, start=0, dct=None, keys=None):
+    if dct is None:
+        dct = collections.OrderedDict()
     
-    if key in dct:
-        if type(dct[key] == list):
-            dct[key].append(value)
-        else:
-            dct[key] = [dct[key], value]
+    want_message = keys is None or None in keys
+    if keys is not None:
+        keys = set(k for k in keys if k is not None)
+        missing = len(keys)
+    
+    size = len(raw)
+    pos = start
+    while pos < size:
+        newline = raw.find(b'\n', pos)
+        if newline < 0:
+            newline = size
+        
+        if newline == pos:
+            if want_message:
+                dct[None] = raw[pos + 1:]
+            return dct
+        
+        space = raw.find(b' ', pos, newline)
+        if space < 0:
+            raise Exception('Malformed key-value list: header without value')
+        
+        end = newline
+        if newline + 1 < size and raw[newline + 1] == 0x20:
+            m = KVLM_END_RE.search(raw, newline)
+            if m:
+                end = m.start()
+            else:
+                end = size - 1 if raw.endswith(b'\n') else size
+        
+        key = raw[pos:space]
+        if keys is None or key in keys:
+            value = raw[space + 1:end]
+            if end != newline:
+                value = value.replace(b'\n ', b'\n')
+            
+            if key in dct:
+                if type(dct[key]) == list:
+                    dct[key].append(value)
+                else:
+                    dct[key] = [dct[key], value]
+            else:
+                dct[key] = value
+                if keys is not None:
+                    missing -= 1
+        elif not (missing or want_message):
+            # git writes repeated headers next to each other, so once every
+            # requested key has been seen and another one starts we are done
+            return dct
+        
+        pos = end + 1
     
-    return kvlm_parse(raw, start=end + 1, dct=dct)
+    if want_message:
+        dct[None] = b''
+    return dct
 
 def kvlm_serialize(kvlm):
-    ret = b''
+    parts = list()
     
-    for k in kvlm.keys():
+    for k, val in kvlm.items():
         if k == None:
             continue
         
-        val = kvlm[k]
         if type(val) != list:
             val = [val]
         
         for v in val:
-            ret += k + b' ' + (v.replace(b'\n', b'\n ')) + b'\n'
+            parts.append(k)
+            parts.append(b' ')
+            parts.append(v.replace(b'\n', b'\n '))
+            parts.append(b'\n')
 
-    ret += b'\n' + kvlm[None] + b'\n'
+    parts.append(b'\n')
+    parts.append(kvlm.get(None, b''))
     
-    return ret
+    return b''.join(parts)
 
 class GitTreeLeaf(object):
+    __slots__ = ('mode', 'name', 'binsha')
+    
     def __init__(self, mode, path, sha):
         self.mode = mode
         self.path = path
         self.sha = sha
-        
+    
+    @property
+    def path(self):
+        return self.name.decode('utf8')
+    
+    @path.setter
+    def path(self, value):
+        self.name = value.encode('utf8') if type(value) == str else value
+    
+    @property
+    def sha(self):
+        return self.binsha.hex()
+    
+    @sha.setter
+    def sha(self, value):
+        self.binsha = bytes.fromhex(value) if type(value) == str else value
+
+def tree_mode_is_tree(mode):
+    return mode == b'040000' or mode == b'40000'
+
+def tree_leaf_make(mode, name, binsha):
+    leaf = GitTreeLeaf.__new__(GitTreeLeaf)
+    leaf.mode = mode if len(mode) == 6 else b'0' + mode
+    leaf.name = name
+    leaf.binsha = binsha
+    return leaf
+
+def tree_index(raw):
+    ends = array.array('I')
+    pos = 0
+    size = len(raw)
+    find = raw.find
+    append = ends.append
+    while pos < size:
+        y = find(b'\x00', pos)
+        if y < 0 or y + 21 > size:
+            raise Exception('Malformed tree: truncated entry')
+        append(y)
+        pos = y + 21
+    return ends
+
 def tree_parse_one(raw, start=0):
     x = raw.find(b' ', start)
     assert x-start == 5 or x-start == 6
     
-    mode = raw[start:x]
-    if len(mode) == 5:
-        mode = b' ' + mode
-    
     y = raw.find(b'\x00', x)
-    path = raw[x+1:y]
     
-    raw_sha = int.from_bytes(raw[y+1:y+21], 'big')
-    sha = format(raw_sha, '040x')
-    
-    return y + 21, GitTreeLeaf(mode, path.decode('utf8'), sha)
+    return y + 21, tree_leaf_make(raw[start:x], raw[x+1:y], raw[y+1:y+21])
 
 def tree_parse(raw):
     pos = 0
@@ -199,71 +624,179 @@ def tree_parse(raw):
     return ret
 
 def tree_leaf_sort_key(leaf):
-    if leaf.mode.startswith(b'10'):
-        return leaf.path
+    if tree_mode_is_tree(leaf.mode):
+        return leaf.name + b'/'
     else:
-        return leaf.path + '/'
+        return leaf.name
 
 def tree_serialize(obj):
     obj.items.sort(key=tree_leaf_sort_key)
-    ret = b''
+    parts = list()
     for i in obj.items:
-        ret += i.mode
-        ret += b' '
-        ret += i.path.encode('utf8')
-        ret += b'\x00'
-        sha = int(i.sha, 16)
-        ret += sha.to_bytes(20, byteorder='big')
-    return ret    
+        parts.append(i.mode.lstrip(b'0'))
+        parts.append(b' ')
+        parts.append(i.name)
+        parts.append(b'\x00')
+        parts.append(i.binsha)
+    return b''.join(parts)
     
 class GitTree(GitObject):
     fmt = b'tree'
+    raw = b''
+    ends = None
+    leaves = None
     
     def deserialize(self, data):
-        self.items = tree_parse(data)
+        self.raw = data
+        self.ends = None
+        self.leaves = None
     
     def serialize(self):
+        if self.leaves is None:
+            return self.raw
         return tree_serialize(self)
     
     def init(self):
-        self.items = list()
-
-
-class GitTag(GitObject):
-    fmt = b'tag'
+        self.leaves = list()
+    
+    @property
+    def items(self):
+        if self.leaves is None:
+            self.leaves = [tree_leaf_make(*e) for e in self.entries()]
+        return self.leaves
+    
+    @items.setter
+    def items(self, value):
+        self.leaves = value
+    
+    def index(self):
+        if self.ends is None:
+            self.ends = tree_index(self.raw)
+        return self.ends
+    
+    def __len__(self):
+        if self.leaves is not None:
+            return len(self.leaves)
+        return len(self.index())
+    
+    def __iter__(self):
+        if self.leaves is not None:
+            return iter(self.leaves)
+        return (tree_leaf_make(*e) for e in self.entries())
+    
+    def entry(self, i):
+        if self.leaves is not None:
+            leaf = self.leaves[i]
+            return leaf.mode, leaf.name, leaf.binsha
+        
+        raw = self.raw
+        y = self.index()[i]
+        start = self.ends[i - 1] + 21 if i else 0
+        x = raw.find(b' ', start, y)
+        return raw[start:x], raw[x+1:y], raw[y+1:y+21]
+    
+    def entries(self):
+        if self.leaves is not None:
+            for leaf in self.leaves:
+                yield leaf.mode, leaf.name, leaf.binsha
+            return
+        
+        raw = self.raw
+        start = 0
+        for y in self.index():
+            x = raw.find(b' ', start, y)
+            yield raw[start:x], raw[x+1:y], raw[y+1:y+21]
+            start = y + 21
+    
+    def find(self, name):
+        if type(name) == str:
+            name = name.encode('utf8')
+        
+        for key in (name, name + b'/'):
+            lo = 0
+            hi = len(self)
+            while lo < hi:
+                mid = (lo + hi) // 2
+                mode, cur, binsha = self.entry(mid)
+                if tree_mode_is_tree(mode):
+                    cur = cur + b'/'
+                if cur < key:
+                    lo = mid + 1
+                elif cur > key:
+                    hi = mid
+                else:
+                    return tree_leaf_make(mode, name, binsha)
+        return None
 
 def ref_resolve(repo, ref):
-    path = repo_file(repo, ref)
+    return git_refs.ref_store(repo).resolve(ref)
     
-    if not os.path.isfile(path):
-        return None
+def ref_list(repo, prefix='refs/'):
+    return git_refs.ref_nest(git_refs.ref_store(repo).iter_prefix(prefix), prefix)
+
+def loose_list(repo, prefix):
+    path = repo_path(repo, 'objects', prefix)
     
-    with open(path, 'r') as fp:
-        data = fp.read()[:-1]
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return []
     
-    if data.startswith('ref: '):
-        return ref_resolve(repo, data[5:])
-    else:
-        return data
+    if repo.loose_index is None:
+        repo.loose_index = dict()
     
-def ref_list(repo, path=None):
-    if not path:
-        path = repo_dir(repo, 'refs')
+    cached = repo.loose_index.get(prefix)
+    if cached and cached[0] == mtime:
+        return cached[1]
     
-    ret = collections.OrderedDict()
+    names = sorted(f for f in os.listdir(path) if len(f) == 38)
+    if git_trace.enabled:
+        git_trace.count('loose.scan')
     
-    for f in sorted(os.listdir(path)):
-        can = os.path.join(path, f)
-        if os.path.isdir(can):
-            ret[f] = ref_list(repo, can)
-        else:
-            ret[f] = ref_resolve(repo, can)
+    # a directory modified within the timestamp granularity may change again
+    # without its mtime moving, so only trust listings that are old enough
+    if time.time_ns() - mtime > LOOSE_INDEX_RACY_NS:
+        repo.loose_index[prefix] = (mtime, names)
+    
+    return names
+
+def loose_resolve_prefix(repo, name):
+    prefix = name[0:2]
+    rem = name[2:]
+    names = loose_list(repo, prefix)
     
+    ret = list()
+    i = bisect.bisect_left(names, rem)
+    while i < len(names) and names[i].startswith(rem):
+        ret.append(prefix + names[i])
+        i += 1
     return ret
 
+def object_abbrev(repo, sha, min_len=7):
+    length = max(min_len, 4)
+    
+    neighbors = list()
+    names = loose_list(repo, sha[0:2])
+    i = bisect.bisect_left(names, sha[2:])
+    for j in (i - 1, i, i + 1):
+        if 0 <= j < len(names):
+            neighbors.append(sha[0:2] + names[j])
+    
+    for pack in git_pack.pack_list(repo):
+        neighbors.extend(pack.neighbors(bytes.fromhex(sha)))
+    
+    for other in neighbors:
+        if other == sha:
+            continue
+        common = 0
+        while common < 40 and other[common] == sha[common]:
+            common += 1
+        length = max(length, common + 1)
+    
+    return sha[:min(length, 40)]
+
 def object_resolve(repo, name):
     candidates = list()
-    hashRE = re.compile(r'^[0-9A-Fa-f]{4,40}$')
     
     if not name.strip():
         return None
@@ -271,128 +804,22 @@ def object_resolve(repo, name):
     if name == 'HEAD':
         return [ref_resolve(repo, 'HEAD')]
     
-    if hashRE.match(name):
-        name = name.lower()
-        prefix = name[0:2]
-        path = repo_dir(repo, 'objects', prefix, mkdir=False)
-        if path:
-            rem = name[2:]
-            for f in os.listdir(path):
-                if f.startswith(rem):
-                    candidates.append(prefix + f)
-    
-    as_tag = ref_resolve(repo, 'refs/tags/' + name)
+    if HASH_RE.match(name):
+        lower = name.lower()
+        candidates.extend(loose_resolve_prefix(repo, lower))
+        
+        for sha in git_pack.pack_resolve_prefix(repo, lower):
+            if sha not in candidates:
+                candidates.append(sha)
+    
+    refs = git_refs.ref_store(repo)
+    
+    as_tag = refs.resolve('refs/tags/' + name)
     if as_tag:
         candidates.append(as_tag)
     
-    as_branch = ref_resolve(repo, 'refs/heads/' + name)
+    as_branch = refs.resolve('refs/heads/' + name)
     if as_branch:
         candidates.append(as_branch)
         
     return candidates
-
-class GitIndexEntry(object):
-    def __init__(self, ctime=None, mtime=None, dev=None, ino=None, mode_type=None, 
-                 mode_perms=None, uid=None, gid=None, fsize=None, sha=None, 
-                 flag_assume_valid=None, flag_stage=None, name=None):
-        
-        self.ctime = ctime
-        self.mtime = mtime
-        self.dev = dev
-        self.ino = ino
-        self.mode_type = mode_type
-        self.mode_perms = mode_perms
-        self.uid = uid
-        self.gid = gid
-        self.fsize = fsize
-        self.sha = sha
-        self.flag_assume_valid = flag_assume_valid
-        self.flag_stage = flag_stage
-        self.name = name
-
-class GitIndex(object):
-    version = None
-    entres = []
-    
-    def __init__(self, version=2, entries=None):
-        if not entries:
-            entries = list()
-        
-        self.version = version
-        self.entries = entries
-
-def index_read(repo):
-    index_file = repo_file(repo, 'index')
-    
-    if not os.path.exists(index_file):
-        return GitIndex()
-    
-    with open(index_file, 'rb') as f:
-        raw = f.read()
-    
-    header = raw[:12]
-    signature = header[:4]
-    assert signature == b'DIRC'
-    version = int.from_bytes(header[4:8], 'big')
-    assert version == 2, 'wyag only supports index file version 2'
-    count = int.from_bytes(header[8:12], 'big')
-    
-    entries = list()
-    
-    content = raw[12:]
-    idx = 0
-    for i in range(0, count):
-        ctime_s = int.from_bytes(content[idx:idx+4], 'big')
-        ctime_ns = int.from_bytes(content[idx+4:idx+8], 'big')
-        mtime_s = int.from_bytes(content[idx+8:idx+12], 'big')
-        mtime_ns = int.from_bytes(content[idx+12:idx+16], 'big')
-        dev = int.from_bytes(content[idx+16:idx+20], 'big')
-        ino = int.from_bytes(content[idx+20:idx+24], 'big')
-        unused = int.from_bytes(content[idx+24:idx+26], 'big')
-        assert 0 == unused
-        mode = int.from_bytes(content[idx+26:idx+28], 'big')
-        mode_type = mode >> 12
-        assert mode_type in [0b1000, 0b1010, 0b1110]
-        mode_perms = mode & 0b0000000111111111
-        uid = int.from_bytes(content[idx+28:idx+32], 'big')
-        gid = int.from_bytes(content[idx+32:idx+36], 'big')
-        fsize = int.from_bytes(content[idx+36:idx+40], 'big')
-        sha = format(int.from_bytes(content[idx+40:idx+60], 'big'), '040x')
-        flags = int.from_bytes(content[idx+60:idx+62], 'big')
-        flag_assume_valid = (flags & 0b1000000000000000) != 0
-        flag_extended = (flags & 0b0100000000000000) != 0
-        assert not flag_extended
-        flag_stage =  flags & 0b0011000000000000
-        name_length = flags & 0b0000111111111111
-        
-        idx += 62
-        
-        if name_length < 0xFFF:
-            assert content[idx + name_length] == 0x00
-            raw_name = content[idx:idx + name_length]
-            idx += name_length + 1
-        else:
-            print('Notice: Name is 0x{:X} bytes long'.format(name_length))
-            null_idx = content.find(b'\x00', idx + 0xFFF)
-            raw_name = content[idx:null_idx]
-            idx = null_idx + 1
-        
-        name = raw_name.decode('utf8')
-        
-        idx = 8 * ceil(idx/8)
-        
-        entries.append(GitIndexEntry(ctime=(ctime_s, ctime_ns), 
-                                     mtime=(mtime_s, mtime_ns), 
-                                     dev=dev, 
-                                     ino=ino, 
-                                     mode_type=mode_type, 
-                                     mode_perms=mode_perms, 
-                                     uid=uid, 
-                                     gid=gid, 
-                                     fsize=fsize, 
-                                     sha=sha, 
-                                     flag_assume_valid=flag_assume_valid, 
-                                     flag_stage=flag_stage, 
-                                     name=name))
-    
-    return GitIndex(version=version, entries=entries)
\ No newline at end of file
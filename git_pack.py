@@ -0,0 +1,666 @@
+import mmap
+import os
+import re
+import struct
+import zlib
+
+from git_cache import LRUCache
+from git_repository import repo_dir, repo_config_size
+import git_trace
+
+PACK_OBJ_COMMIT = 1
+PACK_OBJ_TREE = 2
+PACK_OBJ_BLOB = 3
+PACK_OBJ_TAG = 4
+PACK_OBJ_OFS_DELTA = 6
+PACK_OBJ_REF_DELTA = 7
+
+PACK_TYPE_NUMBERS = {
+    b'commit' : PACK_OBJ_COMMIT,
+    b'tree'   : PACK_OBJ_TREE,
+    b'blob'   : PACK_OBJ_BLOB,
+    b'tag'    : PACK_OBJ_TAG,
+}
+
+PACK_TYPES = {
+    PACK_OBJ_COMMIT : b'commit',
+    PACK_OBJ_TREE   : b'tree',
+    PACK_OBJ_BLOB   : b'blob',
+    PACK_OBJ_TAG    : b'tag',
+}
+
+PACK_SIGNATURE = b'PACK'
+IDX_MAGIC = b'\xfftOc'
+INFLATE_CHUNK = 64 * 1024
+DELTA_BASE_CACHE_LIMIT = 96 * 1024 * 1024
+DELTA_COPY_MAX = 0x10000
+DELTA_INSERT_MAX = 0x7f
+DELTA_MIN_MATCH = 8
+
+# deltas are matched in chunks ending at a newline or NUL, which lines up
+# with text lines and tree entries
+DELTA_CHUNK_RE = re.compile(rb'[^\n\x00]*[\n\x00]|[^\n\x00]+')
+
+
+def mmap_file(path):
+    with open(path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class GitPack(object):
+
+    def __init__(self, idx_path):
+        self.idx_path = idx_path
+        self.pack_path = idx_path[:-4] + '.pack'
+        self.idx = mmap_file(idx_path)
+        self.pack = None
+
+        if self.idx[0:4] != IDX_MAGIC:
+            raise Exception(f'Unsupported pack index (v1) {idx_path}')
+        version = struct.unpack('>I', self.idx[4:8])[0]
+        if version != 2:
+            raise Exception(f'Unsupported pack index version {version} {idx_path}')
+
+        self.fanout = struct.unpack('>256I', self.idx[8:8 + 1024])
+        self.count = self.fanout[255]
+        self.sha_table = 8 + 1024
+        self.crc_table = self.sha_table + 20 * self.count
+        self.offset_table = self.crc_table + 4 * self.count
+        self.large_offset_table = self.offset_table + 4 * self.count
+
+    def open_pack(self):
+        if self.pack is None:
+            self.pack = mmap_file(self.pack_path)
+            if self.pack[0:4] != PACK_SIGNATURE:
+                raise Exception(f'Bad pack signature {self.pack_path}')
+        return self.pack
+
+    def close(self):
+        self.idx.close()
+        if self.pack is not None:
+            self.pack.close()
+            self.pack = None
+
+    def sha_at(self, i):
+        pos = self.sha_table + 20 * i
+        return self.idx[pos:pos + 20]
+
+    def bounds(self, first_byte):
+        lo = self.fanout[first_byte - 1] if first_byte else 0
+        return lo, self.fanout[first_byte]
+
+    def find(self, binsha):
+        lo, hi = self.bounds(binsha[0])
+        while lo < hi:
+            mid = (lo + hi) // 2
+            cur = self.sha_at(mid)
+            if cur < binsha:
+                lo = mid + 1
+            elif cur > binsha:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def find_prefix(self, prefix):
+        # prefix is a lowercase hex string of at least two characters
+        if len(prefix) % 2:
+            low = bytes.fromhex(prefix + '0')
+        else:
+            low = bytes.fromhex(prefix)
+
+        lo, hi = self.bounds(low[0])
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.sha_at(mid) < low:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        ret = list()
+        end = self.fanout[low[0]]
+        while lo < end:
+            sha = self.sha_at(lo).hex()
+            if not sha.startswith(prefix):
+                break
+            ret.append(sha)
+            lo += 1
+        return ret
+
+    def neighbors(self, binsha):
+        lo, hi = self.bounds(binsha[0])
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.sha_at(mid) < binsha:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        ret = list()
+        for i in (lo - 1, lo, lo + 1):
+            if 0 <= i < self.count:
+                ret.append(self.sha_at(i).hex())
+        return ret
+
+    def offset_at(self, i):
+        pos = self.offset_table + 4 * i
+        offset = struct.unpack('>I', self.idx[pos:pos + 4])[0]
+        if offset & 0x80000000:
+            pos = self.large_offset_table + 8 * (offset & 0x7fffffff)
+            offset = struct.unpack('>Q', self.idx[pos:pos + 8])[0]
+        return offset
+
+    def entry_header(self, offset):
+        data = self.open_pack()
+        c = data[offset]
+        offset += 1
+        kind = (c >> 4) & 7
+        size = c & 15
+        shift = 4
+        while c & 0x80:
+            c = data[offset]
+            offset += 1
+            size |= (c & 0x7f) << shift
+            shift += 7
+        return kind, size, offset
+
+    def inflate(self, offset, size):
+        data = self.open_pack()
+        d = zlib.decompressobj()
+        out = list()
+        while not d.eof:
+            chunk = data[offset:offset + INFLATE_CHUNK]
+            if not chunk:
+                raise Exception(f'Truncated pack entry in {self.pack_path}')
+            out.append(d.decompress(chunk))
+            offset += len(chunk)
+        raw = b''.join(out)
+        if len(raw) != size:
+            raise Exception(f'Malformed pack entry in {self.pack_path}: bad length')
+        return raw
+
+    def inflate_iter(self, offset, size):
+        data = self.open_pack()
+        d = zlib.decompressobj()
+        total = 0
+        while not d.eof:
+            chunk = data[offset:offset + INFLATE_CHUNK]
+            if not chunk:
+                raise Exception(f'Truncated pack entry in {self.pack_path}')
+            offset += len(chunk)
+            while chunk and not d.eof:
+                out = d.decompress(chunk, INFLATE_CHUNK)
+                chunk = d.unconsumed_tail
+                total += len(out)
+                yield out
+        if total != size:
+            raise Exception(f'Malformed pack entry in {self.pack_path}: bad length')
+
+    def inflate_head(self, offset, length):
+        data = self.open_pack()
+        d = zlib.decompressobj()
+        out = b''
+        while len(out) < length and not d.eof:
+            chunk = data[offset:offset + 512]
+            if not chunk:
+                break
+            offset += len(chunk)
+            out += d.decompress(chunk, length - len(out))
+        return out
+
+    def delta_base(self, kind, offset, pos):
+        data = self.open_pack()
+        if kind == PACK_OBJ_OFS_DELTA:
+            c = data[pos]
+            pos += 1
+            rel = c & 0x7f
+            while c & 0x80:
+                c = data[pos]
+                pos += 1
+                rel = ((rel + 1) << 7) | (c & 0x7f)
+            return offset - rel, None, pos
+        else:
+            return None, data[pos:pos + 20], pos + 20
+
+
+def delta_varint(delta, pos):
+    ret = 0
+    shift = 0
+    while True:
+        c = delta[pos]
+        pos += 1
+        ret |= (c & 0x7f) << shift
+        shift += 7
+        if not c & 0x80:
+            return ret, pos
+
+def delta_apply(base, delta):
+    src_size, pos = delta_varint(delta, 0)
+    if src_size != len(base):
+        raise Exception('Delta base size mismatch')
+    dst_size, pos = delta_varint(delta, pos)
+    
+    src = memoryview(base)
+    out = bytearray()
+    end = len(delta)
+    
+    while pos < end:
+        op = delta[pos]
+        pos += 1
+        if op & 0x80:
+            offset = 0
+            size = 0
+            for i in range(4):
+                if op & (1 << i):
+                    offset |= delta[pos] << (8 * i)
+                    pos += 1
+            for i in range(3):
+                if op & (0x10 << i):
+                    size |= delta[pos] << (8 * i)
+                    pos += 1
+            if size == 0:
+                size = 0x10000
+            out += src[offset:offset + size]
+        elif op:
+            out += delta[pos:pos + op]
+            pos += op
+        else:
+            raise Exception('Invalid delta opcode 0')
+    
+    if len(out) != dst_size:
+        raise Exception('Delta result size mismatch')
+    return bytes(out)
+
+def delta_varint_encode(value):
+    out = bytearray()
+    while value >= 0x80:
+        out.append(0x80 | (value & 0x7f))
+        value >>= 7
+    out.append(value)
+    return out
+
+def delta_index(base):
+    index = dict()
+    for m in DELTA_CHUNK_RE.finditer(base):
+        if m.end() - m.start() >= DELTA_MIN_MATCH:
+            index.setdefault(m.group(), m.start())
+    return index
+
+def delta_copy(out, offset, size):
+    while size:
+        n = min(size, DELTA_COPY_MAX)
+        op = 0x80
+        args = bytearray()
+        for i in range(4):
+            b = (offset >> (8 * i)) & 0xff
+            if b:
+                op |= 1 << i
+                args.append(b)
+        if n != DELTA_COPY_MAX:
+            for i in range(3):
+                b = (n >> (8 * i)) & 0xff
+                if b:
+                    op |= 0x10 << i
+                    args.append(b)
+        out.append(op)
+        out += args
+        offset += n
+        size -= n
+
+def delta_insert(out, data):
+    for i in range(0, len(data), DELTA_INSERT_MAX):
+        piece = data[i:i + DELTA_INSERT_MAX]
+        out.append(len(piece))
+        out += piece
+
+def delta_create(base, target, index=None, max_size=None):
+    if index is None:
+        index = delta_index(base)
+    if max_size is None:
+        max_size = len(target)
+    
+    out = delta_varint_encode(len(base)) + delta_varint_encode(len(target))
+    literal = None
+    copy_offset = copy_size = 0
+    
+    for m in DELTA_CHUNK_RE.finditer(target):
+        chunk = m.group()
+        if copy_size:
+            end = copy_offset + copy_size
+            if base[end:end + len(chunk)] == chunk:
+                copy_size += len(chunk)
+                continue
+        
+        offset = index.get(chunk) if len(chunk) >= DELTA_MIN_MATCH else None
+        if offset is None:
+            if copy_size:
+                delta_copy(out, copy_offset, copy_size)
+                copy_size = 0
+            if literal is None:
+                literal = m.start()
+            continue
+        
+        if copy_size:
+            delta_copy(out, copy_offset, copy_size)
+        elif literal is not None:
+            delta_insert(out, target[literal:m.start()])
+            literal = None
+        copy_offset = offset
+        copy_size = len(chunk)
+        
+        if len(out) > max_size:
+            return None
+    
+    if copy_size:
+        delta_copy(out, copy_offset, copy_size)
+    elif literal is not None:
+        delta_insert(out, target[literal:])
+    
+    if len(out) > max_size:
+        return None
+    return bytes(out)
+
+def delta_cache(repo):
+    if repo.delta_cache is None:
+        limit = repo_config_size(repo, 'core', 'deltaBaseCacheLimit', DELTA_BASE_CACHE_LIMIT)
+        repo.delta_cache = LRUCache(limit)
+    return repo.delta_cache
+
+def pack_unpack(repo, pack, offset):
+    cache = delta_cache(repo)
+    chain = list()
+    cur = offset
+    
+    while True:
+        if chain:
+            base = cache.get((pack.idx_path, cur))
+            if base is not None:
+                break
+        
+        kind, size, pos = pack.entry_header(cur)
+        if kind in PACK_TYPES:
+            base = (PACK_TYPES[kind], pack.inflate(pos, size))
+            if chain:
+                cache.put((pack.idx_path, cur), base, len(base[1]))
+            break
+        
+        if kind != PACK_OBJ_OFS_DELTA and kind != PACK_OBJ_REF_DELTA:
+            raise Exception(f'Unsupported pack entry type {kind} in {pack.pack_path}')
+        
+        base_offset, base_sha, pos = pack.delta_base(kind, cur, pos)
+        chain.append((cur, pos, size))
+        
+        if base_offset is None:
+            i = pack.find(base_sha)
+            if i is None:
+                found = pack_find(repo, base_sha.hex())
+                if not found:
+                    raise Exception(f'Missing delta base {base_sha.hex()} for {pack.pack_path}')
+                other, other_offset = found
+                base = pack_unpack(repo, other, other_offset)
+                break
+            base_offset = pack.offset_at(i)
+        cur = base_offset
+    
+    fmt, data = base
+    if git_trace.enabled:
+        git_trace.count('pack.delta.apply', len(chain))
+    while chain:
+        cur, pos, size = chain.pop()
+        data = delta_apply(data, pack.inflate(pos, size))
+        if chain:
+            cache.put((pack.idx_path, cur), (fmt, data), len(data))
+    
+    return fmt, data
+
+
+def pack_header(repo, pack, offset):
+    kind, size, pos = pack.entry_header(offset)
+    if kind in PACK_TYPES:
+        return PACK_TYPES[kind], size
+    
+    head = pack.inflate_head(pack.delta_base(kind, offset, pos)[2], 20)
+    _, i = delta_varint(head, 0)
+    size, _ = delta_varint(head, i)
+    
+    cache = delta_cache(repo)
+    cur = offset
+    while kind not in PACK_TYPES:
+        if kind != PACK_OBJ_OFS_DELTA and kind != PACK_OBJ_REF_DELTA:
+            raise Exception(f'Unsupported pack entry type {kind} in {pack.pack_path}')
+        base_offset, base_sha, pos = pack.delta_base(kind, cur, pos)
+        if base_offset is None:
+            i = pack.find(base_sha)
+            if i is None:
+                found = pack_find(repo, base_sha.hex())
+                if not found:
+                    raise Exception(f'Missing delta base {base_sha.hex()} for {pack.pack_path}')
+                return pack_header(repo, *found)[0], size
+            base_offset = pack.offset_at(i)
+        cur = base_offset
+        cached = cache.entries.get((pack.idx_path, cur))
+        if cached is not None:
+            return cached[0][0], size
+        kind, _, pos = pack.entry_header(cur)
+    
+    return PACK_TYPES[kind], size
+
+def pack_list(repo):
+    path = repo_dir(repo, 'objects', 'pack')
+    if not path:
+        return []
+
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return []
+
+    if repo.packs is not None and repo.packs_mtime == mtime:
+        return repo.packs
+
+    if git_trace.enabled:
+        git_trace.count('pack.scan')
+    old = dict((p.idx_path, p) for p in repo.packs or [])
+    packs = list()
+    for f in sorted(os.listdir(path)):
+        if not f.endswith('.idx'):
+            continue
+        idx_path = os.path.join(path, f)
+        if idx_path in old:
+            packs.append(old.pop(idx_path))
+        elif os.path.exists(idx_path[:-4] + '.pack'):
+            packs.append(GitPack(idx_path))
+
+    for p in old.values():
+        p.close()
+
+    repo.packs = packs
+    repo.packs_mtime = mtime
+    return packs
+
+def pack_find(repo, sha):
+    binsha = bytes.fromhex(sha)
+
+    for rescan in (False, True):
+        if rescan:
+            before = repo.packs
+            packs = pack_list(repo)
+            if packs is before:
+                return None
+        else:
+            packs = repo.packs if repo.packs is not None else pack_list(repo)
+
+        for pack in packs:
+            i = pack.find(binsha)
+            if i is not None:
+                return pack, pack.offset_at(i)
+
+    return None
+
+def pack_read(repo, sha):
+    found = pack_find(repo, sha)
+    if not found:
+        return None
+    pack, offset = found
+    return pack_unpack(repo, pack, offset)
+
+def pack_resolve_prefix(repo, prefix):
+    ret = list()
+    for pack in pack_list(repo):
+        ret.extend(pack.find_prefix(prefix))
+    return ret
+
+def pack_read_header(repo, sha):
+    found = pack_find(repo, sha)
+    if not found:
+        return None
+    return pack_header(repo, *found)
+
+def pack_stream(repo, sha):
+    found = pack_find(repo, sha)
+    if not found:
+        return None
+    pack, offset = found
+    
+    kind, size, pos = pack.entry_header(offset)
+    if kind in PACK_TYPES:
+        return PACK_TYPES[kind], size, pack.inflate_iter(pos, size)
+    
+    # deltas need their whole base in memory, there is nothing to stream
+    fmt, data = pack_unpack(repo, pack, offset)
+    return fmt, len(data), iter((data,))
+
+
+class GitPackWriter(object):
+
+    def __init__(self, repo):
+        self.repo = repo
+        self.dir = repo_dir(repo, 'objects', 'pack', mkdir=True)
+        import tempfile
+        fd, self.tmp = tempfile.mkstemp(dir=self.dir, prefix='tmp_pack_')
+        self.f = os.fdopen(fd, 'w+b')
+        self.f.write(struct.pack('>4sII', PACK_SIGNATURE, 2, 0))
+        self.offset = 12
+        self.entries = dict()
+
+    def __contains__(self, binsha):
+        return binsha in self.entries
+
+    def add(self, binsha, kind, size, zdata):
+        if binsha in self.entries:
+            return
+        header = pack_entry_header(kind, size)
+        self.entries[binsha] = (self.offset, zlib.crc32(zdata, zlib.crc32(header)))
+        self.f.write(header)
+        self.f.write(zdata)
+        self.offset += len(header) + len(zdata)
+        if git_trace.enabled:
+            git_trace.count('object.write.pack')
+            git_trace.count('bytes.out', len(zdata))
+
+    def add_delta(self, binsha, base, size, zdata):
+        if binsha in self.entries:
+            return
+        rel = self.offset - self.entries[base][0]
+        ofs = bytearray([rel & 0x7f])
+        rel >>= 7
+        while rel:
+            rel -= 1
+            ofs.append(0x80 | (rel & 0x7f))
+            rel >>= 7
+        ofs.reverse()
+        
+        header = pack_entry_header(PACK_OBJ_OFS_DELTA, size) + ofs
+        self.entries[binsha] = (self.offset, zlib.crc32(zdata, zlib.crc32(header)))
+        self.f.write(header)
+        self.f.write(zdata)
+        self.offset += len(header) + len(zdata)
+        if git_trace.enabled:
+            git_trace.count('object.write.pack')
+            git_trace.count('bytes.out', len(zdata))
+
+    def abort(self):
+        self.f.close()
+        os.unlink(self.tmp)
+
+    def close(self):
+        if not self.entries:
+            self.abort()
+            return None
+
+        # the object count is only known now, so the header is patched
+        # and the checksum computed over the finished file
+        f = self.f
+        f.seek(0)
+        f.write(struct.pack('>4sII', PACK_SIGNATURE, 2, len(self.entries)))
+        f.seek(0)
+        import hashlib
+        h = hashlib.sha1()
+        while True:
+            chunk = f.read(INFLATE_CHUNK)
+            if not chunk:
+                break
+            h.update(chunk)
+        pack_sha = h.digest()
+        f.write(pack_sha)
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+
+        name = os.path.join(self.dir, f'pack-{pack_sha.hex()}')
+        pack_idx_write(name + '.idx', self.entries, pack_sha)
+        os.replace(self.tmp, name + '.pack')
+        return pack_sha.hex()
+
+
+def pack_entry_header(kind, size):
+    out = bytearray()
+    c = (kind << 4) | (size & 15)
+    size >>= 4
+    while size:
+        out.append(c | 0x80)
+        c = size & 0x7f
+        size >>= 7
+    out.append(c)
+    return bytes(out)
+
+def pack_idx_write(path, entries, pack_sha):
+    order = sorted(entries)
+
+    fanout = [0] * 256
+    for binsha in order:
+        fanout[binsha[0]] += 1
+    total = 0
+    for i in range(256):
+        total += fanout[i]
+        fanout[i] = total
+
+    offsets = list()
+    large = list()
+    for binsha in order:
+        offset = entries[binsha][0]
+        if offset < 0x80000000:
+            offsets.append(offset)
+        else:
+            offsets.append(0x80000000 | len(large))
+            large.append(offset)
+
+    count = len(order)
+    parts = [
+        IDX_MAGIC,
+        struct.pack('>I', 2),
+        struct.pack('>256I', *fanout),
+        b''.join(order),
+        struct.pack(f'>{count}I', *(entries[binsha][1] for binsha in order)),
+        struct.pack(f'>{count}I', *offsets),
+        struct.pack(f'>{len(large)}Q', *large),
+        pack_sha,
+    ]
+    content = b''.join(parts)
+
+    import hashlib
+    lock = path + '.lock'
+    with open(lock, 'xb') as f:
+        f.write(content)
+        f.write(hashlib.sha1(content).digest())
+    os.replace(lock, path)
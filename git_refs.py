@@ -0,0 +1,201 @@
+import bisect
+import collections
+import os
+
+from git_repository import repo_path, file_stamp
+import git_trace
+
+PACKED_REFS_HEADER = '# pack-refs with: peeled fully-peeled sorted \n'
+
+
+class GitRefStore(object):
+
+    def __init__(self, repo):
+        self.repo = repo
+        self.packed = dict()
+        self.peeled = dict()
+        self.packed_stamp = None
+        self.loose = dict()
+        self.loose_stamps = None
+        self.table = dict()
+        self.names = list()
+
+    def refresh(self):
+        changed = False
+
+        stamp = file_stamp(repo_path(self.repo, 'packed-refs'))
+        if self.loose_stamps is None or stamp != self.packed_stamp:
+            self.packed, self.peeled = packed_refs_read(self.repo)
+            self.packed_stamp = stamp
+            changed = True
+
+        if self.loose_stamps is None or any(file_stamp(d) != s for d, s in self.loose_stamps.items()):
+            if git_trace.enabled:
+                git_trace.count('refs.scan')
+            self.loose = dict()
+            self.loose_stamps = dict()
+            self.scan(repo_path(self.repo, 'refs'), 'refs')
+            changed = True
+
+        if changed:
+            self.table = dict(self.packed)
+            self.table.update(self.loose)
+            self.names = sorted(self.table)
+
+    def scan(self, path, name):
+        self.loose_stamps[path] = file_stamp(path)
+        try:
+            entries = list(os.scandir(path))
+        except FileNotFoundError:
+            return
+
+        for entry in entries:
+            if entry.name.endswith('.lock'):
+                continue
+            if entry.is_dir():
+                self.scan(entry.path, name + '/' + entry.name)
+            else:
+                with open(entry.path, 'r') as fp:
+                    self.loose[name + '/' + entry.name] = fp.read().strip()
+
+    def read(self, name):
+        if not name.startswith('refs/'):
+            try:
+                with open(repo_path(self.repo, name), 'r') as fp:
+                    return fp.read().strip()
+            except (FileNotFoundError, IsADirectoryError):
+                return None
+
+        self.refresh()
+        return self.table.get(name)
+
+    def resolve(self, name):
+        for _ in range(10):
+            value = self.read(name)
+            if value is None or not value.startswith('ref: '):
+                return value
+            name = value[5:]
+        raise Exception(f'Symbolic reference loop at {name}')
+
+    def peel(self, name):
+        self.refresh()
+        if name in self.loose:
+            return None
+        return self.peeled.get(name)
+
+    def iter_prefix(self, prefix):
+        self.refresh()
+        i = bisect.bisect_left(self.names, prefix)
+        while i < len(self.names) and self.names[i].startswith(prefix):
+            name = self.names[i]
+            yield name, self.resolve(name)
+            i += 1
+
+    def invalidate(self):
+        self.loose_stamps = None
+
+
+def ref_store(repo):
+    if repo.refs is None:
+        repo.refs = GitRefStore(repo)
+    return repo.refs
+
+def packed_refs_read(repo):
+    refs = dict()
+    peeled = dict()
+
+    try:
+        fp = open(repo_path(repo, 'packed-refs'), 'r')
+    except FileNotFoundError:
+        return refs, peeled
+
+    if git_trace.enabled:
+        git_trace.count('refs.packed.read')
+    with fp:
+        last = None
+        for line in fp:
+            line = line.rstrip('\n')
+            if not line or line.startswith('#'):
+                continue
+            if line.startswith('^'):
+                if last is None:
+                    raise Exception('Malformed packed-refs: peeled line without a ref')
+                peeled[last] = line[1:]
+                continue
+            sha, last = line.split(' ', 1)
+            refs[last] = sha
+
+    return refs, peeled
+
+def packed_refs_write(repo, refs, peeled):
+    path = repo_path(repo, 'packed-refs')
+    lock = path + '.lock'
+
+    with open(lock, 'x') as fp:
+        fp.write(PACKED_REFS_HEADER)
+        for name in sorted(refs):
+            fp.write(f'{refs[name]} {name}\n')
+            if name in peeled:
+                fp.write(f'^{peeled[name]}\n')
+    os.replace(lock, path)
+
+    ref_store(repo).invalidate()
+
+def ref_write(repo, name, value):
+    path = repo_path(repo, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    lock = path + '.lock'
+
+    with open(lock, 'x') as fp:
+        fp.write(value + '\n')
+    os.replace(lock, path)
+
+    ref_store(repo).invalidate()
+
+def ref_nest(pairs, prefix):
+    ret = collections.OrderedDict()
+    for name, sha in pairs:
+        parts = name[len(prefix):].split('/')
+        node = ret
+        for part in parts[:-1]:
+            node = node.setdefault(part, collections.OrderedDict())
+        node[parts[-1]] = sha
+    return ret
+
+def refs_pack(repo, peel, all_refs=False, prune=True):
+    store = ref_store(repo)
+    store.refresh()
+
+    refs = dict(store.packed)
+    peeled = dict(store.peeled)
+    packed = list()
+
+    for name, value in store.loose.items():
+        if value.startswith('ref: '):
+            continue
+        if not (all_refs or name.startswith('refs/tags/')):
+            continue
+        refs[name] = value
+        peeled.pop(name, None)
+        packed.append(name)
+
+    for name, sha in refs.items():
+        if name not in peeled:
+            target = peel(sha)
+            if target and target != sha:
+                peeled[name] = target
+
+    packed_refs_write(repo, refs, peeled)
+
+    if prune:
+        keep = (repo_path(repo, 'refs'), repo_path(repo, 'refs', 'heads'), repo_path(repo, 'refs', 'tags'))
+        for name in packed:
+            path = repo_path(repo, name)
+            os.unlink(path)
+            parent = os.path.dirname(path)
+            while parent not in keep and not os.listdir(parent):
+                os.rmdir(parent)
+                parent = os.path.dirname(parent)
+        store.invalidate()
+
+    return packed
@@ -0,0 +1,211 @@
+import collections
+import os
+import zlib
+
+from git_repository import repo_path, repo_dir
+import git_commit_graph
+import git_index
+import git_object
+import git_pack
+import git_refs
+import git_trace
+
+REPACK_WINDOW = 10
+REPACK_DEPTH = 50
+DELTA_MIN_SIZE = 64
+
+TYPE_ORDER = {b'commit': 0, b'tag': 1, b'tree': 2, b'blob': 3}
+
+
+def pack_name_hash(name):
+    # only the last sixteen or so characters survive the shifts, so files
+    # with the same name and extension sort next to each other
+    h = 0
+    for c in name:
+        if c in b' \t\n\r\f\v':
+            continue
+        h = (h >> 2) + (c << 24)
+    return h & 0xffffffff
+
+def repack_starts(repo):
+    starts = [sha for _, sha in git_refs.ref_store(repo).iter_prefix('refs/') if sha]
+    head = git_object.ref_resolve(repo, 'HEAD')
+    if head:
+        starts.append(head)
+
+    # staged blobs are not reachable from any ref yet but must survive
+    for e in git_index.index_read(repo).entries:
+        if e.mode_type != 0b1110:
+            starts.append((e.sha, e.raw_name.rsplit(b'/', 1)[-1]))
+    return starts
+
+def repack_enumerate(repo, starts):
+    objects = dict()
+    order = list()
+    stack = [s if type(s) == tuple else (s, b'') for s in reversed(starts)]
+
+    while stack:
+        sha, name = stack.pop()
+        if sha in objects:
+            continue
+        header = git_object.object_header(repo, sha)
+        if header is None:
+            raise Exception(f'Missing object {sha}')
+        fmt, size = header
+        objects[sha] = (fmt, size, name)
+        order.append(sha)
+
+        match fmt:
+            case b'commit':
+                kvlm = git_object.object_read(repo, sha).headers(b'tree', b'parent')
+                stack.extend((p, b'') for p in reversed(git_commit_graph.commit_parents(kvlm)))
+                stack.append((kvlm[b'tree'].decode('ascii'), b''))
+            case b'tree':
+                entries = list(git_object.object_read(repo, sha).entries())
+                for mode, leaf, binsha in reversed(entries):
+                    if mode != b'160000':
+                        stack.append((binsha.hex(), leaf))
+            case b'tag':
+                target = git_object.object_read(repo, sha).headers(b'object')[b'object']
+                stack.append((target.decode('ascii'), b''))
+
+    # commits and tags lead the pack so history walks touch one region
+    order.sort(key=lambda sha: min(TYPE_ORDER[objects[sha][0]], 2))
+    return objects, order
+
+def repack_deltas(repo, objects, writer, window=REPACK_WINDOW, depth=REPACK_DEPTH):
+    # each object is written as soon as its delta is chosen, so only the
+    # raw data of the window is held; a base is always written before the
+    # objects that delta against it
+    deltas = 0
+    candidates = sorted(objects, key=lambda sha: (TYPE_ORDER[objects[sha][0]],
+                                                  pack_name_hash(objects[sha][2]), -objects[sha][1]))
+
+    recent = collections.deque(maxlen=window)
+    last_fmt = None
+    for sha in candidates:
+        fmt, size, _ = objects[sha]
+        if fmt != last_fmt:
+            recent.clear()
+            last_fmt = fmt
+
+        data = git_object.object_read(repo, sha).serialize()
+        best = None
+
+        if DELTA_MIN_SIZE <= size <= git_object.BIG_FILE_THRESHOLD:
+            max_size = size // 2 - 20
+            for candidate in reversed(recent):
+                base_sha, base_data, base_index, base_depth = candidate
+                if base_depth >= depth or len(base_data) < size // 32:
+                    continue
+                if base_index is None:
+                    base_index = candidate[2] = git_pack.delta_index(base_data)
+                delta = git_pack.delta_create(base_data, data, base_index, max_size)
+                if delta is not None:
+                    best = (base_sha, delta, base_depth + 1)
+                    max_size = len(delta) - 1
+
+        if best:
+            base_sha, delta, delta_depth = best
+            writer.add_delta(bytes.fromhex(sha), bytes.fromhex(base_sha), len(delta), zlib.compress(delta))
+            deltas += 1
+        else:
+            delta_depth = 0
+            writer.add(bytes.fromhex(sha), git_pack.PACK_TYPE_NUMBERS[fmt], size, zlib.compress(data))
+
+        if size <= git_object.BIG_FILE_THRESHOLD:
+            recent.append([sha, data, None, delta_depth])
+
+    return deltas
+
+def repack(repo, all_objects=False, delete=False, window=None, depth=None, loosen=False):
+    # with all_objects and delete, the old packs go away; loosen keeps the
+    # objects in them that nothing reaches as loose objects, as git's
+    # repack -A does, instead of dropping them
+    if window is None:
+        window = repo.conf.getint('pack', 'window', fallback=REPACK_WINDOW)
+    if depth is None:
+        depth = repo.conf.getint('pack', 'depth', fallback=REPACK_DEPTH)
+
+    old_packs = list(git_pack.pack_list(repo))
+    with git_trace.region('repack.enumerate'):
+        objects, order = repack_enumerate(repo, repack_starts(repo))
+    if not all_objects:
+        order = [sha for sha in order if os.path.exists(repo_path(repo, 'objects', sha[0:2], sha[2:]))]
+        objects = dict((sha, objects[sha]) for sha in order)
+
+    if not order:
+        return None, 0, 0
+
+    writer = git_pack.GitPackWriter(repo)
+    try:
+        with git_trace.region('repack.deltas'):
+            deltas = repack_deltas(repo, objects, writer, window, depth)
+    except BaseException:
+        writer.abort()
+        raise
+    with git_trace.region('repack.write'):
+        name = writer.close()
+
+    if delete:
+        if all_objects:
+            packs = [p for p in old_packs if not p.idx_path.endswith(f'pack-{name}.idx')]
+            if loosen:
+                with git_trace.region('repack.loosen'):
+                    repack_loosen(repo, packs, objects)
+            repack_remove_packs(repo, packs)
+        prune_packed(repo)
+
+    return name, len(order), deltas
+
+def repack_loosen(repo, packs, objects):
+    # unreachable objects leave the pack as loose objects dated like it, so
+    # a later prune can age them out
+    count = 0
+    for pack in packs:
+        if os.path.exists(pack.idx_path[:-4] + '.keep'):
+            continue
+        mtime = os.stat(pack.pack_path).st_mtime_ns
+        for i in range(pack.count):
+            sha = pack.sha_at(i).hex()
+            path = repo_path(repo, 'objects', sha[0:2], sha[2:])
+            if sha in objects or os.path.exists(path):
+                continue
+            fmt, size, chunks = git_object.object_stream(repo, sha)
+            z = zlib.compressobj()
+            zdata = [z.compress(fmt + b' ' + str(size).encode() + b'\x00')]
+            zdata.extend(z.compress(chunk) for chunk in chunks)
+            zdata.append(z.flush())
+            git_object.loose_write(repo, sha, b''.join(zdata))
+            os.utime(path, ns=(mtime, mtime))
+            count += 1
+    return count
+
+def repack_remove_packs(repo, packs):
+    for pack in packs:
+        base = pack.idx_path[:-4]
+        if os.path.exists(base + '.keep'):
+            continue
+        pack.close()
+        for ext in ('.pack', '.idx', '.rev', '.bitmap'):
+            if os.path.exists(base + ext):
+                os.unlink(base + ext)
+
+    repo.packs = None
+    git_object.object_cache(repo).clear()
+    git_pack.delta_cache(repo).clear()
+
+def prune_packed(repo):
+    objects = repo_dir(repo, 'objects')
+    count = 0
+    for prefix in sorted(os.listdir(objects)):
+        path = os.path.join(objects, prefix)
+        if len(prefix) != 2 or not os.path.isdir(path):
+            continue
+        for f in os.listdir(path):
+            if len(f) == 38 and git_pack.pack_find(repo, prefix + f):
+                os.unlink(os.path.join(path, f))
+                count += 1
+        if not os.listdir(path):
+            os.rmdir(path)
+    return count
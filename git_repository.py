@@ -2,15 +2,28 @@ import configparser
 import os
 
 
+# set to a dict by long-running processes so repo_find hands out the same
+# instance, and its caches, until the config file changes
+repo_cache = None
+
+
 class GitRepository(object):
     
     worktree = None
     gitdir = None
     conf = None
+    packs = None
+    packs_mtime = None
+    delta_cache = None
+    object_cache = None
+    loose_index = None
+    refs = None
+    commit_graph = None
+    commit_graph_stamp = None
     
-    def __init__(self, path, force=False):
+    def __init__(self, path, force=False, gitdir=None):
         self.worktree = path
-        self.gitdir = os.path.join(path, '.git')
+        self.gitdir = gitdir or os.path.join(path, '.git')
         
         if not (force or os.path.isdir(self.gitdir)):
             raise Exception(f'Not a Valid Git Repository {path}')
@@ -28,6 +41,42 @@ class GitRepository(object):
             if vers != 0:
                 raise Exception(f'Unsupported Repository Format Version {vers}')
 
+def file_stamp(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+def repo_config_size(repo, section, option, default):
+    value = repo.conf.get(section, option, fallback=None)
+    
+    if value is None:
+        return default
+    
+    value = value.strip().lower()
+    units = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+    if value and value[-1] in units:
+        return int(value[:-1]) * units[value[-1]]
+    return int(value)
+
+def repo_config_set(repo, values):
+    # values maps (section, option) to a string, or None to unset it
+    for (section, option), value in values.items():
+        if value is None:
+            if repo.conf.has_section(section):
+                repo.conf.remove_option(section, option)
+            continue
+        if not repo.conf.has_section(section):
+            repo.conf.add_section(section)
+        repo.conf.set(section, option, value)
+    
+    path = repo_path(repo, 'config')
+    lock = path + '.lock'
+    with open(lock, 'x') as f:
+        repo.conf.write(f)
+    os.replace(lock, path)
+
 def repo_path(repo, *path):
     return os.path.join(repo.gitdir, *path)
 
@@ -91,16 +140,50 @@ def repo_default_config():
 
 def repo_find(path="", required=True):
     
+    # an explicit GIT_DIR skips discovery; the worktree is then GIT_WORK_TREE
+    # or the current directory
+    gitdir = os.environ.get('GIT_DIR')
+    worktree = os.environ.get('GIT_WORK_TREE')
+    if gitdir:
+        return repo_open(os.path.abspath(worktree or path or '.'), os.path.abspath(gitdir))
+    
     path = os.path.realpath(path)
-    if os.path.isdir(os.path.join(path, ".git")):
-        return GitRepository(path)
+    ceiling = repo_ceiling(path)
+    
+    while True:
+        if os.path.isdir(os.path.join(path, ".git")):
+            return repo_open(os.path.abspath(worktree) if worktree else path, os.path.join(path, ".git"))
+        
+        parent = os.path.dirname(path)
+        if parent == path or (ceiling is not None and len(parent) <= len(ceiling)):
+            break
+        path = parent
+    
+    if required:
+        raise Exception("No git directory")
+    return None
 
-    parent = os.path.realpath(os.path.join(path, ".."))
+def repo_open(worktree, gitdir):
+    if repo_cache is None:
+        return GitRepository(worktree, gitdir=gitdir)
     
-    if parent == path:
-        if required:
-            raise Exception("No git directory")
-        else:
-            return None
+    stamp = file_stamp(os.path.join(gitdir, 'config'))
+    cached = repo_cache.get((worktree, gitdir))
+    if cached and cached[0] == stamp:
+        return cached[1]
     
-    return repo_find(parent, required)
+    repo = GitRepository(worktree, gitdir=gitdir)
+    repo_cache[(worktree, gitdir)] = (stamp, repo)
+    return repo
+
+def repo_ceiling(path):
+    # the deepest GIT_CEILING_DIRECTORIES entry above path; discovery never
+    # looks at it or anything above it
+    ceiling = None
+    for entry in os.environ.get('GIT_CEILING_DIRECTORIES', '').split(os.pathsep):
+        if not os.path.isabs(entry):
+            continue
+        entry = os.path.realpath(entry)
+        if path.startswith(os.path.join(entry, '')) and (ceiling is None or len(entry) > len(ceiling)):
+            ceiling = entry
+    return ceiling
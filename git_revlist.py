@@ -0,0 +1,381 @@
+import collections
+import heapq
+
+import git_bloom
+import git_commit_graph
+import git_object
+import git_trace
+
+REV_UNINTERESTING = 1
+REV_SEEN = 2
+REV_QUEUED = 4
+REV_PARENT1 = 8
+REV_PARENT2 = 16
+REV_STALE = 32
+REV_RESULT = 64
+REV_TREESAME = 128
+REV_BOTTOM = 256
+
+# how many more commits to walk once only excluded ones are queued, when
+# missing generation numbers leave no way to know the excluded side is done
+REV_SLOP = 5
+
+# commits outside the commit-graph are newer than all of those in it
+REV_GENERATION_NONE = git_commit_graph.GRAPH_GENERATION_MAX + 1
+
+
+class GitRevWalk(object):
+
+    def __init__(self, repo, first_parent=False, paths=None):
+        self.repo = repo
+        self.first_parent = first_parent
+        # with paths, only commits that change one of them are output, and
+        # history is simplified as git does: a commit with a parent the
+        # paths are the same in is followed to that parent alone
+        self.paths = paths
+        self.followed = dict()
+        self.bloom_keys = None
+        self.info = dict()
+        self.flags = dict()
+        self.queue = list()
+        self.seq = 0
+        # queued commits not known to be excluded; at zero nothing unseen
+        # can still be output
+        self.interesting = 0
+        # excluded commits still queued, deepest generation first; an
+        # output candidate is final once none of them can reach it
+        self.blockers = list()
+
+    def commit(self, sha):
+        info = self.info.get(sha)
+        if info is None:
+            tree, parents, generation, date = git_commit_graph.commit_info(self.repo, sha)
+            info = self.info[sha] = (parents, REV_GENERATION_NONE if generation is None else generation, date, tree)
+        return info
+
+    def push(self, sha, uninteresting):
+        flags = self.flags.get(sha, 0)
+        if flags & REV_SEEN:
+            if uninteresting and not flags & REV_UNINTERESTING:
+                self.exclude(sha)
+            return
+
+        # marked by an excluded child before being reached
+        uninteresting = uninteresting or bool(flags & REV_UNINTERESTING)
+        generation, date = self.commit(sha)[1:3]
+        self.flags[sha] = flags | REV_SEEN | REV_QUEUED | (REV_UNINTERESTING if uninteresting else 0)
+        heapq.heappush(self.queue, (-date, self.seq, sha))
+        self.seq += 1
+        if uninteresting:
+            self.block(sha, generation)
+        else:
+            self.interesting += 1
+
+    def exclude(self, sha):
+        # a commit turns out to be excluded: so is everything loaded below
+        # it, as in git's mark_parents_uninteresting; one not queued yet
+        # is queued as excluded
+        stack = [sha]
+        while stack:
+            sha = stack.pop()
+            flags = self.flags.get(sha, 0)
+            if flags & REV_UNINTERESTING:
+                continue
+            self.flags[sha] = flags | REV_UNINTERESTING
+            info = self.info.get(sha)
+            if flags & REV_QUEUED:
+                self.interesting -= 1
+                self.block(sha, info[1])
+            if info is not None:
+                stack.extend(info[0])
+
+    def block(self, sha, generation):
+        # an ancestor has a lower generation than all its descendants, but
+        # a commit without one may reach anything, even another without one
+        if generation == REV_GENERATION_NONE:
+            generation += 1
+        heapq.heappush(self.blockers, (-generation, sha))
+
+    def blocking(self):
+        blockers = self.blockers
+        while blockers and not self.flags[blockers[0][1]] & REV_QUEUED:
+            heapq.heappop(blockers)
+        return -blockers[0][0] if blockers else 0
+
+    def final(self, sha):
+        return self.blocking() <= self.info[sha][1]
+
+    def release(self, pending, force=False):
+        while pending:
+            sha = pending[0]
+            if self.flags[sha] & REV_UNINTERESTING:
+                pending.popleft()
+            elif force or self.final(sha):
+                pending.popleft()
+                yield sha
+            else:
+                break
+
+    def walk(self, include, exclude=(), since=None, until=None):
+        # yields the commits reachable from include and not from exclude,
+        # newest commit date first, each as soon as no excluded commit left
+        # in the queue can still reach it
+        for sha in exclude:
+            self.push(sha, True)
+            self.flags[sha] |= REV_BOTTOM
+            # as in git, the parents of excluded tips are known to be
+            # excluded from the start, which decides path simplification
+            for p in self.info[sha][0]:
+                self.exclude(p)
+        for sha in include:
+            self.push(sha, False)
+
+        graph = git_commit_graph.commit_graph(self.repo)
+        if self.paths and graph is not None and graph.bloom_version is not None:
+            self.bloom_keys = [git_bloom.bloom_pathspec_keys(path, graph.bloom_version, graph.bloom_hashes)
+                               for path in self.paths]
+
+        pending = collections.deque()
+        slop = REV_SLOP
+        while self.queue:
+            if not self.interesting:
+                if not pending:
+                    return
+                yield from self.release(pending)
+                if not pending:
+                    return
+                if self.blocking() > REV_GENERATION_NONE:
+                    slop -= 1
+                    if slop < 0:
+                        break
+
+            _, _, sha = heapq.heappop(self.queue)
+            flags = self.flags[sha] & ~REV_QUEUED
+            parents, _, date, _ = self.info[sha]
+            if not flags & REV_UNINTERESTING:
+                self.interesting -= 1
+                # like git, a commit older than since hides its whole history
+                if since is not None and date < since:
+                    flags |= REV_UNINTERESTING
+
+            # as in git, the excluded side follows every parent
+            uninteresting = bool(flags & REV_UNINTERESTING)
+            if not uninteresting and self.first_parent:
+                parents = parents[:1]
+            if not uninteresting and self.paths is not None:
+                parents, shown = self.simplify(sha, parents)
+                self.followed[sha] = parents
+                if not shown:
+                    flags |= REV_TREESAME
+            self.flags[sha] = flags
+
+            for p in parents:
+                self.push(p, uninteresting)
+                # git loads each parent of an excluded commit and marks its
+                # parents at once, so merges above see them as excluded
+                if uninteresting:
+                    for q in self.info[p][0]:
+                        self.exclude(q)
+
+            if not uninteresting and not flags & REV_TREESAME and (until is None or date <= until):
+                pending.append(sha)
+                yield from self.release(pending)
+
+        yield from self.release(pending, force=True)
+
+    def simplify(self, sha, parents):
+        # the parents to follow, and whether the commit changes the paths
+        tree = self.info[sha][3]
+        if not parents:
+            return parents, not all(tree_path_same(self.repo, tree, None, path) for path in self.paths)
+
+        relevant = changed = False
+        for i, p in enumerate(parents):
+            # the excluded tips themselves still count, like git's bottom
+            excluded = self.flags.get(p, 0) & (REV_UNINTERESTING | REV_BOTTOM) == REV_UNINTERESTING
+            if self.treesame(sha, p, i == 0):
+                # an excluded side branch that brought the change along
+                # does not hide the others
+                if not excluded:
+                    return [p], False
+            else:
+                changed = True
+            relevant |= not excluded
+        return parents, relevant or changed
+
+    def treesame(self, sha, parent, first):
+        # the changed-path filters hold the paths changed against the first
+        # parent, so most commits need no tree read to be passed over
+        maybe = False
+        if first and self.bloom_keys is not None:
+            data = git_commit_graph.commit_graph(self.repo).bloom(sha)
+            if data is not None:
+                if not any(all(git_bloom.bloom_contains(data, key) for key in keys) for keys in self.bloom_keys):
+                    if git_trace.enabled:
+                        git_trace.count('bloom.definitely_not')
+                    return True
+                maybe = True
+
+        a = self.info[sha][3]
+        b = self.commit(parent)[3]
+        same = all(tree_path_same(self.repo, a, b, path) for path in self.paths)
+        if maybe and git_trace.enabled:
+            git_trace.count('bloom.false_positive' if same else 'bloom.maybe')
+        return same
+
+    def rewritten(self, sha):
+        # the nearest output commits down each followed parent, for drawing
+        # the simplified history
+        ret = list()
+        for p in self.followed.get(sha, ()):
+            seen = list()
+            while p is not None and self.flags.get(p, 0) & REV_TREESAME:
+                seen.append(p)
+                followed = self.followed[p]
+                p = followed[0] if followed else None
+            # every commit passed over leads to the same one
+            for s in seen:
+                self.followed[s] = [p] if p is not None else []
+            if p is not None and p not in ret:
+                ret.append(p)
+        return ret
+
+
+def tree_path_same(repo, a, b, path):
+    # compares path in two trees, None for none, a component at a time;
+    # once both sides reach the same subtree nothing below it is read
+    parts = path.split(b'/')
+    for i, part in enumerate(parts):
+        if a == b:
+            return True
+        leaves = [git_object.object_read(repo, sha).find(part) if sha else None for sha in (a, b)]
+        if i == len(parts) - 1:
+            x, y = ((leaf.mode, leaf.binsha) if leaf else None for leaf in leaves)
+            return x == y
+        a, b = (leaf.sha if leaf and git_object.tree_mode_is_tree(leaf.mode) else None for leaf in leaves)
+    return True
+
+def rev_list(repo, include, exclude=(), max_count=None, since=None, until=None, first_parent=False, topo=False,
+             paths=None):
+    walk = GitRevWalk(repo, first_parent=first_parent, paths=paths)
+    commits = walk.walk(include, exclude, since, until)
+    if topo:
+        commits = rev_topo_sort(walk, list(commits))
+    for i, sha in enumerate(commits):
+        if max_count is not None and i >= max_count:
+            return
+        yield sha
+
+def rev_topo_sort(walk, commits):
+    # children before parents, following one line of history as far as it
+    # goes before the next, as git's --topo-order does
+    children = dict((sha, 0) for sha in commits)
+    for sha in commits:
+        for p in walk.info[sha][0]:
+            if p in children:
+                children[p] += 1
+
+    ret = list()
+    stack = [sha for sha in reversed(commits) if not children[sha]]
+    while stack:
+        sha = stack.pop()
+        ret.append(sha)
+        for p in walk.info[sha][0]:
+            if p in children:
+                children[p] -= 1
+                if not children[p]:
+                    stack.append(p)
+    return ret
+
+def merge_bases(repo, one, two):
+    # paints down from both sides, deepest generation first; a commit both
+    # sides reach is a candidate, and the walk ends when every queued commit
+    # is below a candidate already
+    if one == two:
+        return [one]
+
+    walk = GitRevWalk(repo)
+    flags = {one: REV_PARENT1, two: REV_PARENT2}
+    queue = list()
+    for seq, sha in enumerate((one, two)):
+        generation, date = walk.commit(sha)[1:3]
+        queue.append((-generation, -date, seq, sha, True))
+    heapq.heapify(queue)
+    seq = len(queue)
+    active = len(queue)
+
+    result = list()
+    while active:
+        _, _, _, sha, counted = heapq.heappop(queue)
+        if counted:
+            active -= 1
+        paint = flags[sha]
+        if paint & (REV_PARENT1 | REV_PARENT2) == REV_PARENT1 | REV_PARENT2 and not paint & REV_STALE:
+            if not paint & REV_RESULT:
+                flags[sha] = paint | REV_RESULT
+                result.append(sha)
+            paint |= REV_STALE
+        paint &= REV_PARENT1 | REV_PARENT2 | REV_STALE
+
+        for p in walk.commit(sha)[0]:
+            old = flags.get(p, 0)
+            if old & paint == paint:
+                continue
+            flags[p] = old | paint
+            generation, date = walk.commit(p)[1:3]
+            counted = not paint & REV_STALE
+            heapq.heappush(queue, (-generation, -date, seq, p, counted))
+            seq += 1
+            active += counted
+
+    return merge_bases_reduce(walk, result)
+
+def merge_bases_reduce(walk, candidates):
+    # drops candidates reachable from another; nothing below the lowest
+    # candidate generation can lead to one
+    if len(candidates) < 2:
+        return candidates
+    floor = min(walk.commit(sha)[1] for sha in candidates)
+    redundant = set()
+    for sha in candidates:
+        if sha in redundant:
+            continue
+        seen = set()
+        stack = list(walk.commit(sha)[0])
+        while stack:
+            cur = stack.pop()
+            if cur in seen:
+                continue
+            seen.add(cur)
+            if cur in candidates:
+                redundant.add(cur)
+            parents, generation = walk.commit(cur)[0:2]
+            if generation >= floor:
+                stack.extend(parents)
+    return [sha for sha in candidates if sha not in redundant]
+
+def rev_parse_ranges(repo, revs):
+    # A..B, A...B and ^A, into the commits to include and to exclude
+    include = list()
+    exclude = list()
+
+    def commit(name):
+        sha = git_object.object_find(repo, name or 'HEAD', b'commit')
+        if sha is None:
+            raise Exception(f'Not a commit {name}')
+        return sha
+
+    for rev in revs:
+        if '...' in rev:
+            a, b = (commit(side) for side in rev.split('...', 1))
+            include.extend((a, b))
+            exclude.extend(merge_bases(repo, a, b))
+        elif '..' in rev:
+            a, b = (commit(side) for side in rev.split('..', 1))
+            exclude.append(a)
+            include.append(b)
+        elif rev.startswith('^'):
+            exclude.append(commit(rev[1:]))
+        else:
+            include.append(commit(rev))
+    return include, exclude
@@ -0,0 +1,162 @@
+import os
+import struct
+import sys
+
+# the client runs before anything else is imported, so it talks to the
+# socket through _socket: the socket module alone costs more to import
+# than a served request takes
+import _socket
+
+import git_trace
+
+SOCKET_ENV = 'WYAG_SOCKET'
+SERVE_COMMANDS = {'cat-file', 'log', 'ls-tree', 'merge-base', 'rev-list', 'rev-parse', 'show-ref'}
+SERVE_ENV = ('GIT_DIR', 'GIT_WORK_TREE', 'GIT_CEILING_DIRECTORIES')
+
+REQUEST_HEADER = struct.Struct('>IQ')
+RESPONSE_HEADER = struct.Struct('>iQQ')
+
+
+def recv_exact(sock, size):
+    parts = list()
+    while size:
+        chunk = sock.recv(min(size, 1 << 20))
+        if not chunk:
+            raise Exception('Connection closed mid-message')
+        parts.append(chunk)
+        size -= len(chunk)
+    return b''.join(parts)
+
+def request_encode(cwd, argv, env, stdin):
+    fields = [os.fsencode(cwd), str(len(argv)).encode()] + [os.fsencode(a) for a in argv]
+    fields.extend(os.fsencode(f'{k}={v}') for k, v in env.items())
+    payload = b'\x00'.join(fields)
+    return REQUEST_HEADER.pack(len(payload), len(stdin)) + payload + stdin
+
+def request_decode(sock):
+    size, stdin_size = REQUEST_HEADER.unpack(recv_exact(sock, REQUEST_HEADER.size))
+    fields = [os.fsdecode(f) for f in recv_exact(sock, size).split(b'\x00')]
+    count = int(fields[1])
+    argv = fields[2:2 + count]
+    env = dict(f.split('=', 1) for f in fields[2 + count:])
+    return fields[0], argv, env, recv_exact(sock, stdin_size)
+
+def client_run(path, argv):
+    # returns the exit code of the served command, or None when it has to
+    # run locally: not a served command, tracing, or no server listening
+    command = next((a for a in argv if not a.startswith('-')), None)
+    if command not in SERVE_COMMANDS or '--trace' in argv or os.environ.get(git_trace.TRACE_ENV):
+        return None
+
+    sock = _socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+
+    try:
+        stdin = b''
+        if command == 'cat-file' and ('--batch' in argv or '--batch-check' in argv):
+            stdin = sys.stdin.buffer.read()
+        env = dict((k, os.environ[k]) for k in SERVE_ENV if k in os.environ)
+        sock.sendall(request_encode(os.getcwd(), argv, env, stdin))
+
+        code, out_size, err_size = RESPONSE_HEADER.unpack(recv_exact(sock, RESPONSE_HEADER.size))
+        sys.stdout.buffer.write(recv_exact(sock, out_size))
+        sys.stdout.buffer.flush()
+        sys.stderr.buffer.write(recv_exact(sock, err_size))
+        sys.stderr.buffer.flush()
+    finally:
+        sock.close()
+    return code
+
+def serve_request(cwd, argv, env, stdin):
+    import io
+    import traceback
+    import libwyag
+
+    out = io.BytesIO()
+    err = io.BytesIO()
+    saved = (sys.stdin, sys.stdout, sys.stderr, dict((k, os.environ.get(k)) for k in SERVE_ENV))
+    stdout = io.TextIOWrapper(out, write_through=True)
+    stderr = io.TextIOWrapper(err, write_through=True)
+    sys.stdin = io.TextIOWrapper(io.BytesIO(stdin))
+    sys.stdout = stdout
+    sys.stderr = stderr
+    for k in SERVE_ENV:
+        if k in env:
+            os.environ[k] = env[k]
+        else:
+            os.environ.pop(k, None)
+
+    code = 0
+    try:
+        os.chdir(cwd)
+        command = libwyag.argv_command(argv)
+        if command not in SERVE_COMMANDS:
+            raise Exception(f'Command not served: {command}')
+        libwyag.dispatch(libwyag.args_parse(argv))
+    except SystemExit as e:
+        code = e.code if type(e.code) == int else int(e.code is not None)
+    except Exception:
+        traceback.print_exc()
+        code = 1
+    finally:
+        # detached, the wrappers flush without closing the buffers
+        stdout.detach()
+        stderr.detach()
+        sys.stdin, sys.stdout, sys.stderr, old_env = saved
+        for k, v in old_env.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+
+    return code, out.getvalue(), err.getvalue()
+
+def serve(path):
+    import socket
+    import git_repository
+
+    # repositories, with their object, pack, ref and commit-graph caches,
+    # stay open between requests; each cache checks its own files' stamps
+    git_repository.repo_cache = dict()
+
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except OSError:
+            os.unlink(path)
+        else:
+            raise Exception(f'Already serving on {path}')
+        finally:
+            probe.close()
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o077)
+    try:
+        server.bind(path)
+    finally:
+        os.umask(old_umask)
+    server.listen(64)
+
+    try:
+        while True:
+            conn, _ = server.accept()
+            with conn:
+                try:
+                    request = request_decode(conn)
+                except Exception:
+                    continue
+                code, out, err = serve_request(*request)
+                try:
+                    conn.sendall(RESPONSE_HEADER.pack(code, len(out), len(err)) + out + err)
+                except OSError:
+                    pass
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        os.unlink(path)
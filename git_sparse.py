@@ -0,0 +1,118 @@
+import os
+
+from git_repository import repo_path
+
+SPARSE_ROOT = (b'/*', b'!/*/')
+
+
+def sparse_enabled(repo):
+    return repo.conf.getboolean('core', 'sparsecheckout', fallback=False)
+
+def sparse_read(repo):
+    # the directories checked out in full, or None when every path is
+    if not sparse_enabled(repo):
+        return None
+    if not repo.conf.getboolean('core', 'sparsecheckoutcone', fallback=True):
+        raise Exception('Only cone mode sparse checkout is supported')
+
+    try:
+        with open(repo_path(repo, 'info', 'sparse-checkout'), 'rb') as f:
+            lines = [line.strip() for line in f.read().split(b'\n')]
+    except FileNotFoundError:
+        return list()
+    return sparse_parse([line for line in lines if line and not line.startswith(b'#')])
+
+def sparse_parse(lines):
+    # cone mode files list every parent directory as /dir/ followed by
+    # !/dir/*/, which leaves only its files in; a directory without that
+    # second line is in with everything below it
+    if tuple(lines[:2]) != SPARSE_ROOT:
+        raise Exception('Sparse checkout patterns are not in cone mode')
+
+    dirs = list()
+    parents = set()
+    for line in lines[2:]:
+        if line.startswith(b'!/') and line.endswith(b'/*/'):
+            parents.add(sparse_unescape(line[2:-3]))
+        elif line.startswith(b'/') and line.endswith(b'/') and len(line) > 2 and not line.endswith(b'*/'):
+            dirs.append(sparse_unescape(line[1:-1]))
+        else:
+            raise Exception(f'Sparse checkout pattern not in cone mode: {line.decode('utf8', 'replace')}')
+    return [d for d in dirs if d not in parents]
+
+def sparse_unescape(path):
+    if b'\\' not in path:
+        return path
+    out = bytearray()
+    i = 0
+    while i < len(path):
+        if path[i] == 0x5c and i + 1 < len(path):
+            i += 1
+        out.append(path[i])
+        i += 1
+    return bytes(out)
+
+def sparse_escape(path):
+    for c in (b'\\', b'*', b'?', b'['):
+        path = path.replace(c, b'\\' + c)
+    return path
+
+def sparse_write(repo, dirs):
+    # sorted, each directory comes right after its parents
+    dirs = sparse_normalize(dirs)
+    parents = set()
+    for d in dirs:
+        pos = d.find(b'/')
+        while pos >= 0:
+            parents.add(d[:pos])
+            pos = d.find(b'/', pos + 1)
+
+    lines = list(SPARSE_ROOT)
+    for d in sorted(parents | set(dirs)):
+        lines.append(b'/' + sparse_escape(d) + b'/')
+        if d not in dirs:
+            lines.append(b'!/' + sparse_escape(d) + b'/*/')
+
+    path = repo_path(repo, 'info', 'sparse-checkout')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    lock = path + '.lock'
+    with open(lock, 'xb') as f:
+        f.write(b'\n'.join(lines) + b'\n')
+    os.replace(lock, path)
+
+def sparse_normalize(dirs):
+    # directories below another listed one add nothing
+    ret = list()
+    for d in sorted(set(d.strip(b'/') for d in dirs)):
+        if not d:
+            raise Exception('Cannot restrict a sparse checkout to the top directory')
+        if not ret or not d.startswith(ret[-1] + b'/'):
+            ret.append(d)
+    return ret
+
+def sparse_cone(dirs):
+    # a trie of path components: a dict holds the directories that lead to
+    # the cone, where only files are in, and None is a directory that is in
+    # with everything below it; a name not in a dict is out
+    if dirs is None:
+        return None
+    root = dict()
+    for d in sparse_normalize(dirs):
+        node = root
+        parts = d.split(b'/')
+        for part in parts[:-1]:
+            node = node.setdefault(part, dict())
+            if node is None:
+                break
+        else:
+            node[parts[-1]] = None
+    return root
+
+def sparse_load(repo):
+    return sparse_cone(sparse_read(repo))
+
+def sparse_child(node, name):
+    # the node of a subdirectory; False when it is outside the cone
+    if node is None:
+        return None
+    return node.get(name, False)
@@ -0,0 +1,255 @@
+import bisect
+import os
+import stat
+import time
+
+from git_repository import repo_path, file_stamp
+import git_commit_graph
+import git_index
+import git_object
+import git_trace
+
+MODE_REGULAR = 0b1000
+MODE_SYMLINK = 0b1010
+MODE_GITLINK = 0b1110
+MODE_TREE = 0b0100
+
+
+class GitStatus(object):
+
+    def __init__(self):
+        self.staged = dict()
+        self.unstaged = dict()
+        self.unmerged = set()
+        self.untracked = list()
+        self.hashed = 0
+        self.refreshed = 0
+        # racily clean entries found modified; their stat data still
+        # matches, so the index must not be rewritten under them
+        self.racy = 0
+
+
+def stat_fields(st):
+    ctime, ctime_ns = divmod(st.st_ctime_ns, 10 ** 9)
+    mtime, mtime_ns = divmod(st.st_mtime_ns, 10 ** 9)
+    return (ctime & 0xFFFFFFFF, ctime_ns, mtime & 0xFFFFFFFF, mtime_ns, st.st_dev & 0xFFFFFFFF,
+            st.st_ino & 0xFFFFFFFF, st.st_uid & 0xFFFFFFFF, st.st_gid & 0xFFFFFFFF, st.st_size & 0xFFFFFFFF)
+
+def stat_mode(st):
+    if stat.S_ISLNK(st.st_mode):
+        return MODE_SYMLINK << 12
+    if st.st_mode & 0o100:
+        return (MODE_REGULAR << 12) | 0o755
+    return (MODE_REGULAR << 12) | 0o644
+
+def worktree_hash(path, st):
+    if stat.S_ISLNK(st.st_mode):
+        target = os.readlink(path)
+        return git_object.object_write_stream(b'blob', len(target), [target])
+
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        return git_object.object_write_stream(b'blob', size, git_object.file_chunks(f))
+
+def status_head_tree(repo):
+    sha = git_object.ref_resolve(repo, 'HEAD')
+    if not sha:
+        return None
+    return git_commit_graph.commit_info(repo, sha)[0]
+
+def status_staged(repo, index, result):
+    entries = index.entries
+    names = [e.raw_name for e in entries]
+    cache = git_index.index_cache_tree(index)
+
+    # subtrees whose cached tree sha matches HEAD hold the same entries in
+    # the index, so neither side of them has to be looked at
+    head = dict()
+    pruned = list()
+    # directories outside a sparse cone are single index entries, compared
+    # with HEAD by their tree sha
+    sparse = set(e.raw_name for e in entries if e.fields[6] >> 12 == MODE_TREE)
+    tree_sha = status_head_tree(repo)
+    stack = [(b'', tree_sha)] if tree_sha else []
+    while stack:
+        prefix, sha = stack.pop()
+        if cache.get(prefix, (-1, None))[1] == bytes.fromhex(sha):
+            pruned.append(prefix)
+            continue
+        for mode, name, binsha in git_object.object_read(repo, sha).entries():
+            if git_object.tree_mode_is_tree(mode):
+                if prefix + name + b'/' in sparse:
+                    head[prefix + name + b'/'] = (int(mode, 8), binsha)
+                else:
+                    stack.append((prefix + name + b'/', binsha.hex()))
+            else:
+                head[prefix + name] = (int(mode, 8), binsha)
+
+    skip = bytearray(len(entries))
+    for prefix in pruned:
+        lo = bisect.bisect_left(names, prefix)
+        hi = bisect.bisect_left(names, prefix[:-1] + b'0') if prefix else len(names)
+        skip[lo:hi] = b'\x01' * (hi - lo)
+
+    for i, e in enumerate(entries):
+        if skip[i]:
+            continue
+        if e.fields[11] & git_index.FLAG_STAGE_MASK:
+            result.unmerged.add(e.name)
+            head.pop(e.raw_name, None)
+            continue
+        if e.extended & git_index.FLAG_INTENT_TO_ADD:
+            continue
+
+        old = head.pop(e.raw_name, None)
+        if old is None:
+            result.staged[e.name] = 'A'
+        elif old[0] >> 12 != e.fields[6] >> 12:
+            result.staged[e.name] = 'T'
+        elif old[0] != e.fields[6] or old[1] != e.binsha:
+            result.staged[e.name] = 'M'
+
+    for name in head:
+        result.staged[name.decode('utf8')] = 'D'
+
+def status_worktree(repo, index, result, jobs=0):
+    root = os.path.join(os.fsencode(repo.worktree), b'')
+    filemode = repo.conf.getboolean('core', 'filemode', fallback=True)
+    trust_ctime = repo.conf.getboolean('core', 'trustctime', fallback=True)
+
+    # a file modified within the same timestamp tick the index was written
+    # in can look unchanged to stat, so those entries are always rehashed
+    stamp = file_stamp(repo_path(repo, 'index'))
+    racy_ns = stamp[0] if stamp else 0
+    start_ns = time.time_ns()
+    first = 0 if trust_ctime else 2
+
+    suspects = list()
+    unstaged = result.unstaged
+    lstat = os.lstat
+    for e in index.entries:
+        fields = e.fields
+        if fields[11] & git_index.FLAG_STAGE_MASK or e.extended & git_index.FLAG_SKIP_WORKTREE:
+            continue
+        if e.extended & git_index.FLAG_INTENT_TO_ADD:
+            unstaged[e.name] = 'A'
+            continue
+
+        mode_type = fields[6] >> 12
+        try:
+            st = lstat(root + e.raw_name)
+        except (FileNotFoundError, NotADirectoryError):
+            if mode_type != MODE_GITLINK:
+                unstaged[e.name] = 'D'
+            continue
+
+        if mode_type == MODE_GITLINK:
+            continue
+        if stat.S_ISDIR(st.st_mode):
+            unstaged[e.name] = 'D'
+            continue
+
+        mode = stat_mode(st)
+        if mode >> 12 != mode_type:
+            unstaged[e.name] = 'T'
+        elif filemode and mode != fields[6]:
+            unstaged[e.name] = 'M'
+        elif fields[11] & git_index.FLAG_ASSUME_VALID:
+            continue
+        elif st.st_size & 0xFFFFFFFF != fields[9] and fields[9]:
+            # a zero size may be a smudged racy entry, which is hashed
+            unstaged[e.name] = 'M'
+        elif stat_fields(st)[first:] != fields[first:6] + fields[7:10] or st.st_mtime_ns >= racy_ns:
+            suspects.append((e, st))
+
+    if not suspects:
+        return
+
+    def check(suspect):
+        e, st = suspect
+        try:
+            return worktree_hash(root + e.raw_name, st)
+        except FileNotFoundError:
+            return None
+
+    if jobs == 0:
+        jobs = os.cpu_count() or 1
+
+    if jobs == 1 or len(suspects) < 2:
+        shas = list(map(check, suspects))
+    else:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            shas = list(pool.map(check, suspects))
+
+    result.hashed += len(suspects)
+    for (e, st), sha in zip(suspects, shas):
+        if sha is None:
+            unstaged[e.name] = 'D'
+        elif sha != e.sha:
+            unstaged[e.name] = 'M'
+            if stat_fields(st)[first:] == e.fields[first:6] + e.fields[7:10]:
+                result.racy += 1
+        elif st.st_mtime_ns < start_ns and st.st_ctime_ns < start_ns:
+            # unchanged and older than this run: record the new stat data so
+            # the next status can trust it without hashing
+            fields = stat_fields(st)
+            e.fields = fields[0:6] + e.fields[6:7] + fields[6:9] + e.fields[10:]
+            result.refreshed += 1
+
+def status_untracked(repo, index, result):
+    names = [e.raw_name for e in index.entries]
+    tracked = set(names)
+    untracked = result.untracked
+
+    stack = [(os.fsencode(repo.worktree), b'')]
+    while stack:
+        path, prefix = stack.pop()
+        for entry in os.scandir(path):
+            name = prefix + entry.name
+            if entry.is_dir(follow_symlinks=False):
+                if entry.name == b'.git' or name in tracked:
+                    continue
+                i = bisect.bisect_left(names, name + b'/')
+                if i < len(names) and names[i].startswith(name + b'/'):
+                    stack.append((entry.path, name + b'/'))
+                elif dir_has_files(entry.path):
+                    untracked.append(os.fsdecode(name) + '/')
+            elif name not in tracked:
+                untracked.append(os.fsdecode(name))
+
+    untracked.sort()
+
+def dir_has_files(path):
+    stack = [path]
+    while stack:
+        for entry in os.scandir(stack.pop()):
+            if not entry.is_dir(follow_symlinks=False) or entry.name == b'.git':
+                return True
+            stack.append(entry.path)
+    return False
+
+def status(repo, jobs=0, untracked=True, refresh=True):
+    stamp = file_stamp(repo_path(repo, 'index'))
+    index = git_index.index_read(repo)
+
+    result = GitStatus()
+    with git_trace.region('status.staged'):
+        status_staged(repo, index, result)
+    with git_trace.region('status.worktree'):
+        status_worktree(repo, index, result, jobs=jobs)
+    if untracked:
+        with git_trace.region('status.untracked'):
+            status_untracked(repo, index, result)
+    
+    if git_trace.enabled:
+        git_trace.count('status.hashed', result.hashed)
+        git_trace.count('status.refreshed', result.refreshed)
+
+    if refresh and result.refreshed and not result.racy and file_stamp(repo_path(repo, 'index')) == stamp:
+        try:
+            git_index.index_write(repo, index)
+        except FileExistsError:
+            pass
+
+    return result
@@ -0,0 +1,111 @@
+import builtins
+import os
+import sys
+import time
+
+TRACE_ENV = 'WYAG_TRACE'
+TRACE_SYSCALLS = ('open', 'stat', 'lstat', 'scandir', 'listdir', 'readlink', 'replace', 'unlink', 'mkdir')
+
+# module level so the disabled case costs a single attribute check
+enabled = False
+counters = dict()
+events = list()
+target = None
+start_ns = 0
+depth = 0
+# (owner, name, original) of each call counted, put back at the end
+wrapped = list()
+
+
+class TraceRegion(object):
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        global depth
+        self.depth = depth
+        depth += 1
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, kind, value, tb):
+        global depth
+        depth -= 1
+        elapsed = time.perf_counter_ns() - self.start
+        events.append({'event': 'region', 'name': self.name, 'depth': self.depth,
+                       't_rel': (self.start - start_ns) / 1e9, 't_elapsed': elapsed / 1e9})
+        return False
+
+
+class TraceNullRegion(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, tb):
+        return False
+
+NULL_REGION = TraceNullRegion()
+
+
+def region(name):
+    if not enabled:
+        return NULL_REGION
+    return TraceRegion(name)
+
+def count(name, n=1):
+    counters[name] = counters.get(name, 0) + n
+
+def trace_wrap(owner, name, counter):
+    original = getattr(owner, name)
+
+    def wrapper(*args, **kwargs):
+        counters[counter] = counters.get(counter, 0) + 1
+        return original(*args, **kwargs)
+
+    wrapped.append((owner, name, original))
+    setattr(owner, name, wrapper)
+
+def trace_unwrap():
+    while wrapped:
+        owner, name, original = wrapped.pop()
+        setattr(owner, name, original)
+
+def trace_start(path, argv, command):
+    global enabled, target, start_ns
+    if not path or path in ('0', 'false'):
+        return
+
+    enabled = True
+    target = path
+    start_ns = time.perf_counter_ns()
+    events.append({'event': 'start', 'time': time.time(), 'pid': os.getpid(),
+                   'command': command, 'argv': list(argv)})
+
+    # the file system calls are replaced for the whole process with ones
+    # that count, which trace_finish puts back
+    trace_wrap(builtins, 'open', 'syscall.open')
+    for name in TRACE_SYSCALLS[1:]:
+        trace_wrap(os, name, f'syscall.{name}')
+
+def trace_finish(code):
+    global enabled
+    if not enabled:
+        return
+    enabled = False
+    trace_unwrap()
+
+    elapsed = (time.perf_counter_ns() - start_ns) / 1e9
+    events.append({'event': 'counters', 'counters': dict(sorted(counters.items()))})
+    events.append({'event': 'exit', 'code': code, 't_abs': elapsed})
+
+    import json
+    lines = ''.join(json.dumps(e, separators=(',', ':')) + '\n' for e in events)
+    if target in ('1', '2', 'true', '-'):
+        sys.stderr.write(lines)
+    else:
+        with open(target, 'a') as f:
+            f.write(lines)
+    counters.clear()
+    events.clear()
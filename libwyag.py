@@ -1,71 +1,244 @@
 import argparse
-import collections
-import configparser
-from datetime import datetime
-# import grp, pwd
-from fnmatch import fnmatch
-import hashlib
-from math import ceil
+import bisect
 import os
-import re
 import sys
-import zlib
 
 import git_repository
 import git_object
 
-argparser = argparse.ArgumentParser()
-argsubparsers = argparser.add_subparsers(title='Commands', dest='command')
-argsubparsers.required = True
 
-argsp = argsubparsers.add_parser('init', help='Initialize a new, empty repository')
-argsp.add_argument('path', metavar='directory', nargs='?', default='.', 
-                   help='Where to create the repository')
+def args_init(argsp):
+    argsp.add_argument('path', metavar='directory', nargs='?', default='.', 
+                       help='Where to create the repository')
 
-argsp = argsubparsers.add_parser('cat-file', help='Provide content of repo objects')
-argsp.add_argument('type', metavar="type", choices=['blob', 'commit', 'tag', 'tree'],
-                   help='Specify the Type')
-argsp.add_argument('object', metavar='object', help='The object to display')
+def args_add(argsp):
+    argsp.add_argument('-j', dest='jobs', type=int, default=0, 
+                       help='Number of parallel workers hashing files (0 for one per CPU)')
+    argsp.add_argument('path', nargs='+', help='Files or directories to add')
 
-argsp = argsubparsers.add_parser('log', help='Display commit history')
-argsp.add_argument('commit', default='HEAD', nargs='?', help='Commit to display')
+def args_cat_file(argsp):
+    argsp.add_argument('--batch', action='store_true', 
+                       help='Print type, size and content of each object named on stdin')
+    argsp.add_argument('--batch-check', action='store_true', dest='batch_check', 
+                       help='Print type and size of each object named on stdin')
+    argsp.add_argument('--buffer', action='store_true', 
+                       help='Do not flush the output after each object in batch mode')
+    argsp.add_argument('type', metavar="type", nargs='?', choices=['blob', 'commit', 'tag', 'tree'],
+                       help='Specify the Type')
+    argsp.add_argument('object', metavar='object', nargs='?', help='The object to display')
 
-argsp = argsubparsers.add_parser('ls-tree', help='Print a tree object')
-argsp.add_argument('-r', dest='recursive', action='store_true', help='Recurse into sub trees')
-argsp.add_argument('tree', help='A tree object')
+def args_commit_graph(argsp):
+    argsp.add_argument('action', choices=['write'], help='Write a commit-graph of every commit reachable from refs')
+    argsp.add_argument('--changed-paths', action='store_true', default=None, 
+                       help='Also store a filter of the paths each commit changed, for log -- path')
 
-argps = argsubparsers.add_parser('checkout', help='Checkout a commit')
-argsp.add_argument('commit', help='The commit or tree to checkout')
-argsp.add_argument('path', help='The empty directory to checkout on')
+def args_commit(argsp):
+    argsp.add_argument('-m', metavar='message', dest='message', required=True, help='The commit message')
 
-argsp = argsubparsers.add_parser('show-ref', help='List references')
+def args_diff_tree(argsp):
+    argsp.add_argument('-r', dest='recursive', action='store_true', help='Recurse into sub trees')
+    argsp.add_argument('-t', dest='trees', action='store_true', help='Show tree entries even when recursing')
+    argsp.add_argument('-p', '--patch', action='store_true', help='Show a textual diff of the changed files; implies -r')
+    argsp.add_argument('-U', '--unified', metavar='n', dest='context', type=int, default=3, 
+                       help='Lines of context around each change')
+    argsp.add_argument('old', help='A commit to compare with its parent, or the old tree')
+    argsp.add_argument('new', nargs='?', help='The new tree')
 
-argsp = argsubparsers.add_parser('tag', help='List and create tags')
-argsp.add_argument('-a', action='store_true', dest='create_tag_object')
-argsp.add_argument('name', nargs='?', help='The name of the tag')
-argsp.add_argument('object', default='HEAD', nargs='?', help='The object the tag points to')
+def args_gc(argsp):
+    pass
 
-argsp = argsubparsers.add_parser('rev-parse', help='Parse revision identifiers')
-argsp.add_argument('--wyag-type', metavar='type', dest='type', choices=['blob', 'commit','tag','tree'], default=None, help='Specify the expected type')
-argsp.add_argument('name', help='The name to parse')
+def args_hash_object(argsp):
+    argsp.add_argument('-t', metavar='type', dest='type', choices=['blob', 'commit', 'tag', 'tree'], default='blob', 
+                       help='Specify the type')
+    argsp.add_argument('-w', dest='write', action='store_true', help='Write the objects into the database')
+    argsp.add_argument('--stdin-paths', action='store_true', dest='stdin_paths', 
+                       help='Read the paths to hash from stdin, one per line')
+    argsp.add_argument('-j', dest='jobs', type=int, default=0, 
+                       help='Number of parallel workers hashing files (0 for one per CPU)')
+    argsp.add_argument('path', nargs='*', help='Read objects from these files')
+
+def args_log(argsp):
+    argsp.add_argument('commit', default='HEAD', nargs='?', 
+                       help='Commit to display; paths after -- keep only the commits changing them')
+
+def args_ls_tree(argsp):
+    argsp.add_argument('-r', dest='recursive', action='store_true', help='Recurse into sub trees')
+    argsp.add_argument('--sparse', action='store_true', 
+                       help='Only list paths inside the sparse checkout cone')
+    argsp.add_argument('tree', help='A tree object')
+
+def args_checkout(argsp):
+    argsp.add_argument('-j', dest='jobs', type=int, default=1, 
+                       help='Number of parallel workers writing files (0 for one per CPU)')
+    argsp.add_argument('commit', help='The commit or tree to checkout')
+    argsp.add_argument('path', nargs='?',
+                       help='The empty directory to checkout on (default: switch the worktree to commit)')
+
+def args_sparse_checkout(argsp):
+    argsp.add_argument('-j', dest='jobs', type=int, default=1, 
+                       help='Number of parallel workers writing files (0 for one per CPU)')
+    argsp.add_argument('action', choices=['list', 'set', 'add', 'reapply', 'disable'])
+    argsp.add_argument('dirs', nargs='*', help='Directories to check out in full, relative to the top')
+
+def args_show_ref(argsp):
+    argsp.add_argument('-d', '--dereference', action='store_true', 
+                       help='Also show the objects annotated tags point to')
+
+def args_pack_refs(argsp):
+    argsp.add_argument('--all', action='store_true', help='Pack branches as well as tags')
+    argsp.add_argument('--no-prune', action='store_false', dest='prune', 
+                       help='Keep the loose refs that were packed')
+
+def args_status(argsp):
+    argsp.add_argument('-s', '--short', action='store_true', help='Give the output in the short format')
+    argsp.add_argument('-j', dest='jobs', type=int, default=0, 
+                       help='Number of parallel workers hashing files (0 for one per CPU)')
+    argsp.add_argument('-u', '--untracked-files', dest='untracked', choices=['no', 'normal'], default='normal', 
+                       help='Whether to show untracked files')
+
+def args_tag(argsp):
+    argsp.add_argument('-a', action='store_true', dest='create_tag_object')
+    argsp.add_argument('name', nargs='?', help='The name of the tag')
+    argsp.add_argument('object', default='HEAD', nargs='?', help='The object the tag points to')
+
+def args_repack(argsp):
+    argsp.add_argument('-a', action='store_true', dest='all_objects', 
+                       help='Pack every reachable object instead of only the loose ones')
+    argsp.add_argument('-A', action='store_true', dest='loosen', 
+                       help='Like -a, but with -d the unreachable objects of old packs are kept as loose objects')
+    argsp.add_argument('-d', action='store_true', dest='delete', 
+                       help='Remove redundant packs and loose objects after packing')
+    argsp.add_argument('--window', type=int, default=None, help='Number of objects to try as delta bases')
+    argsp.add_argument('--depth', type=int, default=None, help='Maximum delta chain length')
+
+def args_rev_parse(argsp):
+    argsp.add_argument('--wyag-type', metavar='type', dest='type', choices=['blob', 'commit','tag','tree'], default=None, help='Specify the expected type')
+    # as in git, a length only comes as --short=length, so --short HEAD
+    # reads HEAD as the name; args_parse turns it into --short-length
+    argsp.add_argument('--short', dest='short', action='store_const', const=7, default=None, 
+                       help='Print the shortest unique abbreviation, of at least 7 characters or --short=length')
+    argsp.add_argument('--short-length', dest='short', type=int, help=argparse.SUPPRESS)
+    argsp.add_argument('name', help='The name to parse')
+
+def args_rev_list(argsp):
+    argsp.add_argument('-n', '--max-count', type=int, default=None, help='Stop after this many commits')
+    argsp.add_argument('--since', metavar='date', help='Only commits newer than this, and stop walking there')
+    argsp.add_argument('--until', metavar='date', help='Only commits older than this')
+    argsp.add_argument('--first-parent', action='store_true', help='Only follow the first parent of merges')
+    argsp.add_argument('--topo-order', action='store_true', 
+                       help='Show no parent before all its children, keeping lines of history together')
+    argsp.add_argument('--count', action='store_true', help='Print the number of commits instead')
+    argsp.add_argument('rev', nargs='+', 
+                       help='Commits, ^commit to exclude, A..B or A...B; paths after -- keep only the commits changing them')
+
+def args_merge_base(argsp):
+    argsp.add_argument('--all', action='store_true', help='Print all best common ancestors')
+    argsp.add_argument('one', help='A commit')
+    argsp.add_argument('two', help='Another commit')
+
+def args_serve(argsp):
+    argsp.add_argument('--socket', metavar='path', default=os.environ.get('WYAG_SOCKET'), 
+                       help='The Unix socket to listen on; defaults to $WYAG_SOCKET')
+
+COMMANDS = {
+    'init'         : ('Initialize a new, empty repository', args_init),
+    'add'          : ('Add file contents to the index', args_add),
+    'cat-file'     : ('Provide content of repo objects', args_cat_file),
+    'commit-graph' : ('Write the commit-graph file', args_commit_graph),
+    'commit'       : ('Record the index as a new commit', args_commit),
+    'diff-tree'    : ('Compare the content and mode of blobs found via two tree objects', args_diff_tree),
+    'gc'           : ('Pack refs and objects and write the commit-graph', args_gc),
+    'hash-object'  : ('Compute object IDs and optionally create objects from files', args_hash_object),
+    'log'          : ('Display commit history', args_log),
+    'ls-tree'      : ('Print a tree object', args_ls_tree),
+    'merge-base'   : ('Find the best common ancestors of two commits', args_merge_base),
+    'checkout'     : ('Checkout a commit', args_checkout),
+    'show-ref'     : ('List references', args_show_ref),
+    'sparse-checkout' : ('Restrict the worktree to a cone of directories', args_sparse_checkout),
+    'pack-refs'    : ('Pack references into packed-refs', args_pack_refs),
+    'status'       : ('Show the working tree status', args_status),
+    'tag'          : ('List and create tags', args_tag),
+    'repack'       : ('Pack objects into a packfile with deltas', args_repack),
+    'rev-list'     : ('List commits reachable from some commits but not others', args_rev_list),
+    'rev-parse'    : ('Parse revision identifiers', args_rev_parse),
+    'serve'        : ('Answer read-only commands over a Unix socket with warm caches', args_serve),
+}
+
+PATHSPEC_COMMANDS = {'log', 'rev-list'}
+
+def argparser_make(command=None):
+    import git_trace
+    # every command is listed for --help, but only the one being run gets
+    # its arguments added
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--trace', metavar='path', default=os.environ.get(git_trace.TRACE_ENV),
+                           help=f'Append timings and counters as JSON lines to this file (or 2 for stderr); '
+                                f'defaults to ${git_trace.TRACE_ENV}')
+    argsubparsers = argparser.add_subparsers(title='Commands', dest='command')
+    argsubparsers.required = True
+    
+    for name, (help, setup) in COMMANDS.items():
+        argsp = argsubparsers.add_parser(name, help=help)
+        if command is None or command == name:
+            setup(argsp)
+    return argparser
+
+def args_parse(argv):
+    # paths come after --, where argparse would take them for more revs
+    command = argv_command(argv)
+    paths = list()
+    if command in PATHSPEC_COMMANDS and '--' in argv:
+        i = argv.index('--')
+        argv, paths = argv[:i], argv[i + 1:]
+    if command == 'rev-parse':
+        argv = [a for arg in argv for a in (['--short-length', arg[8:]] if arg.startswith('--short=') else [arg])]
+    args = argparser_make(command).parse_args(argv)
+    args.paths = paths
+    return args
+
+def argv_command(argv):
+    for i, arg in enumerate(argv):
+        if arg in COMMANDS and (i == 0 or argv[i - 1] != '--trace'):
+            return arg
+    return None
 
 def main(argv=sys.argv[1:]):
-    args = argparser.parse_args(argv)
+    import git_trace
+    args = args_parse(argv)
+    git_trace.trace_start(args.trace, argv, args.command)
+    code = 1
+    try:
+        with git_trace.region(f'cmd.{args.command}'):
+            dispatch(args)
+        code = 0
+    finally:
+        git_trace.trace_finish(code)
+
+def dispatch(args):
     match args.command:
-        # case 'add'          : cmd_add(args)
+        case 'add'          : cmd_add(args)
         case 'cat-file'     : cmd_cat_file(args)
         # case 'check-ignore' : cmd_check_ignore(args)
         case 'checkout'     : cmd_checkout(args)
-        # case 'commit'       : cmd_commit(args)
-        # case 'hash-object'  : cmd_hash_object(args)
+        case 'commit-graph' : cmd_commit_graph(args)
+        case 'commit'       : cmd_commit(args)
+        case 'diff-tree'    : cmd_diff_tree(args)
+        case 'gc'           : cmd_gc(args)
+        case 'hash-object'  : cmd_hash_object(args)
         case 'init'         : cmd_init(args)
         case 'log'          : cmd_log(args)
         # case 'ls-files'     : cmd_ls_files(args)
         case 'ls-tree'      : cmd_ls_tree(args)
+        case 'merge-base'   : cmd_merge_base(args)
+        case 'pack-refs'    : cmd_pack_refs(args)
+        case 'repack'       : cmd_repack(args)
+        case 'rev-list'     : cmd_rev_list(args)
         case 'rev-parse'    : cmd_rev_parse(args)
         # case 'rm'           : cmd_rm(args)
+        case 'serve'        : cmd_serve(args)
         case 'show-ref'     : cmd_show_ref(args)
-        # case 'status'       : cmd_status(args)
+        case 'sparse-checkout' : cmd_sparse_checkout(args)
+        case 'status'       : cmd_status(args)
         case 'tag'          : cmd_tag(args)
         case _              : print('Invalid Command')
         
@@ -74,82 +247,431 @@ def cmd_init(args):
 
 def cmd_cat_file(args):
     repo = git_repository.repo_find()
+    
+    if args.batch or args.batch_check:
+        cat_file_batch(repo, sys.stdin.buffer, sys.stdout.buffer, 
+                       contents=args.batch, flush=not args.buffer)
+        return
+    
+    if not (args.type and args.object):
+        raise Exception('cat-file needs a type and an object, or --batch/--batch-check')
     cat_file(repo, args.object, fmt=args.type.encode())
     
 def cat_file(repo, obj, fmt=None):
-    obj = git_object.object_read(repo, git_object.object_find(repo, obj, fmt=fmt))
-    sys.stdout.buffer.write(obj.serialize())
+    sha = git_object.object_find(repo, obj, fmt=fmt)
+    _, _, chunks = git_object.object_stream(repo, sha)
+    for chunk in chunks:
+        sys.stdout.buffer.write(chunk)
+    
+def cat_file_batch(repo, infile, outfile, contents=True, flush=True):
+    for line in infile:
+        name = line.strip()
+        if not name:
+            continue
+        name = name.decode('utf8')
+        
+        candidates = [c for c in git_object.object_resolve(repo, name) or [] if c]
+        if len(candidates) > 1:
+            outfile.write(f'{name} ambiguous\n'.encode())
+            continue
+        
+        header = git_object.object_header(repo, candidates[0]) if candidates else None
+        if not header:
+            outfile.write(f'{name} missing\n'.encode())
+            continue
+        
+        sha = candidates[0]
+        fmt, size = header
+        outfile.write(f'{sha} {fmt.decode('ascii')} {size}\n'.encode())
+        
+        if contents:
+            _, _, chunks = git_object.object_stream(repo, sha)
+            for chunk in chunks:
+                outfile.write(chunk)
+            outfile.write(b'\n')
+        
+        if flush:
+            outfile.flush()
+    
+    outfile.flush()
+
+def cmd_add(args):
+    repo = git_repository.repo_find()
+    add(repo, args.path, jobs=args.jobs)
+
+def add(repo, paths, jobs=0):
+    import git_index
+    import git_trace
+    index = git_index.index_read(repo)
+    stamp = git_repository.file_stamp(git_repository.repo_path(repo, 'index'))
+    racy_ns = stamp[0] if stamp else 0
+    filemode = repo.conf.getboolean('core', 'filemode', fallback=True)
+    
+    names = [e.raw_name for e in index.entries]
+    tracked = dict((e.raw_name, e) for e in index.entries if not e.flag_stage)
+    found = dict()
+    removed = set()
+    
+    for path in paths:
+        full, rel = worktree_path(repo, path)
+        prefix = rel + b'/' if rel else b''
+        
+        lo = bisect.bisect_left(names, prefix)
+        hi = lo
+        while hi < len(names) and names[hi].startswith(prefix):
+            hi += 1
+        
+        if os.path.isdir(full) and not os.path.islink(full):
+            walked = worktree_files(full, prefix)
+            found.update(walked)
+        elif os.path.lexists(full):
+            found[rel] = full
+            continue
+        elif rel in tracked or lo < hi:
+            walked = dict()
+            removed.add(rel)
+        else:
+            raise Exception(f'Pathspec {path} did not match any files')
+        
+        # tracked files under the path that are gone are staged as deletions
+        removed.update(name for name in names[lo:hi] if name not in walked)
+    
+    with git_trace.region('add.hash'):
+        entries = add_hash(repo, tracked, found, racy_ns, filemode, jobs)
+    
+    if not entries and not removed:
+        return
+    
+    with git_trace.region('add.index'):
+        add_index_update(repo, index, entries, removed)
+
+def add_hash(repo, tracked, found, racy_ns, filemode, jobs):
+    import git_index
+    import git_status
+    changed = list()
+    for rel, full in sorted(found.items()):
+        e = tracked.get(rel)
+        if e is not None:
+            st = os.lstat(full)
+            if (git_status.stat_mode(st) >> 12 == e.mode_type and st.st_mtime_ns < racy_ns 
+                    and git_status.stat_fields(st) == e.fields[0:6] + e.fields[7:10]):
+                continue
+        changed.append(rel)
+    
+    entries = dict()
+    results = git_object.blobs_write(repo, [found[rel] for rel in changed], jobs=jobs)
+    for rel, (sha, st) in zip(changed, results):
+        mode = git_status.stat_mode(st)
+        old = tracked.get(rel)
+        if not filemode and old is not None and old.mode_type == mode >> 12:
+            mode = old.fields[6]
+        fields = git_status.stat_fields(st)
+        entries[rel] = git_index.GitIndexEntry(fields[0:6] + (mode,) + fields[6:9] + (bytes.fromhex(sha), 0), rel)
+    return entries
+
+def add_index_update(repo, index, entries, removed):
+    import git_index
+    # a new file replaces whatever was tracked at its parent paths or below it
+    touched = set(entries) | removed
+    parents = set()
+    for rel in entries:
+        pos = rel.find(b'/')
+        while pos >= 0:
+            parents.add(rel[:pos])
+            pos = rel.find(b'/', pos + 1)
+    
+    keep = list()
+    for e in index.entries:
+        name = e.raw_name
+        if name in touched or name in parents:
+            touched.add(name)
+            continue
+        pos = name.find(b'/')
+        while pos >= 0 and name[:pos] not in entries:
+            pos = name.find(b'/', pos + 1)
+        if pos >= 0:
+            touched.add(name)
+            continue
+        keep.append(e)
+    
+    keep.extend(entries.values())
+    keep.sort(key=lambda e: (e.raw_name, e.flag_stage))
+    index.entries = keep
+    git_index.index_cache_tree_invalidate(index, touched)
+    git_index.index_write(repo, index)
+
+def worktree_path(repo, path):
+    # parent directories are resolved but the last component is kept, so a
+    # symlink is added as a link
+    full = os.path.abspath(path)
+    full = os.path.join(os.path.realpath(os.path.dirname(full)), os.path.basename(full))
+    rel = os.path.relpath(full, repo.worktree)
+    if rel == '..' or rel.startswith('..' + os.sep) or rel == '.git' or rel.startswith('.git' + os.sep):
+        raise Exception(f'Path outside the worktree {path}')
+    if rel == '.':
+        return repo.worktree, b''
+    return full, os.fsencode(rel.replace(os.sep, '/'))
+
+def worktree_files(path, prefix):
+    ret = dict()
+    stack = [(os.fsencode(path), prefix)]
+    while stack:
+        path, prefix = stack.pop()
+        for entry in os.scandir(path):
+            if entry.name == b'.git':
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                # nested repositories are left alone
+                if not os.path.lexists(os.path.join(entry.path, b'.git')):
+                    stack.append((entry.path, prefix + entry.name + b'/'))
+            else:
+                ret[prefix + entry.name] = entry.path
+    return ret
+
+def cmd_commit(args):
+    import git_refs
+    repo = git_repository.repo_find()
+    sha = commit_create(repo, args.message)
+    
+    head = git_refs.ref_store(repo).read('HEAD')
+    branch = head[16:] if head.startswith('ref: refs/heads/') else 'detached HEAD'
+    print(f'[{branch} {sha[:7]}] {args.message.splitlines()[0] if args.message else ''}')
+
+def commit_create(repo, message):
+    import git_commit_graph
+    import git_index
+    import git_refs
+    index = git_index.index_read(repo)
+    
+    batch = git_object.GitLooseBatch(repo)
+    try:
+        tree = git_index.index_tree_write(index, batch.write)
+    except BaseException:
+        batch.abort()
+        raise
+    batch.close()
+    
+    parent = git_object.ref_resolve(repo, 'HEAD')
+    if parent and git_commit_graph.commit_info(repo, parent)[0] == tree:
+        raise Exception('Nothing to commit')
+    
+    commit = git_object.GitCommit()
+    commit.kvlm[b'tree'] = tree.encode()
+    if parent:
+        commit.kvlm[b'parent'] = parent.encode()
+    commit.kvlm[b'author'] = commit_identity(repo, 'AUTHOR').encode()
+    commit.kvlm[b'committer'] = commit_identity(repo, 'COMMITTER').encode()
+    commit.kvlm[None] = message.encode() if message.endswith('\n') else message.encode() + b'\n'
+    sha = git_object.object_write(commit, repo)
+    
+    head = git_refs.ref_store(repo).read('HEAD')
+    git_refs.ref_write(repo, head[5:] if head.startswith('ref: ') else 'HEAD', sha)
+    
+    # the index only gained a fresh cache tree
+    git_index.index_write(repo, index)
+    return sha
+
+def gitconfig_read():
+    import configparser
+    xdg = os.environ.get('XDG_CONFIG_HOME') or '~/.config'
+    files = [os.path.expanduser(os.path.join(xdg, 'git', 'config')), os.path.expanduser('~/.gitconfig')]
+    
+    config = configparser.ConfigParser(allow_no_value=True, strict=False, interpolation=None)
+    for f in files:
+        try:
+            config.read([f])
+        except configparser.Error:
+            pass
+    return config
+
+def commit_identity(repo, role):
+    name = os.environ.get(f'GIT_{role}_NAME')
+    email = os.environ.get(f'GIT_{role}_EMAIL')
+    for conf in (repo.conf, gitconfig_read()):
+        name = name or conf.get('user', 'name', fallback=None)
+        email = email or conf.get('user', 'email', fallback=None)
+    
+    if not name or not email:
+        raise Exception('Unknown identity: set user.name and user.email')
+    
+    from datetime import datetime
+    now = datetime.now().astimezone()
+    offset = int(now.utcoffset().total_seconds()) // 60
+    sign = '+' if offset >= 0 else '-'
+    return f'{name} <{email}> {int(now.timestamp())} {sign}{abs(offset) // 60:02d}{abs(offset) % 60:02d}'
+
+def cmd_hash_object(args):
+    repo = git_repository.repo_find(required=args.write)
+    
+    paths = list(args.path)
+    if args.stdin_paths:
+        paths.extend(line.rstrip('\n') for line in sys.stdin if line.rstrip('\n'))
+    
+    if args.type == 'blob':
+        shas = [sha for sha, _ in git_object.blobs_write(repo, paths, write=args.write, jobs=args.jobs, follow=True)]
+    else:
+        shas = list()
+        for path in paths:
+            with open(path, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                shas.append(git_object.object_write_stream(args.type.encode(), size, git_object.file_chunks(f), 
+                                                           repo=repo if args.write else None))
+    
+    sys.stdout.write(''.join(sha + '\n' for sha in shas))
+
+def cmd_commit_graph(args):
+    import git_commit_graph
+    repo = git_repository.repo_find()
+    git_commit_graph.commit_graph_write(repo, changed_paths=args.changed_paths)
     
 def cmd_log(args):
     repo = git_repository.repo_find()
     
+    sha = git_object.object_find(repo, args.commit)
+    paths = paths_parse(repo, args.paths)
+    
     print('digraph wyaglog{')
     print('  node[shape=rect]')
-    log_graphviz(repo, git_object.object_find(repo, args.commit), set())
+    if paths is None:
+        log_graphviz(repo, sha, set())
+    else:
+        log_graphviz_paths(repo, sha, paths)
     print('}')
     
 def log_graphviz(repo, sha, seen):
+    import git_commit_graph
+    stack = [sha]
+    while stack:
+        sha = stack.pop()
         if sha in seen:
-            return
+            continue
         seen.add(sha)
         
-        commit = git_object.object_read(repo, sha)
-        short_hash = sha[0:8]
-        message = commit.kvlm[None].decode('utf8').strip()
-        message = message.replace('\\', '\\\\')
-        message = message.replace('\"', '\\\"')
-        
-        if '\n' in message:
-            message = message[:message.index('\n')]
-        
-        print(f'  c_{sha} [label=\"{sha[0:7]}: {message}]')
-        assert commit.fmt==b'commit'
-        
-        if not b'parent' in commit.kvlm.keys():
-            return
+        log_graphviz_node(repo, sha)
         
-        parents = commit.kvlm[b'parent']
-        
-        if type(parents) != list:
-            parents = [parents]
+        _, parents, _, _ = git_commit_graph.commit_info(repo, sha)
         
         for p in parents:
-            p = p.decode('ascii')
-            print(f'c_{sha} -> c_{p}')
-            log_graphviz(repo, p, seen)
+            print(f'  c_{sha} -> c_{p};')
+        
+        stack.extend(reversed(parents))
+
+def log_graphviz_node(repo, sha):
+    commit = git_object.object_read(repo, sha)
+    assert commit.fmt==b'commit'
+    message = commit.headers(None)[None].decode('utf8').strip()
+    message = message.replace('\\', '\\\\')
+    message = message.replace('\"', '\\\"')
+    
+    if '\n' in message:
+        message = message[:message.index('\n')]
+    
+    print(f'  c_{sha} [label=\"{sha[0:7]}: {message}\"]')
+
+def log_graphviz_paths(repo, sha, paths):
+    # only the commits changing paths, each linked to the nearest such
+    # commits below it
+    import git_revlist
+    walk = git_revlist.GitRevWalk(repo, paths=paths)
+    for sha in list(walk.walk([sha])):
+        log_graphviz_node(repo, sha)
+        for p in walk.rewritten(sha):
+            print(f'  c_{sha} -> c_{p};')
+
+def paths_parse(repo, paths):
+    # worktree-relative paths, or None when nothing is left out
+    ret = list()
+    for path in paths:
+        rel = worktree_path(repo, path)[1]
+        if not rel:
+            return None
+        ret.append(rel)
+    return ret or None
 
 def cmd_ls_tree(args):
     repo = git_repository.repo_find()
-    ls_tree(repo, args.tree, args.recursive)
+    sparse = None
+    if args.sparse:
+        import git_sparse
+        sparse = git_sparse.sparse_load(repo)
+    ls_tree(repo, args.tree, args.recursive, sparse=sparse)
     
-def ls_tree(repo, ref, recursive=None, prefix=''):
+def ls_tree(repo, ref, recursive=None, prefix='', sparse=None):
     sha = git_object.object_find(repo, ref, fmt=b'tree')
+    ls_tree_walk(repo, sha, recursive, prefix, sparse)
+
+def ls_tree_walk(repo, sha, recursive, prefix, sparse=None):
+    import git_sparse
     obj = git_object.object_read(repo, sha)
-    for item in obj.items():
-        if len(item.mode) == 5:
-            type = item.mode[0:1]
+    for mode, name, binsha in obj.entries():
+        if len(mode) == 5:
+            type = mode[0:1]
         else:
-            type = item.mode[0:2]
+            type = mode[0:2]
         
         match type:
-            case b'04'  : type = 'tree'
+            case b'4' | b'04' : type = 'tree'
             case b'10'  : type = 'blob'
             case b'12'  : type = 'blob'
             case b'16'  : type = 'commit'
-            case _      : raise Exception(f'Weird tree leaf mode {item.mode}')
+            case _      : raise Exception(f'Weird tree leaf mode {mode}')
         
-        if not (recursive and type=='tree'):
-            print(f'{'0' * (6 - len(item.mode)) + item.mode.decode('ascii')} {type} {item.sha}\t{os.path.join(prefix, item.path)}')
+        # subtrees outside the sparse cone are listed but never read
+        inner = git_sparse.sparse_child(sparse, name) if type == 'tree' else None
+        
+        path = os.path.join(prefix, name.decode('utf8'))
+        if not (recursive and type=='tree') or inner is False:
+            print(f'{'0' * (6 - len(mode)) + mode.decode('ascii')} {type} {binsha.hex()}\t{path}')
         else:
-            ls_tree(repo, item.sha, recursive, os.path.join(prefix, item.path))
+            ls_tree_walk(repo, binsha.hex(), recursive, path, inner)
+
+def cmd_diff_tree(args):
+    import git_commit_graph
+    import git_diff
+    repo = git_repository.repo_find()
+    out = sys.stdout.buffer
+    
+    if args.new is None:
+        sha = git_object.object_find(repo, args.old, fmt=b'commit')
+        if sha is None:
+            raise Exception(f'Not a commit {args.old}')
+        new, parents, _, _ = git_commit_graph.commit_info(repo, sha)
+        # like git without -m, a root commit or a merge shows nothing
+        if len(parents) != 1:
+            return
+        old = git_commit_graph.commit_info(repo, parents[0])[0]
+        # the commit is only named when something changed
+        header = sha.encode() + b'\n'
+    else:
+        old = git_object.object_find(repo, args.old, fmt=b'tree')
+        new = git_object.object_find(repo, args.new, fmt=b'tree')
+        header = b''
+    
+    recursive = args.recursive or args.patch
+    trees = args.trees and not args.patch
+    for change in git_diff.diff_trees(repo, bytes.fromhex(old), bytes.fromhex(new), recursive, trees):
+        out.write(header)
+        header = b''
+        if args.patch:
+            out.write(b''.join(git_diff.diff_patch(repo, change, args.context)))
+            continue
+        status, old_mode, new_mode, old_sha, new_sha, path = change
+        old_hex = old_sha.hex() if old_sha else '0' * 40
+        new_hex = new_sha.hex() if new_sha else '0' * 40
+        out.write(f':{old_mode:06o} {new_mode:06o} {old_hex} {new_hex} {status}\t'.encode() + path + b'\n')
+    out.flush()
 
 def cmd_checkout(args):
     repo = git_repository.repo_find()
     
+    if args.path is None or os.path.realpath(args.path) == os.path.realpath(repo.worktree):
+        checkout_switch(repo, args.commit, jobs=args.jobs)
+        return
+    
     obj = git_object.object_read(repo, git_object.object_find(repo, args.commit))
     
     if obj.fmt == b'commit':
-        obj = git_object.object_read(repo, obj.kvlm[b'tree'].decode('ascii'))
+        obj = git_object.object_read(repo, obj.headers(b'tree')[b'tree'].decode('ascii'))
         
     if os.path.exists(args.path):
         if not os.path.isdir(args.path):
@@ -159,62 +681,232 @@ def cmd_checkout(args):
     else:
         os.makedirs(args.path)
     
-    tree_checkout(repo, obj, os.path.realpath(args.path))
+    import git_sparse
+    tree_checkout(repo, obj, os.path.realpath(args.path), jobs=args.jobs, sparse=git_sparse.sparse_load(repo))
+
+def checkout_switch(repo, name, jobs=1):
+    import git_checkout
+    import git_commit_graph
+    import git_refs
+    commit = git_object.object_find(repo, name, b'commit')
+    if commit is None:
+        raise Exception(f'Not a commit {name}')
+    tree = git_commit_graph.commit_info(repo, commit)[0]
+    
+    git_checkout.checkout_switch(repo, tree, jobs=jobs)
+    
+    # HEAD stays as it is, on its branch or not, as in git
+    if name == 'HEAD':
+        return
+    
+    # a branch name leaves HEAD on the branch, anything else detaches it
+    branch = f'refs/heads/{name}'
+    git_refs.ref_write(repo, 'HEAD', f'ref: {branch}' if git_refs.ref_store(repo).read(branch) else commit)
+
+def tree_checkout(repo, tree, path, jobs=1, sparse=None):
+    import git_checkout
+    import git_trace
+    dirs = list()
+    files = list()
+    with git_trace.region('checkout.plan'):
+        tree_checkout_plan(repo, tree, path, dirs, files, sparse)
+    
+    for d in dirs:
+        os.mkdir(d)
+    
+    if jobs == 0:
+        jobs = os.cpu_count() or 1
+    
+    if jobs == 1 or len(files) < 2:
+        for mode, sha, dest in files:
+            git_checkout.blob_checkout(repo, mode, sha, dest)
+    else:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            for _ in pool.map(lambda f: git_checkout.blob_checkout(repo, *f), files):
+                pass
 
-def tree_checkout(repo, tree, path):
+def tree_checkout_plan(repo, tree, path, dirs, files, sparse=None):
+    import git_sparse
     for item in tree.items:
-        obj = git_object.object_read(repo, item.sha)
         dest = os.path.join(path, item.path)
         
-        if obj.fmt == b'tree':
-            os.mkdir(dest)
-            tree_checkout(repo, obj, dest)
-        elif obj.fmt == b'blob':
-            with open(dest, 'wb') as f:
-                f.write(obj.blobdata)
+        if item.mode.startswith(b'04'):
+            # subtrees outside the sparse cone are not even read
+            inner = git_sparse.sparse_child(sparse, item.name)
+            if inner is not False:
+                dirs.append(dest)
+                tree_checkout_plan(repo, git_object.object_read(repo, item.sha), dest, dirs, files, inner)
+        elif not item.mode.startswith(b'16'):
+            files.append((item.mode, item.sha, dest))
+
+def cmd_sparse_checkout(args):
+    import git_checkout
+    import git_sparse
+    repo = git_repository.repo_find()
+    
+    match args.action:
+        case 'list':
+            for d in git_sparse.sparse_read(repo) or []:
+                print(os.fsdecode(d))
+        case 'set' | 'add':
+            dirs = [os.fsencode(d.replace(os.sep, '/')) for d in args.dirs]
+            if args.action == 'add':
+                dirs.extend(git_sparse.sparse_read(repo) or [])
+            sparse_checkout_set(repo, dirs, jobs=args.jobs)
+        case 'reapply':
+            git_checkout.checkout_reapply(repo, jobs=args.jobs)
+        case 'disable':
+            sparse_checkout_set(repo, None, jobs=args.jobs)
+
+def sparse_checkout_set(repo, dirs, jobs=1):
+    import git_checkout
+    import git_sparse
+    old = git_sparse.sparse_read(repo)
+    
+    # index.sparse keeps git itself from expanding the directory entries
+    enabled = 'false' if dirs is None else 'true'
+    if dirs is not None:
+        git_sparse.sparse_write(repo, dirs)
+    git_repository.repo_config_set(repo, {('core', 'sparsecheckout'): enabled, 
+                                          ('core', 'sparsecheckoutcone'): 'true',
+                                          ('index', 'sparse'): enabled})
+    try:
+        git_checkout.checkout_reapply(repo, jobs=jobs)
+    except BaseException:
+        if old is not None:
+            git_sparse.sparse_write(repo, old)
+        restored = 'false' if old is None else 'true'
+        git_repository.repo_config_set(repo, {('core', 'sparsecheckout'): restored, 
+                                              ('index', 'sparse'): restored})
+        raise
 
 def cmd_show_ref(args):
     repo = git_repository.repo_find()
-    refs = git_object.ref_list(repo)
-    show_ref(repo, refs, prefix='refs')
+    show_ref(repo, 'refs/', dereference=args.dereference)
+    
+def show_ref(repo, prefix, with_hash=True, dereference=False):
+    import git_refs
+    refs = git_refs.ref_store(repo)
+    for name, sha in refs.iter_prefix(prefix):
+        if sha is None:
+            continue
+        print(f'{sha + ' ' if with_hash else ''}{name if with_hash else name[len(prefix):]}')
+        if dereference:
+            peeled = refs.peel(name) or ref_peel(repo, sha)
+            if peeled and peeled != sha:
+                print(f'{peeled} {name}^{{}}')
+
+def ref_peel(repo, sha):
+    while True:
+        header = git_object.object_header(repo, sha)
+        if not header or header[0] != b'tag':
+            return sha
+        sha = git_object.object_read(repo, sha).headers(b'object')[b'object'].decode('ascii')
+
+def cmd_status(args):
+    import git_status
+    repo = git_repository.repo_find()
+    result = git_status.status(repo, jobs=args.jobs, untracked=args.untracked != 'no')
     
-def show_ref(repo, refs, with_hash=True, prefix=''):
-    for k, v in refs.items():
-        if type(v) == str:
-            print(f'{v + ' ' if with_hash else ''}{prefix + '/' if prefix else ''}{k}')
+    if args.short:
+        status_short(result)
+    else:
+        status_long(repo, result)
+
+def status_short(result):
+    names = sorted(set(result.staged) | set(result.unstaged) | result.unmerged)
+    for name in names:
+        if name in result.unmerged:
+            print(f'UU {name}')
         else:
-            show_ref(repo, v, with_hash=with_hash, prefix=f'{prefix}{'/' if prefix else ''}{k}')
+            print(f'{result.staged.get(name, ' ')}{result.unstaged.get(name, ' ')} {name}')
+    for name in result.untracked:
+        print(f'?? {name}')
+
+def status_long(repo, result):
+    import git_refs
+    labels = {'A': 'new file', 'D': 'deleted', 'M': 'modified', 'T': 'typechange'}
+    
+    head = git_refs.ref_store(repo).read('HEAD')
+    if head.startswith('ref: refs/heads/'):
+        print(f'On branch {head[16:]}')
+    else:
+        print(f'HEAD detached at {head[:7]}')
+    
+    sections = [
+        ('Unmerged paths:', [('both modified', name) for name in sorted(result.unmerged)]),
+        ('Changes to be committed:', [(labels[c], name) for name, c in sorted(result.staged.items())]),
+        ('Changes not staged for commit:', [(labels[c], name) for name, c in sorted(result.unstaged.items())]),
+        ('Untracked files:', [(None, name) for name in result.untracked]),
+    ]
+    
+    clean = True
+    for title, lines in sections:
+        if not lines:
+            continue
+        clean = False
+        print(f'\n{title}')
+        for label, name in lines:
+            print(f'\t{label + ':':<12}{name}' if label else f'\t{name}')
+    
+    if clean:
+        print('nothing to commit, working tree clean')
 
 def cmd_tag(args):
     repo = git_repository.repo_find()
     
     if args.name:
-        tag_create(repo, args.name, args.object, type='object' if args.create_tag_object else 'ref')
+        tag_create(repo, args.name, args.object, create_tag_object=args.create_tag_object)
     else:
-        refs = git_object.ref_list(repo)
-        show_ref(repo, refs['tags'], with_hash=False)
+        show_ref(repo, 'refs/tags/', with_hash=False)
         
 def tag_create(repo, name, ref, create_tag_object=False):
     sha = git_object.object_find(repo, ref)
     
     if create_tag_object:
-        tag = git_object.GitTag(repo)
-        tag.kvlm = collections.OrderedDict()
+        tag = git_object.GitTag()
         tag.kvlm[b'object'] = sha.encode()
-        tag.kvlm[b'type'] = b'commit'
+        tag.kvlm[b'type'] = git_object.object_header(repo, sha)[0]
         tag.kvlm[b'tag'] = name.encode()
         
-        tag.kvlm[b'tagger'] = b'Wyag <wyag@example.com>'
-        tag.kvlm[None] = b'A tag generated by wyag'
-        tag_sha = git_object.object_write(tag)
+        from datetime import datetime
+        tag.kvlm[b'tagger'] = f'Wyag <wyag@example.com> {int(datetime.now().timestamp())} +0000'.encode()
+        tag.kvlm[None] = b'A tag generated by wyag\n'
+        tag_sha = git_object.object_write(tag, repo)
         
         ref_create(repo, 'tags/' + name, tag_sha)
     else:
         ref_create(repo, 'tags/' + name, sha)
         
 def ref_create(repo, ref_name, sha):
-    with open(git_repository.repo_file(repo, 'refs/' + ref_name), 'w') as fp:
-        fp.write(sha + '\n')
+    import git_refs
+    git_refs.ref_write(repo, 'refs/' + ref_name, sha)
+
+def cmd_pack_refs(args):
+    import git_refs
+    repo = git_repository.repo_find()
+    git_refs.refs_pack(repo, lambda sha: ref_peel(repo, sha), all_refs=args.all, prune=args.prune)
+
+def cmd_repack(args):
+    import git_repack
+    repo = git_repository.repo_find()
+    name, total, deltas = git_repack.repack(repo, all_objects=args.all_objects or args.loosen, delete=args.delete, 
+                                            window=args.window, depth=args.depth, loosen=args.loosen)
+    if name:
+        print(f'Total {total} (delta {deltas}) pack-{name}')
+    else:
+        print('Nothing new to pack')
+
+def cmd_gc(args):
+    import git_commit_graph
+    import git_refs
+    import git_repack
+    repo = git_repository.repo_find()
+    git_refs.refs_pack(repo, lambda sha: ref_peel(repo, sha), all_refs=True)
+    # unreachable packed objects are loosened rather than dropped, as git gc does
+    git_repack.repack(repo, all_objects=True, delete=True, loosen=True)
+    git_commit_graph.commit_graph_write(repo)
 
 def cmd_rev_parse(args):
     if args.type:
@@ -224,4 +916,55 @@ def cmd_rev_parse(args):
         
     repo = git_repository.repo_find()
     
-    print(git_object.object_find(repo, args.name, fmt, follow=True))
\ No newline at end of file
+    sha = git_object.object_find(repo, args.name, fmt, follow=True)
+    if args.short is not None:
+        sha = git_object.object_abbrev(repo, sha, args.short)
+    print(sha)
+
+def cmd_rev_list(args):
+    import git_revlist
+    repo = git_repository.repo_find()
+    
+    include, exclude = git_revlist.rev_parse_ranges(repo, args.rev)
+    commits = git_revlist.rev_list(repo, include, exclude, max_count=args.max_count, 
+                                   since=date_parse(args.since), until=date_parse(args.until), 
+                                   first_parent=args.first_parent, topo=args.topo_order, 
+                                   paths=paths_parse(repo, args.paths))
+    if args.count:
+        print(sum(1 for _ in commits))
+        return
+    
+    out = sys.stdout
+    for sha in commits:
+        out.write(sha + '\n')
+    out.flush()
+
+def cmd_merge_base(args):
+    import git_revlist
+    repo = git_repository.repo_find()
+    
+    one = git_object.object_find(repo, args.one, b'commit')
+    two = git_object.object_find(repo, args.two, b'commit')
+    bases = git_revlist.merge_bases(repo, one, two)
+    if not bases:
+        sys.exit(1)
+    for sha in bases if args.all else bases[:1]:
+        print(sha)
+
+def date_parse(value):
+    # seconds since the epoch, or an ISO 8601 date in local time
+    if value is None:
+        return None
+    if value.lstrip('-').isdigit():
+        return int(value)
+    import datetime
+    try:
+        return int(datetime.datetime.fromisoformat(value).timestamp())
+    except ValueError:
+        raise Exception(f'Bad date {value}')
+
+def cmd_serve(args):
+    import git_serve
+    if not args.socket:
+        raise Exception(f'No socket: pass --socket or set ${git_serve.SOCKET_ENV}')
+    git_serve.serve(args.socket)